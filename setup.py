@@ -17,6 +17,7 @@ setup(name='django_uncertainty',
       url='https://github.com/abarto/django_uncertainty',
       license='BSD',
       install_requires=[],
+      extras_require={'numpy': ['numpy']},
       tests_require=['Django>=1.10'],
       test_suite='uncertainty.tests.runtests.runtests',
       classifiers=[
@@ -1,13 +1,27 @@
 from __future__ import absolute_import
 
-from .behaviours import (default, bad_request, case, cond, conditional, delay,  # noqa
+from .behaviours import (default, bad_request, budget, case, cond, conditional, delay,  # noqa
                          delay_request, forbidden, html, json, multi_conditional, not_allowed, ok,
-                         random_choice, server_error, status, slowdown, random_stop)
-from .conditions import (has_param, has_parameter, is_authenticated, is_delete, is_get,  # noqa
-                         is_method, is_post, is_put, path_matches, path_is, user_is)
+                         random_choice, rate_limit, round_robin_choice, server_error, status,
+                         slowdown, random_stop, rechunk, throttle)
+from .conditions import (has_body_param, has_body_parameter, has_cookie, has_param,  # noqa
+                         has_parameter, has_query_param, has_query_parameter, header_is,
+                         header_matches, is_authenticated, is_delete, is_get, is_method, is_post,
+                         is_put, meta_is, path_matches, path_is, user_is)
+from .distributions import (capped, empirical, exponential, jitter, lognormal, pareto,  # noqa
+                            per_path, uniform)
 from .middleware import UncertaintyMiddleware  # noqa
+from .nodes import intern_spec  # noqa
+from .optimizer import optimize_spec  # noqa
+from .sources import cache_spec, file_spec, publish_spec  # noqa
+from .specs import build_spec, load_spec_file  # noqa
 
 __all__ = ('html', 'bad_request', 'forbidden', 'not_allowed', 'server_error', 'status', 'json',
            'delay', 'delay_request', 'random_choice', 'conditional', 'is_method', 'is_get',
            'is_delete', 'is_post', 'is_put', 'has_parameter', 'path_matches', 'path_is',
-           'is_authenticated', 'user_is', 'slowdown', random_stop)
+           'is_authenticated', 'user_is', 'slowdown', 'random_stop', 'round_robin_choice',
+           'exponential', 'lognormal', 'pareto', 'uniform', 'jitter', 'capped', 'empirical',
+           'per_path', 'throttle', 'rechunk', 'rate_limit', 'budget', 'has_query_parameter',
+           'has_body_parameter', 'file_spec', 'cache_spec', 'publish_spec', 'build_spec',
+           'load_spec_file', 'intern_spec', 'optimize_spec', 'header_is', 'header_matches',
+           'has_cookie', 'meta_is')
@@ -1,13 +1,40 @@
-from random import random
-from time import sleep
+from asyncio import sleep as async_sleep
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import count
+from math import ceil
+from threading import Lock
+from time import monotonic, sleep
+
+try:
+    from asgiref.sync import async_to_sync, sync_to_async
+except ImportError:  # Django < 3.0, async support is not available
+    async_to_sync = sync_to_async = None
 
 from django.http import (HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
-                         HttpResponseNotAllowed, HttpResponseServerError, JsonResponse)
+                         HttpResponseNotAllowed, HttpResponseServerError, JsonResponse,
+                         StreamingHttpResponse)
 
+from . import metrics
+from .conditions import (_meta_key, compile_path_dispatch, compile_predicate, is_path_dispatchable,
+                         is_synchronous)
+from .counters import SharedCounter
+from .distributions import Distribution
+from .nodes import Node
+from .rng import random
 
-class Behaviour:
+
+class Behaviour(Node):
     """Base of all behaviours. It is also the default implementation which just just returns the
-    result of calling get_response."""
+    result of calling get_response. Behaviours are immutable and compared by their constructor
+    arguments (see uncertainty.nodes.Node)."""
+    __slots__ = ()
+
+    def __reduce__(self):
+        if self is _default:  # pickled by name, so it's still the shared instance when unpickled
+            return '_default'
+        return super().__reduce__()
+
     def __call__(self, get_response, request):
         """Returns the result of calling get_response (as given by the UncertaintyMiddleware
         middleware with request as argument. It returns the same response that would have been
@@ -18,21 +45,60 @@ class Behaviour:
         """
         response = get_response(request)
         return response
+
+    async def acall(self, get_response, request):
+        """The asynchronous counterpart of __call__, used by UncertaintyMiddleware when the Django
+        stack runs asynchronously (ASGI). It awaits get_response with request as argument. If a
+        subclass only overrides __call__, the synchronous implementation is run in a thread with a
+        synchronous version of get_response.
+        :param get_response: The (asynchronous) get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of awaiting get_response with the request parameter
+        """
+        if type(self).__call__ is not Behaviour.__call__:
+            return await sync_to_async(self)(async_to_sync(get_response), request)
+
+        response = await get_response(request)
+        return response
 default = Behaviour
 _default = default()
 
 
+async def acall(behaviour, get_response, request):
+    """Invokes a behaviour asynchronously. Behaviour objects are awaited through their acall method,
+    any other callable following the behaviour protocol is run in a thread.
+    :param behaviour: The behaviour to invoke
+    :param get_response: The (asynchronous) get_response method provided by the Django stack
+    :param request: The request that triggered the middleware
+    :return: The result of invoking the behaviour
+    """
+    if isinstance(behaviour, Behaviour):
+        return await behaviour.acall(get_response, request)
+
+    return await sync_to_async(behaviour)(async_to_sync(get_response), request)
+
+
+_no_kwargs = {}  # shared by the behaviours without named arguments, never modified
+
+
 class HttpResponseBehaviour(Behaviour):
-    def __init__(self, response_class, *args, **kwargs):
+    __slots__ = ('_response_class', '_args', '_kwargs', '_static', '_rendered')
+
+    def __init__(self, response_class, *args, static=False, **kwargs):
         """A Behaviour that overrides the default response with the result of calling an
         HttpResponse constructor.
         :param response_class: An HttpResponse class
         :param args: The positional arguments for the HttpResponse constructor
+        :param static: If True, the response is rendered (content serialized, headers computed)
+        only once and every invocation returns a new response around the same content bytes.
+        Useful for json responses, as the data isn't serialized on every request.
         :param kwargs: The named arguments for the HttpResponse constructor
         """
         self._response_class = response_class
         self._args = args
-        self._kwargs = kwargs
+        self._kwargs = kwargs or _no_kwargs  # most responses take no named arguments
+        self._static = static
+        self._rendered = None
 
     def __call__(self, get_response, request):
         """Returns the result of calling the HttpResponse constructor with the positional and named
@@ -42,9 +108,49 @@ class HttpResponseBehaviour(Behaviour):
         :return: The result of calling the HttpResponse constructor with the positional and named
         arguments supplied.
         """
-        response = self._response_class(*self._args, **self._kwargs)
+        if self._static:
+            response = self._static_response()
+        else:
+            response = self._response_class(*self._args, **self._kwargs)
+
+        if metrics.enabled:
+            metrics.response(self, response.status_code)
         return response
 
+    def _static_response(self):
+        """Returns a new response with the pre-rendered content, status and headers. The rendering
+        happens on the first invocation (and not on __init__) as the specification is usually built
+        before the Django settings are available."""
+        rendered = self._rendered
+        if rendered is None:
+            rendered = self._render()
+            object.__setattr__(self, '_rendered', rendered)  # a cache, not part of the state
+
+        response_class, content, kwargs = rendered
+        return response_class(content, **kwargs)
+
+    def _render(self):
+        response = self._response_class(*self._args, **self._kwargs)
+        # Classes with their own constructor (JsonResponse, HttpResponseNotAllowed, etc.) can't be
+        # built from rendered content, so a plain HttpResponse is used for those
+        if getattr(self._response_class, '__init__', None) is HttpResponse.__init__:
+            response_class = self._response_class
+        else:
+            response_class = HttpResponse
+
+        return response_class, response.content, {'status': response.status_code,
+                                                  'reason': response.reason_phrase,
+                                                  'headers': dict(response.items())}
+
+    async def acall(self, get_response, request):
+        """Asynchronous version of __call__. Building the response does not block so it is done
+        in the event loop.
+        :param get_response: The get_response method provided by the Django stack (ignored)
+        :param request: The request that triggered the middleware (ignored)
+        :return: The result of calling the HttpResponse constructor
+        """
+        return self(get_response, request)
+
     def __str__(self):
         return ('HttpResponseBehaviour('
                 'response_class={response_class}, '
@@ -146,11 +252,26 @@ def json(data, *args, **kwargs):
     return HttpResponseBehaviour(JsonResponse, data, *args, **kwargs)
 
 
+def _seconds(behaviour, seconds, request):
+    """Returns the delay to introduce by behaviour, which is either a fixed amount of seconds or a
+    sample of a Distribution."""
+    if isinstance(seconds, Distribution):
+        seconds = seconds.sample(request)
+
+    if metrics.enabled:
+        metrics.delay(behaviour, seconds)
+    return seconds
+
+
 class DelayResponseBehaviour(Behaviour):
+    __slots__ = ('_behaviour', '_seconds')
+    _argument_slots = __slots__
+
     def __init__(self, behaviour, seconds):
         """A Behaviour that delays the response to the client a given amount of seconds.
         :param behaviour: The behaviour to invoke before delaying its response
         :param seconds: The amount of seconds to wait after requesting a response from the behaviour
+        or a Distribution (see uncertainty.distributions) to take the amount from
         """
         self._behaviour = behaviour
         self._seconds = seconds
@@ -163,8 +284,23 @@ class DelayResponseBehaviour(Behaviour):
         :param request: The request that triggered the middleware (ignored)
         :return: The result of calling the encapsulated behaviour
         """
+        if metrics.enabled:
+            metrics.invoked(self._behaviour)
         response = self._behaviour(get_response, request)
-        sleep(self._seconds)
+        sleep(_seconds(self, self._seconds, request))
+        return response
+
+    async def acall(self, get_response, request):
+        """Asynchronous version of __call__. The delay is introduced with asyncio.sleep so the event
+        loop keeps serving other requests while this one waits.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of awaiting the encapsulated behaviour
+        """
+        if metrics.enabled:
+            metrics.invoked(self._behaviour)
+        response = await acall(self._behaviour, get_response, request)
+        await async_sleep(_seconds(self, self._seconds, request))
         return response
 
     def __str__(self):
@@ -176,12 +312,15 @@ delay = DelayResponseBehaviour
 
 
 class DelayRequestBehaviour(Behaviour):
+    __slots__ = ('_behaviour', '_seconds')
+    _argument_slots = __slots__
+
     def __init__(self, behaviour, seconds):
         """A Behaviour that delays the response to the client a given amount of seconds. It
         introduces the delay BEFORE invoking the encapsulated behaviour.
         :param behaviour: The behaviour to invoke
         :param seconds: The amount of seconds to wait before requesting a response from the
-        behaviour
+        behaviour or a Distribution (see uncertainty.distributions) to take the amount from
         """
         self._behaviour = behaviour
         self._seconds = seconds
@@ -194,10 +333,25 @@ class DelayRequestBehaviour(Behaviour):
         :param request: The request that triggered the middleware (ignored)
         :return: The result of calling the encapsulated behaviour
         """
-        sleep(self._seconds)
+        sleep(_seconds(self, self._seconds, request))
+        if metrics.enabled:
+            metrics.invoked(self._behaviour)
         response = self._behaviour(get_response, request)
         return response
 
+    async def acall(self, get_response, request):
+        """Asynchronous version of __call__. The delay is introduced with asyncio.sleep so the event
+        loop keeps serving other requests while this one waits.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of awaiting the encapsulated behaviour
+        """
+        await async_sleep(_seconds(self, self._seconds, request))
+        if metrics.enabled:
+            metrics.invoked(self._behaviour)
+        response = await acall(self._behaviour, get_response, request)
+        return response
+
     def __str__(self):
         return ('DelayRequest('
                 'behaviour={behaviour}, '
@@ -206,7 +360,201 @@ class DelayRequestBehaviour(Behaviour):
 delay_request = DelayRequestBehaviour
 
 
+class RateLimitBehaviour(Behaviour):
+    __slots__ = ('_behaviour', '_rate', '_per', '_burst', '_key', '_max_keys', '_interval',
+                 '_tolerance', '_key_function', '_synchronous_key', '_arrival_times', '_lock')
+    stateful = True
+
+    def __init__(self, behaviour, rate, per=1, burst=None, key='ip', max_keys=10000):
+        """A Behaviour that emulates a server enforcing a rate limit. Requests are counted per key
+        with the Generic Cell Rate Algorithm (GCRA), which only keeps the theoretical arrival time
+        of each key. Requests within the limit are served by the encapsulated behaviour, the rest
+        get a 429 (Too Many Requests) response with a Retry-After header. Only the max_keys most
+        recently seen keys are tracked.
+        :param behaviour: The behaviour to invoke if the request is within the limit
+        :param rate: The amount of requests allowed every per seconds
+        :param per: The period of the rate in seconds
+        :param burst: The amount of requests that can be made at once, at least 1. Defaults to
+        rate (or 1 if rate is lower).
+        :param key: What the requests are counted by: 'ip' (the REMOTE_ADDR), 'user' (the
+        authenticated user, or the IP for anonymous requests), the name of a header, or a callable
+        that takes the request and returns the key
+        :param max_keys: The maximum amount of keys tracked at once
+        """
+        self._behaviour = behaviour
+        self._rate = rate
+        self._per = per
+        self._burst = burst if burst is not None else max(rate, 1)
+        if self._burst < 1:
+            raise ValueError('The burst must allow at least one request')
+        self._key = key
+        self._max_keys = max_keys
+        self._interval = per / rate
+        self._tolerance = self._interval * self._burst
+        self._key_function = self._get_key_function(key)
+        # the user key reads the lazy request.user and callables could do anything, so they may
+        # touch the database
+        self._synchronous_key = key == 'user' or callable(key)
+        self._arrival_times = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _get_key_function(key):
+        if callable(key):
+            return key
+
+        if key == 'ip':
+            return lambda request: request.META.get('REMOTE_ADDR')
+
+        if key == 'user':
+            def user_key(request):
+                user = getattr(request, 'user', None)
+                if user is not None and user.is_authenticated:
+                    return 'user', user.pk
+                return request.META.get('REMOTE_ADDR')
+            return user_key
+
+        meta_key = _meta_key(key)
+        return lambda request: request.META.get(meta_key)
+
+    def _retry_after(self, request):
+        """Accounts for the request and returns the amount of seconds the client has to wait
+        before being allowed, or 0 if the request is within the limit."""
+        key = self._key_function(request)
+        now = monotonic()
+        arrival_times = self._arrival_times
+        with self._lock:
+            last_arrival_time = arrival_times.get(key)
+            if last_arrival_time is None:
+                last_arrival_time = now
+                if len(arrival_times) >= self._max_keys:
+                    arrival_times.popitem(last=False)
+            else:
+                arrival_times.move_to_end(key)
+
+            arrival_time = max(last_arrival_time, now) + self._interval
+            allowed_at = arrival_time - self._tolerance
+            if now < allowed_at:
+                return allowed_at - now
+
+            arrival_times[key] = arrival_time
+
+        return 0
+
+    def _too_many_requests(self, retry_after):
+        if metrics.enabled:
+            metrics.response(self, 429)
+        return HttpResponse(status=429, headers={'Retry-After': str(ceil(retry_after))})
+
+    def __call__(self, get_response, request):
+        """Returns the result of invoking the encapsulated behaviour if the request is within the
+        limit, or a 429 response otherwise.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of calling the encapsulated behaviour or a 429 response
+        """
+        retry_after = self._retry_after(request)
+        if retry_after:
+            return self._too_many_requests(retry_after)
+
+        if metrics.enabled:
+            metrics.chose(self, self._behaviour)
+        return self._behaviour(get_response, request)
+
+    async def acall(self, get_response, request):
+        """Asynchronous version of __call__.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of awaiting the encapsulated behaviour or a 429 response
+        """
+        if self._synchronous_key:
+            retry_after = await sync_to_async(self._retry_after)(request)
+        else:
+            retry_after = self._retry_after(request)
+        if retry_after:
+            return self._too_many_requests(retry_after)
+
+        if metrics.enabled:
+            metrics.chose(self, self._behaviour)
+        return await acall(self._behaviour, get_response, request)
+
+    def __str__(self):
+        return ('RateLimitBehaviour('
+                'behaviour={behaviour}, '
+                'rate={rate}, '
+                'per={per}, '
+                'burst={burst}, '
+                'key={key})').format(behaviour=self._behaviour, rate=self._rate, per=self._per,
+                                     burst=self._burst, key=self._key)
+rate_limit = RateLimitBehaviour
+
+
+class BudgetBehaviour(Behaviour):
+    __slots__ = ('_behaviour', '_amount', '_per', '_fallback', '_counter')
+
+    def __init__(self, behaviour, amount, name, per=None, fallback=None, slots=64, path=None):
+        """A Behaviour that invokes the encapsulated behaviour at most amount times (every per
+        seconds, if given) across all the processes of the host, e.g. to inject exactly 1000 errors
+        per minute regardless of the amount of workers. Once the budget is spent, the fallback
+        behaviour is invoked instead. The invocations are counted with a SharedCounter (see
+        uncertainty.counters) named name, so the budgets of different behaviours need different
+        names. Workers spending the budget at the same time may exceed it by one invocation each.
+        :param behaviour: The behaviour to invoke while there's budget left
+        :param amount: The amount of invocations of the behaviour
+        :param name: The name of the budget, shared by all the processes
+        :param per: The length in seconds of the budget windows (optional)
+        :param fallback: The behaviour to invoke once the budget is spent (default if not given)
+        :param slots: The maximum amount of processes that can spend the budget
+        :param path: The path of the file backing the counter (optional)
+        """
+        self._behaviour = behaviour
+        self._amount = amount
+        self._per = per
+        self._fallback = fallback if fallback is not None else _default
+        self._counter = SharedCounter(name, window=per, slots=slots, path=path)
+
+    def _choose(self):
+        if self._counter.add_if_below(self._amount):
+            behaviour = self._behaviour
+        else:
+            behaviour = self._fallback
+
+        if metrics.enabled:
+            metrics.chose(self, behaviour)
+        return behaviour
+
+    def __call__(self, get_response, request):
+        """Returns the result of invoking the encapsulated behaviour if there's budget left, or the
+        result of invoking the fallback behaviour otherwise.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of calling the chosen behaviour
+        """
+        return self._choose()(get_response, request)
+
+    async def acall(self, get_response, request):
+        """Asynchronous version of __call__.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of awaiting the chosen behaviour
+        """
+        return await acall(self._choose(), get_response, request)
+
+    def __str__(self):
+        return ('BudgetBehaviour('
+                'behaviour={behaviour}, '
+                'amount={amount}, '
+                'per={per}, '
+                'fallback={fallback}, '
+                'counter={counter})').format(behaviour=self._behaviour, amount=self._amount,
+                                             per=self._per, fallback=self._fallback,
+                                             counter=self._counter)
+budget = BudgetBehaviour
+
+
 class RandomChoiceBehaviour(Behaviour):
+    __slots__ = ('_behaviours', '_choices', '_cdf')
+
     def __init__(self, behaviours):
         """A behaviour that chooses randomly amongst the encapsulated behaviours. It is possible to
         specify different proportions between the behaviours. For instance, to specify a 50 percent
@@ -225,6 +573,8 @@ class RandomChoiceBehaviour(Behaviour):
         behaviour.
         """
         self._behaviours = self._init_cdf(behaviours)
+        self._choices = [behaviour for behaviour, _ in self._behaviours]
+        self._cdf = [f_x for _, f_x in self._behaviours]
 
     def _init_cdf(self, behaviours):
         with_proportions = list(filter(lambda s: isinstance(s, (list, tuple)), behaviours))
@@ -256,20 +606,105 @@ class RandomChoiceBehaviour(Behaviour):
         :return: The result of calling one of the encapsulated behaviours chosing randomly amognst
         them.
         """
-        x = random()
-        for behaviour, f_x in self._behaviours:
-            if x < f_x:
-                return behaviour(get_response, request)
-        return _default(get_response, request)
+        behaviour = self._choose(request)
+        if metrics.enabled:
+            metrics.chose(self, behaviour)
+        return behaviour(get_response, request)
+
+    async def acall(self, get_response, request):
+        """Asynchronous version of __call__.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of awaiting one of the encapsulated behaviours chosen randomly
+        """
+        behaviour = self._choose(request)
+        if metrics.enabled:
+            metrics.chose(self, behaviour)
+        return await acall(behaviour, get_response, request)
+
+    def _choose(self, request):
+        """Returns the first behaviour whose cumulative proportion is greater than a random number,
+        using a binary search over the CDF, or the default behaviour if there's none."""
+        index = bisect_right(self._cdf, random(request))
+        if index < len(self._choices):
+            return self._choices[index]
+        return _default
 
     def __str__(self):
         return ('RandomChoiceBehaviour('
                 'behaviours=[{behaviours}])').format(
-                    behaviours=', '.join(b for b in self._behaviours))
+                    behaviours=', '.join('({b}, {f_x})'.format(b=b, f_x=f_x)
+                                         for b, f_x in self._behaviours))
 random_choice = RandomChoiceBehaviour
 
 
+class RoundRobinChoiceBehaviour(RandomChoiceBehaviour):
+    __slots__ = ('_window', '_schedule', '_counter')
+    stateful = True
+
+    def __init__(self, behaviours, window=100):
+        """A behaviour that chooses amongst the encapsulated behaviours deterministically instead of
+        randomly. It takes the same specification as RandomChoiceBehaviour, and every (aligned)
+        window of requests gets each behaviour in its given proportion, rounded to whole requests.
+        The behaviours are interleaved using a smooth weighted round-robin, so for example
+
+        RoundRobinChoiceBehaviour([(server_error(), 0.05)], window=100)
+
+        responds with a server error to exactly 5 out of every 100 requests, evenly spread.
+
+        :param behaviours: A sequence of Behaviour objects or tuples of a Behaviour object and a
+        number less than 1 representing the proportion of requests that are going to exhibit that
+        behaviour.
+        :param window: The number of requests over which the proportions are exact
+        """
+        super().__init__(behaviours)
+        self._window = window
+        self._schedule = self._init_schedule(window)
+        self._counter = count()
+
+    def _init_schedule(self, window):
+        """Apportions the window amongst the behaviours (and the default behaviour, which gets the
+        remaining proportion) using the largest remainder method, and orders the result with the
+        smooth weighted round-robin algorithm."""
+        choices = self._choices + [_default]
+        proportions = [f_x - f_x_1 for f_x, f_x_1 in zip(self._cdf + [1], [0] + self._cdf)]
+
+        quotas = [max(proportion, 0) * window for proportion in proportions]
+        weights = [int(quota) for quota in quotas]
+        by_remainder = sorted(range(len(quotas)), key=lambda i: weights[i] - quotas[i])
+        for i in by_remainder[:window - sum(weights)]:
+            weights[i] += 1
+
+        current = [0] * len(weights)
+        schedule = []
+        for _ in range(window):
+            for i, weight in enumerate(weights):
+                current[i] += weight
+            chosen = max(range(len(current)), key=current.__getitem__)
+            current[chosen] -= window
+            schedule.append(choices[chosen])
+
+        return schedule
+
+    def _choose(self, request):
+        """Returns the next behaviour in the schedule. next() on itertools.count is atomic, so no
+        lock is needed to share the behaviour amongst threads."""
+        return self._schedule[next(self._counter) % self._window]
+
+    def __str__(self):
+        return ('RoundRobinChoiceBehaviour('
+                'behaviours=[{behaviours}], '
+                'window={window})').format(
+                    behaviours=', '.join('({b}, {f_x})'.format(b=b, f_x=f_x)
+                                         for b, f_x in self._behaviours),
+                    window=self._window)
+round_robin_choice = RoundRobinChoiceBehaviour
+
+
 class ConditionalBehaviour(Behaviour):
+    __slots__ = ('_predicate', '_test', '_synchronous', '_behaviour', '_alternative_behaviour')
+    _argument_slots = ('_predicate', '_behaviour', '_alternative_behaviour')
+
     def __init__(self, predicate, behaviour, alternative_behaviour=None):
         """A Behaviour that invokes the encapsulated behaviour if a condition is met, otherwise it
         invokes the alternative behaviour. The default alternative behaviour is just going through
@@ -280,6 +715,8 @@ class ConditionalBehaviour(Behaviour):
         met
         """
         self._predicate = predicate
+        self._test = compile_predicate(predicate)
+        self._synchronous = is_synchronous(predicate)
         self._behaviour = behaviour
         self._alternative_behaviour = alternative_behaviour or _default  # makes testing easier
 
@@ -292,10 +729,28 @@ class ConditionalBehaviour(Behaviour):
         :return: The result of calling the encapsulated behaviour if the predicate condition is met
         or the result of invoking the alternative behaviour otherwise.
         """
-        if self._predicate(get_response, request):
-            return self._behaviour(get_response, request)
+        return self._choose(get_response, request)(get_response, request)
 
-        return self._alternative_behaviour(get_response, request)
+    async def acall(self, get_response, request):
+        """Asynchronous version of __call__. The predicate is evaluated on the event loop, or in a
+        thread if it may touch the database (see is_synchronous).
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of awaiting the encapsulated or the alternative behaviour
+        """
+        if self._synchronous:
+            behaviour = await sync_to_async(self._choose)(get_response, request)
+        else:
+            behaviour = self._choose(get_response, request)
+        return await acall(behaviour, get_response, request)
+
+    def _choose(self, get_response, request):
+        result = self._test(get_response, request)
+        behaviour = self._behaviour if result else self._alternative_behaviour
+        if metrics.enabled:
+            metrics.predicate_result(self._predicate, result)
+            metrics.chose(self, behaviour)
+        return behaviour
 
     def __str__(self):
         return ('ConditionalBehaviour('
@@ -308,7 +763,13 @@ conditional = ConditionalBehaviour
 cond = ConditionalBehaviour
 
 
+_dispatched = object()
+
+
 class MultiConditionalBehaviour(Behaviour):
+    __slots__ = ('_predicates_behaviours', '_tests_behaviours', '_synchronous',
+                 '_default_behaviour')
+
     def __init__(self, predicates_behaviours, default_behaviour=None):
         """A Behaviour that takes several conditions (predicates) and behaviours and executes the
         behaviour associated with the fist condition that is met. If no conditions are met,
@@ -316,9 +777,35 @@ class MultiConditionalBehaviour(Behaviour):
         :param predicates_behaviours: A list of (predicate, behaviour) tuples
         :param default_behaviour: The default behaviour to invoke if no conditions are met
         """
-        self._predicates_behaviours = predicates_behaviours
+        self._predicates_behaviours = list(predicates_behaviours)
+        self._tests_behaviours = self._init_tests(self._predicates_behaviours)
+        self._synchronous = any(is_synchronous(predicate)
+                                for predicate, _ in self._predicates_behaviours)
         self._default_behaviour = default_behaviour or _default  # makes testing easier
 
+    @staticmethod
+    def _init_tests(predicates_behaviours):
+        """Compiles the predicates. Runs of consecutive path_matches predicates are merged into a
+        single path dispatch test whose associated behaviour is _dispatched, meaning that the test
+        itself returns the behaviour to invoke (or None)."""
+        tests_behaviours = []
+        run = []
+        for predicate, behaviour in list(predicates_behaviours) + [(None, None)]:
+            if is_path_dispatchable(predicate):
+                run.append((predicate, behaviour))
+                continue
+
+            if len(run) > 1:
+                tests_behaviours.append((compile_path_dispatch(run), _dispatched))
+            else:
+                tests_behaviours.extend((compile_predicate(p), b) for p, b in run)
+            run = []
+
+            if predicate is not None:
+                tests_behaviours.append((compile_predicate(predicate), behaviour))
+
+        return tests_behaviours
+
     def __call__(self, get_response, request):
         """It iterates through the conditions until one is met, and its associated behaviour is
         invoked and its result is returned. If no conditions are met the method returns the result
@@ -328,12 +815,66 @@ class MultiConditionalBehaviour(Behaviour):
         :return: The result of calling the behaviour that matches one of the conditions or the
         result of calling the default behaviour if no conditions are met.
         """
+        return self._choose(get_response, request)(get_response, request)
 
-        for predicate, behaviour in self._predicates_behaviours:
-            if predicate(get_response, request):
-                return behaviour(get_response, request)
-
-        return self._default_behaviour(get_response, request)
+    async def acall(self, get_response, request):
+        """Asynchronous version of __call__. The predicates are evaluated on the event loop, or in
+        a thread if any of them may touch the database (see is_synchronous).
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of awaiting the behaviour that matches one of the conditions or the
+        default behaviour.
+        """
+        if self._synchronous:
+            behaviour = await sync_to_async(self._choose)(get_response, request)
+        else:
+            behaviour = self._choose(get_response, request)
+        return await acall(behaviour, get_response, request)
+
+    def _choose(self, get_response, request):
+        if metrics.enabled:
+            behaviour = self._match_recording(get_response, request)
+            metrics.chose(self, behaviour)
+            return behaviour
+
+        return self._match(get_response, request)
+
+    def _match_recording(self, get_response, request):
+        """Same as _match, but records the result of every predicate evaluated. The predicates of
+        path dispatch tests are matched one by one, so the ones that didn't match are recorded too.
+        """
+        predicates_behaviours = self._predicates_behaviours
+        position = 0
+        for test, behaviour in self._tests_behaviours:
+            if behaviour is _dispatched:  # the run of path_matches predicates at position
+                while (position < len(predicates_behaviours) and
+                       is_path_dispatchable(predicates_behaviours[position][0])):
+                    predicate, behaviour = predicates_behaviours[position]
+                    position += 1
+                    result = predicate(get_response, request)
+                    metrics.predicate_result(predicate, result)
+                    if result:
+                        return behaviour
+            else:
+                predicate = predicates_behaviours[position][0]
+                position += 1
+                result = test(get_response, request)
+                metrics.predicate_result(predicate, result)
+                if result:
+                    return behaviour
+
+        return self._default_behaviour
+
+    def _match(self, get_response, request):
+        for test, behaviour in self._tests_behaviours:
+            if behaviour is _dispatched:
+                behaviour = test(get_response, request)
+                if behaviour is not None:
+                    return behaviour
+            elif test(get_response, request):
+                return behaviour
+
+        return self._default_behaviour
 
     def __str__(self, *args, **kwargs):
         return ('MultiConditionalBehaviour('
@@ -345,7 +886,57 @@ multi_cond = MultiConditionalBehaviour
 case = MultiConditionalBehaviour
 
 
+def to_streaming_response(response, chunk_size, asynchronous=False):
+    """Turns a non-streaming response into a StreamingHttpResponse with the same status, headers
+    and cookies, whose streaming content is made of memoryview slices of the content of response,
+    so the body is not copied.
+    :param response: The non-streaming response
+    :param chunk_size: The size in bytes of the chunks of the streaming content
+    :param asynchronous: Whether the streaming content should be an asynchronous iterator or not
+    :return: A StreamingHttpResponse
+    """
+    content = memoryview(response.content)
+    chunks = (content[start:start + chunk_size] for start in range(0, len(content), chunk_size))
+    if asynchronous:
+        chunks = _aiter(chunks)
+
+    streaming_response = StreamingHttpResponse(chunks, status=response.status_code,
+                                               reason=response.reason_phrase)
+    streaming_response.headers = response.headers
+    streaming_response.cookies = response.cookies
+    # only the resources of response, its close() would send request_finished a second time
+    streaming_response._resource_closers.extend(response._resource_closers)
+    return streaming_response
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
+
+
 class StreamBehaviour(Behaviour):
+    __slots__ = ('_force_streaming_value',)
+    streaming_chunk_size = 4096
+
+    def __init__(self, force_streaming=False):
+        """A Behaviour that wraps the streaming content of the response returned by get_response.
+        Non-streaming responses are left alone unless force_streaming is True, in which case they
+        are turned into streaming responses over memoryview slices of their content (see
+        to_streaming_response), so the behaviour applies to any view.
+        :param force_streaming: Whether to stream non-streaming responses or not
+        """
+        self._force_streaming = force_streaming
+
+    @property
+    def _force_streaming(self):
+        # subclasses whose __init__ doesn't call this one's (like the ones written before
+        # force_streaming) leave the slot unset, and don't stream non-streaming responses
+        return getattr(self, '_force_streaming_value', False)
+
+    @_force_streaming.setter
+    def _force_streaming(self, force_streaming):
+        self._force_streaming_value = force_streaming
+
     def wrap_streaming_content(self, streaming_content):
         """
         A generator that wraps the streaming content of the response returned get_response. Each
@@ -356,6 +947,15 @@ class StreamBehaviour(Behaviour):
         for chunk in streaming_content:
             yield chunk
 
+    async def awrap_streaming_content(self, streaming_content):
+        """
+        An asynchronous generator that wraps the streaming content of asynchronous streaming
+        responses (the ones whose is_async attribute is True). Each chunk of the content is yielded.
+        :param streaming_content: The asynchronous streaming content of the response
+        """
+        async for chunk in streaming_content:
+            yield chunk
+
     def __call__(self, get_response, request):
         """If the response returned by get_response (as given by the UncertaintyMiddleware
         middleware is a streaming response, the streaming content is wrapped by the
@@ -365,53 +965,272 @@ class StreamBehaviour(Behaviour):
         :return: The result of calling get_response with the request parameter
         """
         response = get_response(request)
+        if self._force_streaming and not response.streaming:
+            response = to_streaming_response(response, self.streaming_chunk_size)
+
+        return self._wrap_response(response, request)
+
+    async def acall(self, get_response, request):
+        """Asynchronous version of __call__.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of awaiting get_response with the request parameter
+        """
+        response = await get_response(request)
+        if self._force_streaming and not response.streaming:
+            response = to_streaming_response(response, self.streaming_chunk_size,
+                                             asynchronous=True)
 
+        return self._wrap_response(response, request)
+
+    def _wrap_response(self, response, request):
         if response.streaming:
-            response.streaming_content = self.wrap_streaming_content(response.streaming_content)
+            response.streaming_content = self._wrap_streaming_content(response, request)
 
         return response
 
+    def _wrap_streaming_content(self, response, request):
+        if getattr(response, 'is_async', False):
+            return self.awrap_streaming_content(response.streaming_content)
+
+        return self.wrap_streaming_content(response.streaming_content)
+
 
 class SlowdownStreamBehaviour(StreamBehaviour):
-    def __init__(self, seconds):
+    __slots__ = ('_seconds',)
+    _argument_slots = ('_seconds', '_force_streaming')
+
+    def __init__(self, seconds, force_streaming=False):
         """A Behaviour that introduces a delay between each chunk of the streaming content
         returned by get_response.
         :param seconds: The amount of seconds to wait between each chunk of the streaming content
+        or a Distribution (see uncertainty.distributions) to take the amount from
+        :param force_streaming: Whether to stream non-streaming responses or not
         """
+        super().__init__(force_streaming)
         self._seconds = seconds
 
-    def wrap_streaming_content(self, streaming_content):
+    def wrap_streaming_content(self, streaming_content, request=None):
         """Introduces a delay before yielding each chunk of streaming_content.
         :param streaming_content: The streaming_content field of the response.
+        :param request: The request that the distribution of the delay samples for (optional)
         """
         for chunk in streaming_content:
-            sleep(self._seconds)
+            sleep(_seconds(self, self._seconds, request))
+            yield chunk
+
+    async def awrap_streaming_content(self, streaming_content, request=None):
+        """Introduces a non-blocking delay before yielding each chunk of streaming_content.
+        :param streaming_content: The asynchronous streaming_content field of the response.
+        :param request: The request that the distribution of the delay samples for (optional)
+        """
+        async for chunk in streaming_content:
+            await async_sleep(_seconds(self, self._seconds, request))
             yield chunk
 
+    def _wrap_streaming_content(self, response, request):
+        if getattr(response, 'is_async', False):
+            return self.awrap_streaming_content(response.streaming_content, request)
+
+        return self.wrap_streaming_content(response.streaming_content, request)
+
     def __str__(self):
         return ('SlowdownStreamBehaviour('
                 'seconds={seconds})').format(seconds=self._seconds)
 slowdown = SlowdownStreamBehaviour
 
 
+class ThrottleStreamBehaviour(StreamBehaviour):
+    __slots__ = ('_bytes_per_second', '_burst', '_min_sleep')
+
+    def __init__(self, bytes_per_second, burst=None, min_sleep=0.01, force_streaming=False):
+        """A Behaviour that limits the bandwidth of the streaming content returned by get_response
+        using a token bucket, regardless of the size of the chunks. The bucket starts full, and
+        chunks are held only when the bucket runs out of tokens. Sleeps shorter than min_sleep are
+        accumulated, so a stream of tiny chunks doesn't cause a timer call per chunk.
+        :param bytes_per_second: The target bandwidth in bytes per second
+        :param burst: The capacity of the bucket in bytes, the amount of bytes that can be sent at
+        once without waiting. Defaults to min_sleep seconds worth of bytes.
+        :param min_sleep: The minimum amount of seconds of each sleep
+        :param force_streaming: Whether to stream non-streaming responses or not
+        """
+        super().__init__(force_streaming)
+        self._bytes_per_second = bytes_per_second
+        self._burst = burst if burst is not None else bytes_per_second * min_sleep
+        self._min_sleep = min_sleep
+
+    def _wait_times(self):
+        """A generator that receives the size of each chunk and yields the amount of seconds to
+        wait before sending it (0 if it can be sent right away)."""
+        rate = self._bytes_per_second
+        burst = self._burst
+        min_debt = rate * self._min_sleep
+        tokens = burst
+        last = monotonic()
+        size = yield
+        while True:
+            now = monotonic()
+            tokens = min(burst, tokens + (now - last) * rate) - size
+            last = now
+            size = yield (-tokens / rate if tokens < 0 and -tokens >= min_debt else 0)
+
+    def wrap_streaming_content(self, streaming_content):
+        """Holds each chunk of streaming_content for as long as needed to keep the bandwidth.
+        :param streaming_content: The streaming_content field of the response.
+        """
+        wait_times = self._wait_times()
+        next(wait_times)
+        for chunk in streaming_content:
+            seconds = wait_times.send(len(chunk))
+            if seconds:
+                if metrics.enabled:
+                    metrics.delay(self, seconds)
+                sleep(seconds)
+            yield chunk
+
+    async def awrap_streaming_content(self, streaming_content):
+        """Holds each chunk of streaming_content for as long as needed to keep the bandwidth,
+        without blocking.
+        :param streaming_content: The asynchronous streaming_content field of the response.
+        """
+        wait_times = self._wait_times()
+        next(wait_times)
+        async for chunk in streaming_content:
+            seconds = wait_times.send(len(chunk))
+            if seconds:
+                if metrics.enabled:
+                    metrics.delay(self, seconds)
+                await async_sleep(seconds)
+            yield chunk
+
+    def __str__(self):
+        return ('ThrottleStreamBehaviour('
+                'bytes_per_second={bytes_per_second}, '
+                'burst={burst})').format(bytes_per_second=self._bytes_per_second,
+                                         burst=self._burst)
+throttle = ThrottleStreamBehaviour
+
+
+class RechunkStreamBehaviour(StreamBehaviour):
+    __slots__ = ('_chunk_size', '_coalesce')
+    _argument_slots = ('_chunk_size', '_coalesce', '_force_streaming')
+
+    def __init__(self, chunk_size, coalesce=True, force_streaming=False):
+        """A Behaviour that re-segments the streaming content returned by get_response into chunks
+        of chunk_size bytes, e.g. 1460 bytes to emulate TCP segments. Large chunks are split into
+        memoryview slices, so they're never copied. If coalesce is True, small chunks are joined
+        until they fill a chunk (the last chunk of the stream may be smaller).
+        :param chunk_size: The size in bytes of the chunks
+        :param coalesce: Whether to join chunks smaller than chunk_size or not
+        :param force_streaming: Whether to stream non-streaming responses or not
+        """
+        super().__init__(force_streaming)
+        self._chunk_size = chunk_size
+        self._coalesce = coalesce
+
+    def _segmenter(self):
+        """A generator that receives the chunks of the streaming content and yields the list of
+        chunks of chunk_size bytes ready to be sent. Sending None flushes the pending bytes."""
+        size = self._chunk_size
+        coalesce = self._coalesce
+        pending = bytearray()
+        chunk = yield
+        while chunk is not None:
+            segments = []
+            view = memoryview(chunk)
+            if pending:
+                taken = size - len(pending)
+                pending += view[:taken]
+                view = view[taken:]
+                if len(pending) == size:
+                    segments.append(memoryview(pending))
+                    pending = bytearray()
+
+            end = len(view) - len(view) % size
+            for start in range(0, end, size):
+                segments.append(view[start:start + size])
+
+            if end < len(view):
+                if coalesce:
+                    pending += view[end:]
+                else:
+                    segments.append(view[end:])
+
+            chunk = yield segments
+
+        yield [memoryview(pending)] if pending else []
+
+    def wrap_streaming_content(self, streaming_content):
+        """Yields the chunks of streaming_content re-segmented into chunks of chunk_size bytes.
+        :param streaming_content: The streaming_content field of the response.
+        """
+        segmenter = self._segmenter()
+        next(segmenter)
+        for chunk in streaming_content:
+            yield from segmenter.send(chunk)
+        yield from segmenter.send(None)
+
+    async def awrap_streaming_content(self, streaming_content):
+        """Yields the chunks of the asynchronous streaming_content re-segmented into chunks of
+        chunk_size bytes.
+        :param streaming_content: The asynchronous streaming_content field of the response.
+        """
+        segmenter = self._segmenter()
+        next(segmenter)
+        async for chunk in streaming_content:
+            for segment in segmenter.send(chunk):
+                yield segment
+        for segment in segmenter.send(None):
+            yield segment
+
+    def __str__(self):
+        return ('RechunkStreamBehaviour('
+                'chunk_size={chunk_size}, '
+                'coalesce={coalesce})').format(chunk_size=self._chunk_size,
+                                               coalesce=self._coalesce)
+rechunk = RechunkStreamBehaviour
+
+
 class RandomStopStreamBehaviour(StreamBehaviour):
-    def __init__(self, probability, stop_gracefully=True):
+    __slots__ = ('_probability',)
+
+    def __init__(self, probability, stop_gracefully=True, force_streaming=False):
         """A Behaviour that stops the streaming with a certain probability.
         :param probability: The probability of stopping the stream
+        :param force_streaming: Whether to stream non-streaming responses or not
         """
+        super().__init__(force_streaming)
         self._probability = probability
 
-    def wrap_streaming_content(self, streaming_content):
+    def wrap_streaming_content(self, streaming_content, request=None):
         """Stops the iterator with with a certain probability.
         :param streaming_content: The streaming_content field of the response.
+        :param request: The request whose random number generator is used (optional)
         """
         for chunk in streaming_content:
-            if random() < self._probability:
-                raise StopIteration()
+            if random(request) < self._probability:
+                return
+
+            yield chunk
+
+    async def awrap_streaming_content(self, streaming_content, request=None):
+        """Stops the asynchronous iterator with with a certain probability.
+        :param streaming_content: The asynchronous streaming_content field of the response.
+        :param request: The request whose random number generator is used (optional)
+        """
+        async for chunk in streaming_content:
+            if random(request) < self._probability:
+                return
 
             yield chunk
 
+    def _wrap_streaming_content(self, response, request):
+        if getattr(response, 'is_async', False):
+            return self.awrap_streaming_content(response.streaming_content, request)
+
+        return self.wrap_streaming_content(response.streaming_content, request)
+
     def __str__(self):
         return ('RandomStopStreamBehaviour('
-                'probability={probability},').format(probabilty=self._probability)
+                'probability={probability})').format(probability=self._probability)
 random_stop = RandomStopStreamBehaviour
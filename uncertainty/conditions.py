@@ -1,11 +1,31 @@
 import re
+from urllib.parse import unquote_plus
 
+from .nodes import Node, _is_hashable
 
-class Predicate:
+
+class Predicate(Node):
     """Represents a condition that a Django request must meet. It is used in conjunction with
     ConditionalBehaviour to control if behaviours are invoked depending on the result of the
     Predicate invocation. Multiple predicates can be combined with or and and.
+
+    Predicates whose pure attribute is True only depend on the request, so compiled predicates (see
+    compile_predicate) cache their results on the request: a pure predicate that appears in several
+    branches of a specification is only evaluated once per request. Predicates that are cheaper
+    than a cache lookup (like is_get or path_matches) are not marked as pure.
+
+    Predicates whose synchronous attribute is True may query the database (e.g. through the lazy
+    request.user), which can't be done from the event loop, so ConditionalBehaviour and
+    MultiConditionalBehaviour evaluate them in a thread when running asynchronously (see
+    is_synchronous).
+
+    Like behaviours, predicates are immutable and compared by their constructor arguments (see
+    uncertainty.nodes.Node).
     """
+    __slots__ = ()
+    pure = False
+    synchronous = False
+
     def __call__(self, get_response, request):
         """Returns True for all calls.
         :param get_response: The get_response method provided by the Django stack
@@ -39,6 +59,9 @@ class Predicate:
 
 
 class NotPredicate(Predicate):
+    __slots__ = ('_predicate',)
+    _argument_slots = __slots__
+
     def __init__(self, predicate):
         """The negation of a predicate.
         :param predicate: The predicate to negate
@@ -59,6 +82,9 @@ class NotPredicate(Predicate):
 
 
 class OrPredicate(Predicate):
+    __slots__ = ('_left', '_right')
+    _argument_slots = __slots__
+
     def __init__(self, left, right):
         """The disjunction of two predicates.
         :param left: The left predicate
@@ -82,6 +108,9 @@ class OrPredicate(Predicate):
 
 
 class AndPredicate(Predicate):
+    __slots__ = ('_left', '_right')
+    _argument_slots = __slots__
+
     def __init__(self, left, right):
         """The conjunction of two predicates.
         :param left: The left predicate
@@ -104,7 +133,193 @@ class AndPredicate(Predicate):
                 'right={right})').format(left=self._left, right=self._right)
 
 
+_CONSTANT, _LEAF, _NOT, _OR, _AND = 'constant', 'leaf', 'not', 'or', 'and'
+
+
+def compile_predicate(predicate):
+    """Compiles a predicate into a single function with the same signature. Chains of OrPredicate
+    and AndPredicate are flattened into n-ary disjunctions and conjunctions, double negations are
+    removed, and the result is turned into one short-circuiting boolean expression, so evaluating
+    it doesn't need a nested __call__ for each node of the tree. Anything that isn't a Predicate is
+    returned unchanged.
+    :param predicate: The predicate to compile
+    :return: A function that takes get_response and request and returns the predicate value
+    """
+    if not isinstance(predicate, Predicate):
+        return predicate
+
+    node = _normalize(predicate)
+    if node[0] == _LEAF:
+        return _leaf_function(node[1])
+
+    leaves = {}
+    expression = _to_expression(node, leaves)
+    namespace = {name: _leaf_function(leaf) for leaf, name in leaves.values()}
+    try:
+        return eval('lambda get_response, request: ' + expression, namespace)
+    except (SyntaxError, RecursionError, MemoryError):  # too deeply nested for the compiler
+        return _to_function(node)
+
+
+def constant_value(predicate):
+    """Returns the value of a predicate that doesn't depend on the request, like Predicate() or
+    -Predicate() & is_get (it's True or False whatever the request), or None if it depends on it.
+    :param predicate: The predicate
+    :return: True, False or None
+    """
+    if not isinstance(predicate, Predicate):
+        return None
+
+    node = _normalize(predicate)
+    return node[1] if node[0] == _CONSTANT else None
+
+
+def is_synchronous(predicate):
+    """Tells if evaluating a predicate may touch the database (e.g. is_authenticated or user_is,
+    through the lazy request.user), so it has to be run in a thread when the Django stack runs
+    asynchronously. Callables that aren't Predicate objects could do anything, so they are.
+    :param predicate: The predicate to check
+    :return: True if any of the predicates it's made of is synchronous, False otherwise
+    """
+    pending = [predicate]
+    while pending:  # not recursive, as chains of predicates can be very long
+        predicate = pending.pop()
+        if not isinstance(predicate, Predicate):
+            return True
+        if isinstance(predicate, NotPredicate):
+            pending.append(predicate._predicate)
+        elif isinstance(predicate, (OrPredicate, AndPredicate)):
+            pending.extend((predicate._left, predicate._right))
+        elif predicate.synchronous:
+            return True
+
+    return False
+
+
+def _normalize(predicate):
+    """Turns a predicate tree into nested (kind, operand) tuples, flattening chains of the same
+    associative operator, removing double negations and folding constant (base Predicate) terms.
+    """
+    negated = False
+    while type(predicate) is NotPredicate:
+        predicate = predicate._predicate
+        negated = not negated
+
+    if type(predicate) in (OrPredicate, AndPredicate):
+        operator = type(predicate)
+        kind = _OR if operator is OrPredicate else _AND
+        children = []
+        stack = [predicate]
+        while stack:
+            current = stack.pop()
+            if type(current) is operator:
+                stack.append(current._right)
+                stack.append(current._left)
+            else:
+                child = _normalize(current)
+                if child[0] == kind:
+                    children.extend(child[1])
+                else:
+                    children.append(child)
+        node = _fold(kind, children)
+    elif type(predicate) is Predicate:
+        node = (_CONSTANT, True)
+    else:
+        node = (_LEAF, predicate)
+
+    if negated:
+        if node[0] == _CONSTANT:
+            return (_CONSTANT, not node[1])
+        return (_NOT, node)
+
+    return node
+
+
+def _fold(kind, children):
+    absorbing = kind == _OR  # True absorbs a disjunction, False absorbs a conjunction
+    operands = []
+    for child in children:
+        if child[0] == _CONSTANT:
+            if child[1] == absorbing:
+                return child
+        else:
+            operands.append(child)
+
+    if not operands:
+        return (_CONSTANT, not absorbing)
+    if len(operands) == 1:
+        return operands[0]
+    return (kind, operands)
+
+
+def _to_expression(node, leaves):
+    kind = node[0]
+    if kind == _CONSTANT:
+        return repr(bool(node[1]))
+    if kind == _LEAF:
+        leaf = node[1]
+        if id(leaf) not in leaves:
+            leaves[id(leaf)] = (leaf, 'p{index}'.format(index=len(leaves)))
+        return '{name}(get_response, request)'.format(name=leaves[id(leaf)][1])
+    if kind == _NOT:
+        return '(not {operand})'.format(operand=_to_expression(node[1], leaves))
+    return '({operands})'.format(operands=' {kind} '.format(kind=kind).join(
+        _to_expression(child, leaves) for child in node[1]))
+
+
+def _to_function(node):
+    kind = node[0]
+    if kind == _CONSTANT:
+        value = node[1]
+        return lambda get_response, request: value
+    if kind == _LEAF:
+        return _leaf_function(node[1])
+    if kind == _NOT:
+        function = _to_function(node[1])
+        return lambda get_response, request: not function(get_response, request)
+
+    functions = tuple(_to_function(child) for child in node[1])
+    if kind == _OR:
+        return lambda get_response, request: any(f(get_response, request) for f in functions)
+    return lambda get_response, request: all(f(get_response, request) for f in functions)
+
+
+def _leaf_function(predicate):
+    """Returns the function that evaluates a leaf of a compiled predicate, which caches the result
+    on the request if the predicate is pure."""
+    if getattr(predicate, 'pure', False) is not True:
+        return predicate
+
+    key = _cache_key(predicate)
+
+    def memoized(get_response, request):
+        request_dict = request.__dict__
+        try:
+            results = request_dict['_uncertainty_predicates']
+        except KeyError:
+            results = request_dict['_uncertainty_predicates'] = {}
+
+        try:
+            return results[key]
+        except KeyError:
+            result = results[key] = predicate(get_response, request)
+            return result
+
+    return memoized
+
+
+def _cache_key(predicate):
+    """Returns the key of the results of a pure predicate on the request. Predicates of the same
+    type and constructor arguments share the key, so e.g. the is_authenticated() instances of
+    several branches share the result."""
+    structure = predicate._structure() if issubclass(type(predicate), Node) else None
+    return structure if structure is not None and _is_hashable(structure) else predicate
+
+
 class IsMethodPredicate(Predicate):
+    __slots__ = ('_method',)
+    _argument_slots = __slots__
+
     def __init__(self, method):
         """Checks if the request method is the same as the one provided.
         :param method: The HTTP method (GET, POST, etc.) that request.method ought to be equal to
@@ -130,6 +345,10 @@ is_put = IsMethodPredicate('PUT')
 
 
 class HasRequestParameterPredicate(Predicate):
+    __slots__ = ('_parameter',)
+    _argument_slots = __slots__
+    pure = True
+
     def __init__(self, parameter):
         """Checks if the request contains a parameter.
         :param parameter: The name of the parameters
@@ -151,7 +370,94 @@ has_parameter = HasRequestParameterPredicate
 has_param = HasRequestParameterPredicate
 
 
+def _has_field(encoded, parameter):
+    """Returns True if the URL encoded string (a query string or a form body) has a field named
+    parameter, without decoding the values or building a QueryDict."""
+    if parameter not in encoded and '%' not in encoded and '+' not in encoded:
+        return False
+
+    for field in encoded.split('&'):
+        name = field.partition('=')[0]
+        if name == parameter or (('%' in name or '+' in name) and unquote_plus(name) == parameter):
+            return True
+
+    return False
+
+
+class HasQueryParameterPredicate(Predicate):
+    __slots__ = ('_parameter',)
+    _argument_slots = __slots__
+
+    def __init__(self, parameter):
+        """Checks if the query string of the request contains a parameter. Unlike
+        HasRequestParameterPredicate, it never reads the request body.
+        :param parameter: The name of the parameter
+        """
+        self._parameter = parameter
+
+    def __call__(self, get_response, request):
+        """Returns True if the query string has the parameter. The raw QUERY_STRING is scanned, so
+        no QueryDict is built.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: True if the query string has the parameter, False otherwise
+        """
+        return _has_field(request.META.get('QUERY_STRING', ''), self._parameter)
+
+    def __str__(self):
+        return ('HasQueryParameterPredicate('
+                'parameter={parameter})').format(parameter=self._parameter)
+has_query_parameter = HasQueryParameterPredicate
+has_query_param = HasQueryParameterPredicate
+
+
+class HasBodyParameterPredicate(Predicate):
+    __slots__ = ('_parameter', '_max_size')
+    _argument_slots = __slots__
+    pure = True
+
+    def __init__(self, parameter, max_size=64 * 1024):
+        """Checks if the form body of the request contains a parameter. Only URL encoded bodies
+        whose Content-Length is at most max_size bytes are read, streaming uploads (multipart or
+        without a Content-Length) are never touched.
+        :param parameter: The name of the parameter
+        :param max_size: The maximum size in bytes of the bodies that are read
+        """
+        self._parameter = parameter
+        self._max_size = max_size
+
+    def __call__(self, get_response, request):
+        """Returns True if the request has a URL encoded body of at most max_size bytes with the
+        parameter. The body is kept by the request, so the view can still read it.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: True if the body has the parameter, False otherwise
+        """
+        if request.content_type != 'application/x-www-form-urlencoded':
+            return False
+
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH'))
+        except (TypeError, ValueError):
+            return False
+
+        if content_length > self._max_size:
+            return False
+
+        return _has_field(request.body.decode('latin-1'), self._parameter)
+
+    def __str__(self):
+        return ('HasBodyParameterPredicate('
+                'parameter={parameter}, '
+                'max_size={max_size})').format(parameter=self._parameter,
+                                               max_size=self._max_size)
+has_body_parameter = HasBodyParameterPredicate
+has_body_param = HasBodyParameterPredicate
+
+
 class PathMatchesRegexpPredicate(Predicate):
+    __slots__ = ('_regexp',)
+
     def __init__(self, regexp):
         """Checks if the request path matches the given regexp
         :param regexp: The regexp that the request path should match
@@ -172,7 +478,52 @@ path_matches = PathMatchesRegexpPredicate
 path_is = path_matches
 
 
+_DEFAULT_FLAGS = re.compile('').flags
+_GLOBAL_FLAGS = re.compile(r'\(\?[aiLmsux]+\)')
+
+
+def is_path_dispatchable(predicate):
+    """Tells if a predicate can be merged with others by compile_path_dispatch. Only plain
+    PathMatchesRegexpPredicate objects whose regexps have no groups and no global flags are, as
+    those would change meaning when combined with other regexps. Inline global flags, like (?u),
+    are left out even if they don't change the flags, as they can't be joined with other regexps.
+    :param predicate: The predicate to check
+    :return: True if the predicate can be merged, False otherwise
+    """
+    return (type(predicate) is PathMatchesRegexpPredicate and
+            predicate._regexp.groups == 0 and
+            predicate._regexp.flags == _DEFAULT_FLAGS and
+            not _GLOBAL_FLAGS.search(predicate._regexp.pattern))
+
+
+def compile_path_dispatch(predicates_values):
+    """Combines several path_matches predicates into a single alternation regexp, so the first
+    predicate that matches the request path is found with a single regexp match instead of one per
+    predicate.
+    :param predicates_values: A list of (predicate, value) tuples. All the predicates must pass
+    is_path_dispatchable.
+    :return: A function that takes get_response and request and returns the value associated with
+    the first predicate that matches the request path, or None if none of them match.
+    """
+    values = [value for _, value in predicates_values]
+    regexp = re.compile('|'.join('({pattern})'.format(pattern=predicate._regexp.pattern)
+                                 for predicate, _ in predicates_values))
+    match = regexp.match
+
+    def dispatch(get_response, request):
+        matched = match(request.path)
+        if matched is None:
+            return None
+        return values[matched.lastindex - 1]
+
+    return dispatch
+
+
 class IsAuthenticatedPredicate(Predicate):
+    __slots__ = ()
+    pure = True
+    synchronous = True
+
     def __call__(self, get_response, request):
         """Returns True if the request is authenticated
         :param get_response: The get_response method provided by the Django stack
@@ -187,6 +538,11 @@ is_authenticated = IsAuthenticatedPredicate
 
 
 class IsUserPredicate(Predicate):
+    __slots__ = ('_username',)
+    _argument_slots = __slots__
+    pure = True
+    synchronous = True
+
     def __init__(self, username):
         """Checks if the request user username matches the given username
         :param username: The username that the request user should have
@@ -204,3 +560,112 @@ class IsUserPredicate(Predicate):
     def __str__(self):
         return 'IsUser(username={username})'.format(username=self._username)
 user_is = IsUserPredicate
+
+
+def _meta_key(header):
+    """Returns the key of request.META that holds an HTTP header, the same way Django does it (see
+    django.http.request.HttpHeaders)."""
+    key = header.upper().replace('-', '_')
+    if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        return key
+    return 'HTTP_' + key
+
+
+class MetaIsPredicate(Predicate):
+    __slots__ = ('_key', '_value')
+    _argument_slots = __slots__
+
+    def __init__(self, key, value):
+        """Checks if a key of request.META (e.g. REMOTE_ADDR or SERVER_NAME) has the given value
+        :param key: The key of request.META
+        :param value: The value that the key should have
+        """
+        self._key = key
+        self._value = value
+
+    def __call__(self, get_response, request):
+        """Returns True if the key of request.META has the value.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: True if the key of request.META has the value, False otherwise
+        """
+        return request.META.get(self._key) == self._value
+
+    def __str__(self):
+        return 'MetaIsPredicate(key={key}, value={value})'.format(key=self._key, value=self._value)
+meta_is = MetaIsPredicate
+
+
+class HeaderIsPredicate(MetaIsPredicate):
+    __slots__ = ('_header',)
+
+    def __init__(self, header, value):
+        """Checks if an HTTP header of the request has the given value. The header name is turned
+        into its request.META key once, so request.headers is not built on every request.
+        :param header: The name of the header (e.g. X-Client-Version), case insensitive
+        :param value: The value that the header should have
+        """
+        super().__init__(_meta_key(header), value)
+        self._header = header
+
+    def __str__(self):
+        return 'HeaderIsPredicate(header={header}, value={value})'.format(header=self._header,
+                                                                          value=self._value)
+header_is = HeaderIsPredicate
+
+
+class HeaderMatchesPredicate(Predicate):
+    __slots__ = ('_header', '_key', '_regexp')
+
+    def __init__(self, header, regexp):
+        """Checks if the value of an HTTP header of the request matches the given regexp. The
+        header name is turned into its request.META key once, so request.headers is not built on
+        every request.
+        :param header: The name of the header (e.g. User-Agent), case insensitive
+        :param regexp: The regexp that the value of the header should match
+        """
+        self._header = header
+        self._key = _meta_key(header)
+        self._regexp = re.compile(regexp)
+
+    def __call__(self, get_response, request):
+        """Returns True if the request has the header and its value matches the regexp.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: True if the value of the header matches the regexp, False otherwise
+        """
+        value = request.META.get(self._key)
+        return value is not None and bool(self._regexp.match(value))
+
+    def __str__(self):
+        return 'HeaderMatchesPredicate(header={header}, regexp={regexp})'.format(
+            header=self._header, regexp=self._regexp)
+header_matches = HeaderMatchesPredicate
+
+
+class HasCookiePredicate(Predicate):
+    __slots__ = ('_name', '_value')
+    _argument_slots = __slots__
+
+    def __init__(self, name, value=None):
+        """Checks if the request has a cookie, optionally with the given value
+        :param name: The name of the cookie
+        :param value: The value that the cookie should have (optional)
+        """
+        self._name = name
+        self._value = value
+
+    def __call__(self, get_response, request):
+        """Returns True if the request has the cookie (with the value, if it was given).
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: True if the request has the cookie, False otherwise
+        """
+        if self._value is None:
+            return self._name in request.COOKIES
+        return request.COOKIES.get(self._name) == self._value
+
+    def __str__(self):
+        return 'HasCookiePredicate(name={name}, value={value})'.format(name=self._name,
+                                                                       value=self._value)
+has_cookie = HasCookiePredicate
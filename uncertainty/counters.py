@@ -0,0 +1,178 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import weakref
+from time import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import fcntl
+except ImportError:  # Windows, slots are picked by process id instead of being locked
+    fcntl = None
+
+# Each slot holds the window it counts and the count, and is only written by its owner process
+_SLOT = struct.Struct('<qq')
+
+_files_lock = threading.Lock()
+_files = weakref.WeakValueDictionary()  # (process id, real path) -> _CounterFile
+_inherited = []  # the maps and descriptors of the parent process, see _close
+
+
+def _close(mapping, fd, pid):
+    if os.getpid() != pid:
+        # Inherited through a fork. Closing any descriptor of the file (mmap keeps a duplicate)
+        # would release the locks this process holds on it, so they are kept open
+        _inherited.append((mapping, fd))
+        return
+
+    mapping.close()
+    os.close(fd)  # releases the lock of the slot
+
+
+class _CounterFile:
+    def __init__(self, path, name, slots):
+        """The memory map of a counter file and the slot claimed by this process, shared by all the
+        counters of the file in the process, as fcntl locks belong to the process (and closing a
+        descriptor of the file releases all of them). The file is unmapped, and the slot released,
+        when no counter uses it anymore.
+        :param path: The path of the file
+        :param name: The name of the counter, used in error messages
+        :param slots: The amount of slots of the file
+        """
+        self.slots = slots
+        size = _SLOT.size * slots
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        except Exception:
+            os.close(fd)
+            raise
+
+        pid = os.getpid()
+        weakref.finalize(self, _close, self.mmap, fd, pid)
+        self.offset = self._claim_slot(fd, pid, name) * _SLOT.size
+
+    def _claim_slot(self, fd, pid, name):
+        if fcntl is None:
+            return pid % self.slots
+
+        for index in range(self.slots):
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, _SLOT.size, index * _SLOT.size)
+            except OSError:
+                continue
+            return index
+
+        raise ImproperlyConfigured(
+            'All the {slots} slots of the {name} counter are taken, increase slots'.format(
+                slots=self.slots, name=name))
+
+    @classmethod
+    def get(cls, path, name, slots):
+        """Returns the counter file of this process for path, opening it if it isn't yet."""
+        key = (os.getpid(), os.path.realpath(path))
+        with _files_lock:
+            counter_file = _files.get(key)
+            if counter_file is None:
+                counter_file = _files[key] = cls(path, name, slots)
+            elif counter_file.slots != slots:
+                raise ImproperlyConfigured(
+                    'The counters of {path} must have the same amount of slots'.format(path=path))
+            return counter_file
+
+
+class SharedCounter:
+    def __init__(self, name, window=None, slots=64, path=None):
+        """A counter shared by all the processes of a host (e.g. the workers of gunicorn) through a
+        memory mapped file. Each process claims a slot of the file (locking it with fcntl, so the
+        slot of a dead worker can be reused by a new one) and only updates its own slot, so updates
+        never contend across processes. The counters of the same file in a process share the map
+        and the slot, which is released when none of them is used anymore. The value is the sum of
+        the slots. If window is given, the counter only counts the current window of that many
+        seconds, and it starts from 0 on each new window.
+        The file is mapped on first use, and again after a fork, as the slot locks are not
+        inherited by child processes.
+        :param name: The name of the counter, which names the file if path is not given
+        :param window: The length in seconds of the counting windows (optional)
+        :param slots: The maximum amount of processes that can update the counter
+        :param path: The path of the file (optional). Defaults to a file in the temporary directory.
+        """
+        self._name = name
+        self._window = window
+        self._slots = slots
+        self._path = path or os.path.join(tempfile.gettempdir(),
+                                          'django-uncertainty-{name}.counter'.format(name=name))
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._mmap = None
+        self._offset = None
+
+    def _current_window(self):
+        return int(time() // self._window) if self._window else 0
+
+    def _open(self):
+        """Gets the counter file of this process if it hasn't yet. Called with the lock held."""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        self._file = _CounterFile.get(self._path, self._name, self._slots)
+        self._mmap = self._file.mmap
+        self._offset = self._file.offset
+        self._pid = pid
+
+    def add(self, amount=1):
+        """Adds amount to the slot of this process.
+        :param amount: The amount to add
+        """
+        window = self._current_window()
+        with self._lock:
+            self._open()
+            self._add(window, amount)
+
+    def add_if_below(self, limit, amount=1):
+        """Adds amount to the slot of this process only if the value of the counter is below limit.
+        The check is atomic within the process, but processes updating the counter at the same time
+        may exceed the limit by (at most) one amount each.
+        :param limit: The value the counter shouldn't reach
+        :param amount: The amount to add
+        :return: True if the amount was added, False otherwise
+        """
+        window = self._current_window()
+        with self._lock:
+            self._open()
+            if self._value(window) >= limit:
+                return False
+            self._add(window, amount)
+            return True
+
+    def value(self):
+        """Returns the value of the counter, the sum of the slots of all the processes.
+        :return: The value of the counter in the current window
+        """
+        window = self._current_window()
+        with self._lock:
+            self._open()
+            return self._value(window)
+
+    def _add(self, window, amount):
+        slot_window, count = _SLOT.unpack_from(self._mmap, self._offset)
+        if slot_window != window:
+            count = 0
+        _SLOT.pack_into(self._mmap, self._offset, window, count + amount)
+
+    def _value(self, window):
+        return sum(count for slot_window, count in _SLOT.iter_unpack(self._mmap)
+                   if slot_window == window)
+
+    def __str__(self):
+        return ('SharedCounter('
+                'name={name}, '
+                'window={window}, '
+                'path={path})').format(name=self._name, window=self._window, path=self._path)
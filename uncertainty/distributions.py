@@ -0,0 +1,435 @@
+import csv
+import json
+import mmap
+import os
+import re
+import threading
+from bisect import bisect_left
+from collections import deque
+from functools import partial
+from random import Random
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, samples are generated with the random module instead
+    numpy = None
+
+from .rng import get_random
+
+
+class Distribution:
+    def __new__(cls, *args, **kwargs):
+        """Keeps the arguments of the constructor, so the distribution is pickled as the
+        constructor call that built it (see __reduce__)."""
+        self = super().__new__(cls)
+        self._init_args = (args, kwargs)
+        return self
+
+    def __reduce__(self):
+        args, kwargs = self._init_args
+        return partial(type(self), *args, **kwargs), ()
+
+    def __init__(self, batch_size=1024, seed=None):
+        """Base of all the delay distributions. Samples are generated in batches (vectorized with
+        NumPy if it's installed) and kept in a buffer, which is refilled by a background thread when
+        it runs low, so taking a sample on the request path is just popping a number from the
+        buffer. Subclasses implement _generate_numpy and _generate_python.
+        :param batch_size: The amount of samples generated at once
+        :param seed: The seed of the generator. If it's not given, it is taken from the random
+        generator of the thread that takes the first sample (see uncertainty.rng).
+        """
+        self._batch_size = batch_size
+        self._seed = seed
+        self._generator = None
+        self._buffer = deque()
+        self._refilling = threading.Lock()
+
+    def sample(self, request=None):
+        """Returns a sample of the distribution.
+        :param request: The request that triggered the middleware (ignored)
+        :return: A sample of the distribution
+        """
+        buffer = self._buffer
+        while True:
+            try:
+                value = buffer.popleft()
+                break
+            except IndexError:  # the first sample, or the background refill fell behind
+                with self._refilling:
+                    if not buffer:
+                        buffer.extend(self._generate(self._batch_size))
+
+        if len(buffer) < self._batch_size // 2 and self._refilling.acquire(blocking=False):
+            threading.Thread(target=self._refill, daemon=True).start()
+
+        return value
+
+    def _refill(self):
+        try:
+            self._buffer.extend(self._generate(self._batch_size))
+        finally:
+            self._refilling.release()
+
+    def _generate(self, size):
+        """Returns a list with size samples of the distribution."""
+        generator = self._generator
+        if generator is None:
+            seed = self._seed if self._seed is not None else get_random().getrandbits(64)
+            generator = self._generator = (numpy.random.default_rng(seed) if numpy is not None
+                                           else Random(seed))
+
+        if numpy is not None:
+            return self._generate_numpy(generator, size).tolist()
+
+        return self._generate_python(generator, size)
+
+    def _generate_numpy(self, generator, size):
+        """Returns a NumPy array with size samples of the distribution.
+        :param generator: A numpy.random.Generator
+        :param size: The amount of samples
+        """
+        raise NotImplementedError()
+
+    def _generate_python(self, random_, size):
+        """Returns a list with size samples of the distribution.
+        :param random_: A random.Random instance
+        :param size: The amount of samples
+        """
+        raise NotImplementedError()
+
+
+class ExponentialDistribution(Distribution):
+    def __init__(self, mean, **kwargs):
+        """An exponential distribution of delays.
+        :param mean: The mean delay in seconds
+        """
+        super().__init__(**kwargs)
+        self._mean = mean
+
+    def _generate_numpy(self, generator, size):
+        return generator.exponential(self._mean, size)
+
+    def _generate_python(self, random_, size):
+        return [random_.expovariate(1 / self._mean) for _ in range(size)]
+
+    def __str__(self):
+        return 'ExponentialDistribution(mean={mean})'.format(mean=self._mean)
+exponential = ExponentialDistribution
+
+
+class LogNormalDistribution(Distribution):
+    def __init__(self, mu, sigma, **kwargs):
+        """A log-normal distribution of delays.
+        :param mu: The mean of the underlying normal distribution
+        :param sigma: The standard deviation of the underlying normal distribution
+        """
+        super().__init__(**kwargs)
+        self._mu = mu
+        self._sigma = sigma
+
+    def _generate_numpy(self, generator, size):
+        return generator.lognormal(self._mu, self._sigma, size)
+
+    def _generate_python(self, random_, size):
+        return [random_.lognormvariate(self._mu, self._sigma) for _ in range(size)]
+
+    def __str__(self):
+        return ('LogNormalDistribution('
+                'mu={mu}, '
+                'sigma={sigma})').format(mu=self._mu, sigma=self._sigma)
+lognormal = LogNormalDistribution
+
+
+class ParetoDistribution(Distribution):
+    def __init__(self, alpha, minimum, **kwargs):
+        """A Pareto distribution of delays, useful to model long tails.
+        :param alpha: The shape of the distribution. The lower it is, the longer the tail.
+        :param minimum: The minimum delay in seconds
+        """
+        super().__init__(**kwargs)
+        self._alpha = alpha
+        self._minimum = minimum
+
+    def _generate_numpy(self, generator, size):
+        return (generator.pareto(self._alpha, size) + 1) * self._minimum
+
+    def _generate_python(self, random_, size):
+        return [random_.paretovariate(self._alpha) * self._minimum for _ in range(size)]
+
+    def __str__(self):
+        return ('ParetoDistribution('
+                'alpha={alpha}, '
+                'minimum={minimum})').format(alpha=self._alpha, minimum=self._minimum)
+pareto = ParetoDistribution
+
+
+class UniformDistribution(Distribution):
+    def __init__(self, low, high, **kwargs):
+        """A uniform distribution of delays.
+        :param low: The minimum delay in seconds
+        :param high: The maximum delay in seconds
+        """
+        super().__init__(**kwargs)
+        self._low = low
+        self._high = high
+
+    def _generate_numpy(self, generator, size):
+        return generator.uniform(self._low, self._high, size)
+
+    def _generate_python(self, random_, size):
+        return [random_.uniform(self._low, self._high) for _ in range(size)]
+
+    def __str__(self):
+        return ('UniformDistribution('
+                'low={low}, '
+                'high={high})').format(low=self._low, high=self._high)
+uniform = UniformDistribution
+
+
+def jitter(seconds, amount, **kwargs):
+    """A uniform distribution of delays around a given delay (never below 0).
+    :param seconds: The delay in seconds
+    :param amount: The maximum difference with the delay in seconds
+    :return: A UniformDistribution between seconds - amount and seconds + amount
+    """
+    return UniformDistribution(max(seconds - amount, 0), seconds + amount, **kwargs)
+
+
+class CappedDistribution(Distribution):
+    def __init__(self, distribution, maximum, minimum=0, **kwargs):
+        """Limits the samples of another distribution to a range. Distributions that choose their
+        samples for each request (like per_path) are sampled for the request and capped, the rest
+        are capped a batch at a time.
+        :param distribution: The distribution whose samples are capped
+        :param maximum: The maximum delay in seconds
+        :param minimum: The minimum delay in seconds
+        """
+        super().__init__(**kwargs)
+        self._distribution = distribution
+        self._maximum = maximum
+        self._minimum = minimum
+        self._per_request = type(distribution).sample is not Distribution.sample
+
+    def sample(self, request=None):
+        """Returns a sample of the distribution, limited to the range.
+        :param request: The request that triggered the middleware
+        :return: A sample of the distribution
+        """
+        if self._per_request:
+            return min(max(self._distribution.sample(request), self._minimum), self._maximum)
+
+        return super().sample(request)
+
+    def _generate_numpy(self, generator, size):
+        return numpy.clip(self._distribution._generate_numpy(generator, size),
+                          self._minimum, self._maximum)
+
+    def _generate_python(self, random_, size):
+        return [min(max(value, self._minimum), self._maximum)
+                for value in self._distribution._generate_python(random_, size)]
+
+    def __str__(self):
+        return ('CappedDistribution('
+                'distribution={distribution}, '
+                'maximum={maximum}, '
+                'minimum={minimum})').format(distribution=self._distribution,
+                                             maximum=self._maximum, minimum=self._minimum)
+capped = CappedDistribution
+
+
+class EmpiricalDistribution(Distribution):
+    def __init__(self, percentiles=None, buckets=None, path=None, resolution=1000,
+                 mmap_threshold=1024 * 1024, **kwargs):
+        """A distribution that reproduces a recorded latency profile. The profile can be given as a
+        percentile table or as histogram buckets, which are checked right away, or as the path of a
+        file with either of them, which is loaded the first time a sample is taken. An inverse CDF
+        lookup table is built from the profile, so a sample costs a table lookup and a linear
+        interpolation.
+
+        Files can be CSV files with a "percentile,seconds" or a "le,count" header, or JSON files
+        with a "percentiles" or a "buckets" key holding a list of pairs. CSV files larger than
+        mmap_threshold bytes are parsed straight from a memory map.
+        :param percentiles: A sequence of (percentile, seconds) pairs, percentiles between 0 and 100
+        :param buckets: A sequence of (upper bound in seconds, count) pairs where the count is
+        cumulative (the amount of requests that took at most the upper bound), like the le buckets
+        of Prometheus histograms
+        :param path: The path of a CSV or JSON file with the percentiles or buckets
+        :param resolution: The amount of entries of the inverse CDF lookup table
+        :param mmap_threshold: The size in bytes above which CSV files are memory-mapped
+        """
+        super().__init__(**kwargs)
+        if (percentiles is None) + (buckets is None) + (path is None) != 2:
+            raise ValueError('Exactly one of percentiles, buckets or path must be given')
+
+        self._percentiles = percentiles
+        self._buckets = buckets
+        self._path = path
+        self._resolution = resolution
+        self._mmap_threshold = mmap_threshold
+        self._table = None
+        self._loading = threading.Lock()
+        if path is None:  # invalid profiles fail when the specification is built
+            self._table = _inverse_cdf_table(self._load_points(), resolution)
+
+    def _get_table(self):
+        table = self._table
+        if table is None:
+            with self._loading:
+                if self._table is None:
+                    self._table = _inverse_cdf_table(self._load_points(), self._resolution)
+                table = self._table
+
+        return table
+
+    def _load_points(self):
+        """Returns the profile as a sorted list of (cumulative fraction, seconds) points."""
+        if self._path is not None:
+            kind, rows = _load_profile(self._path, self._mmap_threshold)
+        elif self._percentiles is not None:
+            kind, rows = 'percentiles', self._percentiles
+        else:
+            kind, rows = 'buckets', self._buckets
+
+        if kind == 'percentiles':
+            points = sorted((float(percentile) / 100, float(seconds))
+                            for percentile, seconds in rows)
+        else:
+            buckets = sorted((float(le), float(count)) for le, count in rows)
+            if any(count < previous for (_, previous), (_, count) in zip(buckets, buckets[1:])):
+                raise ValueError('The counts of the buckets must be cumulative')
+            total = buckets[-1][1] if buckets else 0
+            if not total:
+                raise ValueError('The latency profile is empty')
+            points = [(0.0, 0.0)]
+            for le, count in buckets:
+                if le != float('inf'):
+                    points.append((count / total, le))
+
+        if not points:
+            raise ValueError('The latency profile is empty')
+        return points
+
+    def _generate_numpy(self, generator, size):
+        table = self._get_table()
+        positions = generator.random(size) * self._resolution
+        return numpy.interp(positions, numpy.arange(len(table)), table)
+
+    def _generate_python(self, random_, size):
+        table = self._get_table()
+        resolution = self._resolution
+        samples = []
+        for _ in range(size):
+            position = random_.random() * resolution
+            index = int(position)
+            samples.append(table[index] + (table[index + 1] - table[index]) * (position - index))
+        return samples
+
+    def __str__(self):
+        return ('EmpiricalDistribution('
+                'path={path}, '
+                'resolution={resolution})').format(path=self._path, resolution=self._resolution)
+empirical = EmpiricalDistribution
+
+
+def _inverse_cdf_table(points, resolution):
+    """Builds a table of resolution + 1 entries where the i-th entry is the delay at the
+    i / resolution quantile, interpolating linearly between the points of the profile."""
+    if points[0][0] > 0:
+        points.insert(0, (0.0, points[0][1]))
+    if points[-1][0] < 1:
+        points.append((1.0, points[-1][1]))
+
+    fractions = [fraction for fraction, _ in points]
+    table = []
+    for i in range(resolution + 1):
+        quantile = i / resolution
+        index = min(max(bisect_left(fractions, quantile), 1), len(points) - 1)
+        (f_0, s_0), (f_1, s_1) = points[index - 1], points[index]
+        if f_1 == f_0:
+            table.append(s_1)
+        else:
+            table.append(s_0 + (s_1 - s_0) * (quantile - f_0) / (f_1 - f_0))
+
+    return table
+
+
+def _load_profile(path, mmap_threshold):
+    """Loads a latency profile file.
+    :return: A ('percentiles' or 'buckets', rows) tuple
+    """
+    if path.endswith('.json'):
+        with open(path) as f:
+            data = json.load(f)
+
+        for kind in ('percentiles', 'buckets'):
+            if kind in data:
+                return kind, data[kind]
+
+        raise ValueError('{path} has neither percentiles nor buckets'.format(path=path))
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > mmap_threshold:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return _parse_csv(iter(mapped.readline, b''), path)
+
+        return _parse_csv(f, path)
+
+
+def _parse_csv(lines, path):
+    rows = csv.reader(line.decode('utf-8') for line in lines)
+    header = [column.strip().lower() for column in next(rows)]
+    if header == ['percentile', 'seconds']:
+        kind = 'percentiles'
+    elif header == ['le', 'count']:
+        kind = 'buckets'
+    else:
+        raise ValueError('{path} must have a "percentile,seconds" or a "le,count" header'.format(
+            path=path))
+
+    return kind, [row for row in rows if row]
+
+
+class PathDistribution(Distribution):
+    def __init__(self, routes, default=None):
+        """Chooses the distribution to sample from the request path, so every route can have its own
+        latency profile. Routes that point to a file path get a lazily loaded
+        EmpiricalDistribution.
+        :param routes: A list of (regexp, distribution or file path) tuples. The first regexp that
+        matches the request path selects the distribution.
+        :param default: The distribution (or file path) to use if no regexp matches. If it's None,
+        the delay is 0.
+        """
+        super().__init__()
+        self._routes = [(re.compile(regexp), self._init_distribution(distribution))
+                        for regexp, distribution in routes]
+        self._default = self._init_distribution(default)
+
+    @staticmethod
+    def _init_distribution(distribution):
+        if isinstance(distribution, str):
+            return EmpiricalDistribution(path=distribution)
+        return distribution
+
+    def sample(self, request=None):
+        """Returns a sample of the distribution of the first route that matches the request path.
+        :param request: The request that triggered the middleware
+        :return: A sample of the distribution
+        """
+        path = request.path
+        for regexp, distribution in self._routes:
+            if regexp.match(path):
+                return distribution.sample(request)
+
+        if self._default is None:
+            return 0
+
+        return self._default.sample(request)
+
+    def __str__(self):
+        return ('PathDistribution('
+                'routes=[{routes}], '
+                'default={default})').format(
+                    routes=', '.join('({r}, {d})'.format(r=r.pattern, d=d)
+                                     for r, d in self._routes),
+                    default=self._default)
+per_path = PathDistribution
@@ -0,0 +1,236 @@
+import hashlib
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from .nodes import Node
+
+# Whether the behaviours record metrics, set from the DJANGO_UNCERTAINTY_METRICS setting by
+# configure. The behaviours check it before calling the functions of this module, so there's no
+# cost on the request path if metrics are disabled.
+enabled = False
+
+DELAY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+_METRICS = (
+    ('uncertainty_invocations_total', 'counter',
+     'Invocations of the behaviours of the specification.'),
+    ('uncertainty_branches_total', 'counter',
+     'Behaviours chosen by the behaviours that choose amongst others.'),
+    ('uncertainty_predicate_results_total', 'counter',
+     'Results of the predicates of the conditional behaviours.'),
+    ('uncertainty_responses_total', 'counter',
+     'Responses injected by the behaviours, by status code.'),
+    ('uncertainty_delay_seconds', 'histogram',
+     'Delays injected by the behaviours.'),
+)
+
+_local = threading.local()
+_all_lock = threading.Lock()
+_all = []
+_labels = {}  # id of the node -> (node, label), see reset_labels
+_MAX_LABELS = 100000
+
+
+def configure():
+    """Enables or disables the metrics according to the DJANGO_UNCERTAINTY_METRICS setting."""
+    global enabled
+
+    enabled = bool(getattr(settings, 'DJANGO_UNCERTAINTY_METRICS', False))
+
+
+def _thread_metrics():
+    """Returns the counters and histograms of the current thread. Each thread only updates its own,
+    so no lock is needed on the request path. The lock is only taken the first time a thread
+    records a metric, to register them for render."""
+    try:
+        return _local.metrics
+    except AttributeError:
+        metrics = _local.metrics = ({}, {})
+        with _all_lock:
+            _all.append(metrics)
+        return metrics
+
+
+def label(node):
+    """Returns the label identifying a behaviour or predicate: the name of its class and a digest of
+    its class and constructor arguments (with the nodes amongst them by their labels), so it's
+    short and the same on every process running the same specification.
+    :param node: The behaviour or predicate
+    :return: The label
+    """
+    try:
+        labeled, value = _labels[id(node)]
+        if labeled is node:
+            return value
+    except KeyError:
+        pass
+
+    if len(_labels) >= _MAX_LABELS:  # a specification is being built over and over
+        _labels.clear()
+    description = _describe(node._arguments()) if issubclass(type(node), Node) else str(node)
+    digest = hashlib.blake2b('{cls}:{description}'.format(
+        cls=type(node).__qualname__, description=description).encode(), digest_size=6)
+    value = '{name}:{digest}'.format(name=type(node).__name__, digest=digest.hexdigest())
+    _labels[id(node)] = (node, value)
+    return value
+
+
+def _describe(value):
+    if issubclass(type(value), Node):
+        return label(value)
+    if type(value) in (list, tuple):
+        return '{type}[{items}]'.format(type=type(value).__name__,
+                                        items=','.join(_describe(item) for item in value))
+    if type(value) is dict:
+        return '{{{items}}}'.format(items=','.join(
+            '{key!r}:{value}'.format(key=key, value=_describe(item))
+            for key, item in sorted(value.items(), key=lambda item: repr(item[0]))))
+    if value is None or isinstance(value, (str, bytes, int, float)):
+        return repr(value)
+    return str(value)  # e.g. distributions and response classes, whose repr has their address
+
+
+def reset_labels(spec=None):
+    """Discards the labels of the nodes, so the nodes of replaced specifications aren't kept alive,
+    and if metrics are enabled, labels the nodes of spec, so that isn't done on the request path.
+    :param spec: The specification in use (optional)
+    """
+    _labels.clear()
+    if enabled and spec is not None:
+        label(spec)
+
+
+def inc(name, labels, amount=1):
+    """Increments a counter.
+    :param name: The name of the counter
+    :param labels: A tuple of (name, value) label pairs
+    :param amount: The amount to increment the counter by
+    """
+    counters = _thread_metrics()[0]
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, labels, value):
+    """Records an observation of a histogram.
+    :param name: The name of the histogram
+    :param labels: A tuple of (name, value) label pairs
+    :param value: The observed value
+    """
+    histograms = _thread_metrics()[1]
+    key = (name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = [[0] * (len(DELAY_BUCKETS) + 1), 0]
+    histogram[0][bisect_left(DELAY_BUCKETS, value)] += 1
+    histogram[1] += value
+
+
+def invoked(node):
+    """Records an invocation of a behaviour."""
+    inc('uncertainty_invocations_total', (('node', label(node)),))
+
+
+def chose(node, behaviour):
+    """Records that a behaviour chose (and invoked) another one."""
+    inc('uncertainty_branches_total', (('node', label(node)), ('branch', label(behaviour))))
+    invoked(behaviour)
+
+
+def predicate_result(predicate, result):
+    """Records the result of a predicate."""
+    inc('uncertainty_predicate_results_total',
+        (('predicate', label(predicate)), ('result', 'true' if result else 'false')))
+
+
+def response(node, status_code):
+    """Records a response injected by a behaviour."""
+    inc('uncertainty_responses_total', (('node', label(node)), ('status', str(status_code))))
+
+
+def delay(node, seconds):
+    """Records a delay injected by a behaviour."""
+    observe('uncertainty_delay_seconds', (('node', label(node)),), seconds)
+
+
+def collect():
+    """Sums the metrics of every thread.
+    :return: A tuple with the counters and the histograms, dictionaries of (name, labels) to values
+    """
+    with _all_lock:
+        all_metrics = list(_all)
+
+    counters = {}
+    histograms = {}
+    for thread_counters, thread_histograms in all_metrics:
+        for key, value in list(thread_counters.items()):
+            counters[key] = counters.get(key, 0) + value
+        for key, (buckets, total) in list(thread_histograms.items()):
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = [[0] * len(buckets), 0]
+            histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+            histogram[1] += total
+
+    return counters, histograms
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    return '{' + ','.join('{name}="{value}"'.format(name=name, value=_escape(value))
+                          for name, value in labels) + '}'
+
+
+def render():
+    """Renders the metrics of every thread in the Prometheus text exposition format.
+    :return: The metrics as text
+    """
+    counters, histograms = collect()
+    lines = []
+    for name, type_, help_ in _METRICS:
+        lines.append('# HELP {name} {help}'.format(name=name, help=help_))
+        lines.append('# TYPE {name} {type}'.format(name=name, type=type_))
+        if type_ == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('{name}{labels} {value}'.format(
+                        name=name, labels=_format_labels(labels), value=value))
+        else:
+            for (metric, labels), (buckets, total) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for le, count in zip(DELAY_BUCKETS + ('+Inf',), buckets):
+                    cumulative += count
+                    lines.append('{name}_bucket{labels} {value}'.format(
+                        name=name, labels=_format_labels(labels + (('le', str(le)),)),
+                        value=cumulative))
+                lines.append('{name}_sum{labels} {value}'.format(
+                    name=name, labels=_format_labels(labels), value=total))
+                lines.append('{name}_count{labels} {value}'.format(
+                    name=name, labels=_format_labels(labels), value=cumulative))
+
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Discards the metrics of every thread."""
+    with _all_lock:
+        for counters, histograms in _all:
+            counters.clear()
+            histograms.clear()
+
+
+def _setting_changed(setting, **kwargs):
+    """Receiver of the setting_changed signal that enables or disables the metrics."""
+    if setting == 'DJANGO_UNCERTAINTY_METRICS':
+        configure()
+
+
+setting_changed.connect(_setting_changed)
@@ -1,7 +1,26 @@
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.signals import setting_changed
+
+from . import metrics
+from .behaviours import acall
+from .nodes import intern_spec
+from .optimizer import optimize_spec
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    from asyncio import coroutines, iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = coroutines._is_coroutine
+        return func
 
 
 class UncertaintyMiddleware(object):
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         """A Django middleware to introduced controlled uncertainty into the stack. It is controlled
         by the DJANGO_UNCERTAINTY setting, were the developers can specify (using the provided
@@ -11,9 +30,51 @@ class UncertaintyMiddleware(object):
 
         DJANGO_UNCERTAINTY = random_choice([(conditional(is_post or is_put, server_error()), 0.3)])
 
+        The middleware supports both synchronous (WSGI) and asynchronous (ASGI) stacks. When
+        get_response is a coroutine function the behaviours are invoked through their asynchronous
+        acall method.
+
+        The specification is resolved once and kept up to date through the setting_changed signal.
+        If DJANGO_UNCERTAINTY is missing (or None) the middleware is removed from the stack by
+        raising MiddlewareNotUsed.
         :param get_response: The get_response method provided by the Django stack
         """
         self.get_response = get_response
+        self._is_async = iscoroutinefunction(get_response)
+        self._spec = self._resolve_spec()
+        metrics.configure()
+        metrics.reset_labels(self._spec)
+
+        if self._spec is None:
+            raise MiddlewareNotUsed('DJANGO_UNCERTAINTY is not set')
+
+        setting_changed.connect(self._setting_changed)
+
+        if self._is_async:
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def _resolve_spec():
+        """Reads and validates the DJANGO_UNCERTAINTY setting.
+        :return: The (optimized and interned, see optimize_spec and intern_spec) uncertainty
+        specification or None if the setting is missing or None
+        """
+        spec = getattr(settings, 'DJANGO_UNCERTAINTY', None)
+
+        if spec is not None and not callable(spec):
+            raise ImproperlyConfigured(
+                'DJANGO_UNCERTAINTY must be a Behaviour, got {spec!r}'.format(spec=spec))
+
+        return intern_spec(optimize_spec(spec))
+
+    def _setting_changed(self, setting, **kwargs):
+        """Receiver of the setting_changed signal that swaps the uncertainty specification when
+        DJANGO_UNCERTAINTY changes.
+        :param setting: The name of the setting that changed
+        """
+        if setting == 'DJANGO_UNCERTAINTY':
+            self._spec = self._resolve_spec()
+            metrics.reset_labels(self._spec)
 
     def __call__(self, request):
         """Controls the middleware behaviour using the specification given by the DJANGO_UNCERTAINTY
@@ -22,7 +83,27 @@ class UncertaintyMiddleware(object):
         :return: The result of running the uncertainty specification if the DJANGO_UNCERTAINTY is
         present, or the default response if it's not.
         """
-        if hasattr(settings, 'DJANGO_UNCERTAINTY') and settings.DJANGO_UNCERTAINTY is not None:
-            return settings.DJANGO_UNCERTAINTY(self.get_response, request)
+        if self._is_async:
+            return self.__acall__(request)
+
+        spec = self._spec
+        if spec is not None:
+            if metrics.enabled:
+                metrics.invoked(spec)
+            return spec(self.get_response, request)
 
         return self.get_response(request)
+
+    async def __acall__(self, request):
+        """Asynchronous version of __call__.
+        :param request: The request provided by the Django stack
+        :return: The result of awaiting the uncertainty specification if the DJANGO_UNCERTAINTY is
+        present, or the default response if it's not.
+        """
+        spec = self._spec
+        if spec is not None:
+            if metrics.enabled:
+                metrics.invoked(spec)
+            return await acall(spec, self.get_response, request)
+
+        return await self.get_response(request)
@@ -0,0 +1,182 @@
+from functools import partial
+from types import MemberDescriptorType
+
+
+def _is_set_slot(node, name):
+    """Returns True if name is an attribute declared in the __slots__ of the class of node (or of
+    its bases) that has already been set."""
+    return isinstance(getattr(type(node), name, None), MemberDescriptorType) and hasattr(node, name)
+
+
+def _freeze(value, freeze_node=None):
+    """Returns a hashable version of a constructor argument. Containers are tagged with their type,
+    so e.g. a list and a tuple with the same items (or 1 and True) aren't the same argument. Nodes
+    are kept as they are, or replaced by the result of freeze_node if it's given."""
+    if isinstance(value, Node):
+        return value if freeze_node is None else freeze_node(value)
+    if type(value) in (list, tuple):
+        return type(value), tuple(_freeze(item, freeze_node) for item in value)
+    if type(value) is dict:
+        return dict, frozenset((key, _freeze(item, freeze_node)) for key, item in value.items())
+    return type(value), value
+
+
+def _is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class Node:
+    """Base of the nodes of a specification (behaviours and predicates).
+
+    Nodes keep the arguments of their constructor, which define them: they are pickled as the
+    constructor call that built them, and nodes of the same type and (equal) arguments are equal
+    and have the same hash, so identical subtrees can be shared (see intern_spec). The positional
+    arguments are kept in the tuple Python already builds for the call, and the named ones only if
+    there are any, so a node costs little more than its own attributes.
+
+    Nodes are immutable: the attributes declared in __slots__ are set once, by the constructor, and
+    can't be changed or deleted afterwards, so a specification can be shared by all the threads of
+    a worker. Subclasses that don't declare __slots__ keep an instance dictionary for their own
+    attributes.
+
+    Nodes whose stateful attribute is True keep state between requests (e.g. rate_limit), so they
+    are only equal to themselves.
+    """
+    __slots__ = ('_init_args', '_init_kwargs')
+    _argument_slots = None
+    stateful = False
+
+    def __new__(cls, *args, **kwargs):
+        """Keeps the arguments of the constructor, so the node is pickled as the constructor call
+        that built it (see __reduce__)."""
+        self = super().__new__(cls)
+        if '_argument_slots' in cls.__dict__:  # rebuilt from the slots by _arguments
+            self._init_args = self._init_kwargs = None
+        else:
+            self._init_args = args
+            self._init_kwargs = kwargs or None
+        return self
+
+    def _arguments(self):
+        """Returns the positional and named arguments of the constructor of the node."""
+        if self._init_args is None:
+            return tuple(getattr(self, name) for name in self._argument_slots), {}
+        return self._init_args, self._init_kwargs or {}
+
+    def __reduce__(self):
+        """Pickles the node as its constructor call, so its derived state (compiled predicates,
+        locks, counters) is built again when it's unpickled."""
+        args, kwargs = self._arguments()
+        return partial(type(self), *args, **kwargs), ()
+
+    def __setattr__(self, name, value):
+        if _is_set_slot(self, name):
+            raise AttributeError("'{cls}' object is immutable, {name} can not be changed".format(
+                cls=type(self).__name__, name=name))
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        if _is_set_slot(self, name):
+            raise AttributeError("'{cls}' object is immutable, {name} can not be deleted".format(
+                cls=type(self).__name__, name=name))
+        object.__delattr__(self, name)
+
+    def _structure(self, freeze_node=None):
+        """Returns the type and the (frozen, see _freeze) constructor arguments of the node, or None
+        if the node is stateful. The structure can't be hashed if some argument can't, in which
+        case the node is only equal to itself."""
+        if self.stateful:
+            return None
+
+        args, kwargs = self._arguments()
+        return type(self), _freeze(args, freeze_node), _freeze(kwargs, freeze_node)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Node):
+            return NotImplemented
+        if type(self) is not type(other):
+            return False
+
+        structure = self._structure()
+        return (structure is not None and structure == other._structure() and
+                _is_hashable(structure))
+
+    def __hash__(self):
+        # Not cached, as that would cost every node an attribute: the hash is only computed when
+        # building the specification (e.g. by compile_predicate), never on the request path
+        structure = self._structure()
+        if structure is None or not _is_hashable(structure):
+            return object.__hash__(self)
+        return hash(structure)
+
+
+def _map_nodes(value, function):
+    """Applies function to the nodes in value (a node, or lists, tuples and dictionaries of them),
+    returning value itself if none of them changed."""
+    if issubclass(type(value), Node):  # not isinstance, so mocks with spec=Node are left alone
+        return function(value)
+
+    if type(value) in (list, tuple):
+        items = [_map_nodes(item, function) for item in value]
+        if all(item is original for item, original in zip(items, value)):
+            return value
+        return type(value)(items)
+
+    if type(value) is dict:
+        items = {key: _map_nodes(item, function) for key, item in value.items()}
+        if all(items[key] is item for key, item in value.items()):
+            return value
+        return items
+
+    return value
+
+
+def map_children(node, function):
+    """Rebuilds a node applying a function to its children (the nodes in its constructor
+    arguments).
+    :param node: The node
+    :param function: The function that takes a child and returns the node to replace it with
+    :return: The rebuilt node, or node itself if none of its children were replaced
+    """
+    args, kwargs = node._arguments()
+    mapped_args = _map_nodes(args, function)
+    mapped_kwargs = _map_nodes(kwargs, function)
+    if mapped_args is args and mapped_kwargs is kwargs:
+        return node
+    return type(node)(*mapped_args, **mapped_kwargs)
+
+
+def intern_spec(spec):
+    """Returns a specification where identical subtrees are the same object. Generated
+    specifications tend to repeat subtrees (e.g. the same delay(server_error(), 2) under hundreds
+    of case branches), so interning them saves memory and shares the caches of the nodes (compiled
+    predicates, static responses). Nodes are rebuilt bottom-up with the interned children, and the
+    subtrees that are already unique are kept as they are.
+    :param spec: The specification
+    :return: The interned specification
+    """
+    canonical = {}  # structure of the nodes, with their (interned) children by id -> the node
+    interned = {}  # id of the visited nodes -> the interned node
+
+    def intern_node(node):
+        try:
+            return interned[id(node)]
+        except KeyError:
+            pass
+
+        result = map_children(node, intern_node)
+        # the children are interned already, so comparing them by identity is enough (and hashing
+        # the structure doesn't go through the whole subtree)
+        structure = result._structure(freeze_node=id)
+        if structure is not None and _is_hashable(structure):
+            result = canonical.setdefault(structure, result)
+        interned[id(node)] = result
+        return result
+
+    return _map_nodes(spec, intern_node)
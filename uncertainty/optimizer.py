@@ -0,0 +1,129 @@
+from math import isclose
+
+from .behaviours import (ConditionalBehaviour, MultiConditionalBehaviour, RandomChoiceBehaviour,
+                         _default)
+from .conditions import constant_value
+from .nodes import Node, map_children
+
+
+def optimize_spec(spec):
+    """Returns an equivalent specification that is cheaper to run. The specification is rewritten
+    bottom-up with the following rules:
+
+    - cond with a constant predicate (e.g. Predicate()) is replaced by the behaviour it always
+      invokes, and so are case branches: branches whose predicate is always False are dropped, and
+      one that is always True becomes the default behaviour.
+    - Chains of cond and case (as alternative or default behaviours) are merged into a single case,
+      so their path_matches predicates can be dispatched with a single regexp.
+    - random_choice amongst random_choice behaviours is merged into a single one with the
+      proportions multiplied, branches with a proportion of 0 are dropped, and a random_choice with
+      a single branch with a proportion of 1 is replaced by the behaviour of the branch.
+
+    Only the built-in behaviours are rewritten (not their subclasses, e.g. round_robin_choice), and
+    nodes are only rebuilt if they change.
+    :param spec: The specification
+    :return: The optimized specification
+    """
+    optimized = {}  # id of the visited nodes -> the optimized node
+
+    def optimize_node(node):
+        try:
+            return optimized[id(node)]
+        except KeyError:
+            pass
+
+        result = map_children(node, optimize_node)
+        rule = _RULES.get(type(result))
+        if rule is not None:
+            result = rule(result)
+        optimized[id(node)] = result
+        return result
+
+    return optimize_node(spec) if issubclass(type(spec), Node) else spec
+
+
+def _branches(behaviour):
+    """Returns the (predicate, behaviour) branches and the default behaviour of a cond or case."""
+    if type(behaviour) is ConditionalBehaviour:
+        return [(behaviour._predicate, behaviour._behaviour)], behaviour._alternative_behaviour
+    return behaviour._predicates_behaviours, behaviour._default_behaviour
+
+
+def _optimize_conditional(behaviour):
+    value = constant_value(behaviour._predicate)
+    if value is not None:
+        return behaviour._behaviour if value else behaviour._alternative_behaviour
+
+    if type(behaviour._alternative_behaviour) in (ConditionalBehaviour, MultiConditionalBehaviour):
+        return _optimize_multi_conditional(behaviour)
+
+    return behaviour
+
+
+def _optimize_multi_conditional(behaviour):
+    predicates_behaviours, default_behaviour = _branches(behaviour)
+    changed = type(behaviour) is not MultiConditionalBehaviour
+
+    branches = []
+    for predicate, branch_behaviour in predicates_behaviours:
+        value = constant_value(predicate)
+        if value is False:
+            changed = True
+        elif value is True:  # the next branches and the default behaviour are unreachable
+            default_behaviour = branch_behaviour
+            changed = True
+            break
+        else:
+            branches.append((predicate, branch_behaviour))
+    else:
+        while type(default_behaviour) in (ConditionalBehaviour, MultiConditionalBehaviour):
+            default_predicates_behaviours, default_behaviour = _branches(default_behaviour)
+            branches.extend(default_predicates_behaviours)
+            changed = True
+
+    if not branches:
+        return default_behaviour
+    if not changed:
+        return behaviour
+    return MultiConditionalBehaviour(branches, default_behaviour)
+
+
+def _proportions(behaviour):
+    """Returns the (behaviour, proportion) branches of a random_choice."""
+    previous = 0
+    for branch_behaviour, f_x in behaviour._behaviours:
+        yield branch_behaviour, f_x - previous
+        previous = f_x
+
+
+def _optimize_random_choice(behaviour):
+    changed = False
+    branches = []
+    for branch_behaviour, proportion in _proportions(behaviour):
+        if proportion <= 0:
+            changed = True
+        elif type(branch_behaviour) is RandomChoiceBehaviour:
+            branches.extend((inner_behaviour, proportion * inner_proportion)
+                            for inner_behaviour, inner_proportion in _proportions(branch_behaviour))
+            changed = True
+        else:
+            branches.append((branch_behaviour, proportion))
+
+    if not branches:
+        return _default
+    if len(branches) == 1 and isclose(branches[0][1], 1):
+        return branches[0][0]
+    if not changed:
+        return behaviour
+
+    try:
+        return RandomChoiceBehaviour(branches)
+    except ValueError:  # rounding errors pushed the sum of the proportions over 1
+        return behaviour
+
+
+_RULES = {
+    ConditionalBehaviour: _optimize_conditional,
+    MultiConditionalBehaviour: _optimize_multi_conditional,
+    RandomChoiceBehaviour: _optimize_random_choice,
+}
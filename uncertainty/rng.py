@@ -0,0 +1,89 @@
+import threading
+from itertools import count
+from random import Random
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from .conditions import _meta_key
+
+_local = threading.local()
+_thread_numbers = count()
+_config = None
+
+
+def get_random(request=None):
+    """Returns the random.Random instance that the decisions taken for a request should use.
+
+    If the DJANGO_UNCERTAINTY_SEED_HEADER setting names a header and the request has it, the
+    instance is created for that request only, seeded with the DJANGO_UNCERTAINTY_SEED setting and
+    the value of the header. Sending the same header value again replays the same decisions.
+    Otherwise each thread has its own instance, seeded with DJANGO_UNCERTAINTY_SEED and the number
+    of the thread (or from the operating system randomness source if there's no seed), so threads
+    never share (and contend on) the same generator state.
+    :param request: The request that triggered the middleware (optional)
+    :return: A random.Random instance
+    """
+    request_dict = getattr(request, '__dict__', None)
+    if request_dict is not None:
+        random_ = request_dict.get('_uncertainty_random')
+        if random_ is not None:
+            return random_
+
+    seed, meta_key = _config or _configure()
+    value = meta_key and request is not None and request.META.get(meta_key)
+    if value:
+        random_ = Random('{seed}:{value}'.format(seed=seed, value=value))
+    else:
+        random_ = _thread_random(seed)
+
+    if request_dict is not None:
+        request_dict['_uncertainty_random'] = random_
+
+    return random_
+
+
+def random(request=None):
+    """Returns the next random floating point number in the range [0.0, 1.0) from the random.Random
+    instance of the request (see get_random).
+    :param request: The request that triggered the middleware (optional)
+    :return: A random number
+    """
+    return get_random(request).random()
+
+
+def _thread_random(seed):
+    local = _local
+    random_ = getattr(local, 'random', None)
+    if random_ is None:
+        if seed is None:
+            random_ = Random()
+        else:
+            random_ = Random('{seed}:thread:{number}'.format(seed=seed,
+                                                             number=next(_thread_numbers)))
+        local.random = random_
+
+    return random_
+
+
+def _configure():
+    global _config
+
+    header = getattr(settings, 'DJANGO_UNCERTAINTY_SEED_HEADER', None)
+    meta_key = header and _meta_key(header)
+    _config = (getattr(settings, 'DJANGO_UNCERTAINTY_SEED', None), meta_key)
+    return _config
+
+
+def _setting_changed(setting, **kwargs):
+    """Receiver of the setting_changed signal that discards the generators if the seed settings
+    change."""
+    global _config, _local, _thread_numbers
+
+    if setting in ('DJANGO_UNCERTAINTY_SEED', 'DJANGO_UNCERTAINTY_SEED_HEADER'):
+        _config = None
+        _local = threading.local()
+        _thread_numbers = count()
+
+
+setting_changed.connect(_setting_changed)
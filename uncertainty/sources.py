@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import threading
+import weakref
+
+from . import metrics
+from .behaviours import Behaviour, _default, acall
+from .nodes import intern_spec
+from .optimizer import optimize_spec
+from .specs import build_spec, load_spec_file
+
+logger = logging.getLogger(__name__)
+
+
+def load_spec(source, filename='<spec>'):
+    """Builds a specification from Python source, which is run like a settings module and has to
+    assign the specification to DJANGO_UNCERTAINTY:
+
+    import uncertainty as u
+    DJANGO_UNCERTAINTY = u.random_choice([(u.server_error(), 0.3)])
+
+    :param source: The Python source
+    :param filename: The name of the file of the source, used in tracebacks
+    :return: The specification
+    """
+    namespace = {'__name__': 'uncertainty_spec'}
+    exec(compile(source, filename, 'exec'), namespace)
+    return namespace['DJANGO_UNCERTAINTY']
+
+
+class ReloadingBehaviour(Behaviour):
+    stateful = True
+
+    def __init__(self, interval=1.0):
+        """Base of the behaviours that load the specification from a source that can change while
+        the site is running, so the specification can be changed without restarting the workers.
+        A background thread loads the specification, and then checks the version of the source
+        every interval seconds and, if it changed, rebuilds the specification and swaps it.
+        Requests never wait for a load, they get either the old or the new specification (default
+        until the first load finishes). If loading the specification fails, the error is logged
+        and the previous one (or default, if there's none) is kept.
+        The thread is started on the first invocation of each process, so it's safe to create the
+        behaviour before the workers are forked, and it only holds a weak reference to the
+        behaviour, so it stops when the behaviour isn't used anymore (e.g. when DJANGO_UNCERTAINTY
+        is replaced). Subclasses implement _get_version and _load.
+        :param interval: The amount of seconds between the checks of the version of the source
+        """
+        self._interval = interval
+        self._behaviour = _default
+        self._version = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._stopped = threading.Event()
+
+    def _get_version(self):
+        """Returns a value that changes whenever the specification in the source changes."""
+        raise NotImplementedError
+
+    def _load(self):
+        """Returns the specification in the source."""
+        raise NotImplementedError
+
+    def reload(self):
+        """Loads the specification if the version of the source changed.
+        :return: True if the specification was swapped, False otherwise
+        """
+        try:
+            version = self._get_version()
+            if version is None or version == self._version:
+                return False
+            behaviour = intern_spec(optimize_spec(self._load()))
+        except Exception:
+            logger.exception('Could not load the uncertainty specification from %s', self)
+            return False
+
+        self._behaviour = behaviour if behaviour is not None else _default
+        self._version = version
+        metrics.reset_labels(self._behaviour)
+        return True
+
+    def stop(self):
+        """Stops checking the source for changes."""
+        self._stopped.set()
+
+    def _current(self):
+        """Returns the current specification, starting the background thread that loads it if this
+        is the first invocation of the process."""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    threading.Thread(target=_poll, args=(weakref.ref(self), self._stopped),
+                                     daemon=True).start()
+                    self._pid = pid
+
+        return self._behaviour
+
+    def __call__(self, get_response, request):
+        """Returns the result of invoking the current specification.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of calling the current specification
+        """
+        return self._current()(get_response, request)
+
+    async def acall(self, get_response, request):
+        """Asynchronous version of __call__.
+        :param get_response: The get_response method provided by the Django stack
+        :param request: The request that triggered the middleware
+        :return: The result of awaiting the current specification
+        """
+        return await acall(self._current(), get_response, request)
+
+
+def _poll(reference, stopped):
+    """Loads the specification of a ReloadingBehaviour and reloads it every interval seconds, until
+    the behaviour is stopped or garbage collected."""
+    behaviour = reference()
+    if behaviour is None:
+        return
+    behaviour.reload()
+    behaviour._loaded.set()
+    interval = behaviour._interval
+    del behaviour  # only the reference is kept while waiting
+
+    while not stopped.wait(interval):
+        behaviour = reference()
+        if behaviour is None:
+            return
+        behaviour.reload()
+        del behaviour
+
+
+class FileSpecBehaviour(ReloadingBehaviour):
+    def __init__(self, path, interval=1.0):
+        """A Behaviour that invokes the specification in a Python file (see load_spec), or in a JSON
+        or TOML file (see uncertainty.specs.load_spec_file) if the name ends in .json or .toml,
+        reloading it when the modification time or the size of the file changes.
+        :param path: The path of the file
+        :param interval: The amount of seconds between the checks of the modification time
+        """
+        super().__init__(interval)
+        self._path = path
+
+    def _get_version(self):
+        stat = os.stat(self._path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        if self._path.endswith(('.json', '.toml')):
+            return load_spec_file(self._path)
+
+        with open(self._path) as spec_file:
+            return load_spec(spec_file.read(), self._path)
+
+    def __str__(self):
+        return ('FileSpecBehaviour('
+                'path={path}, '
+                'interval={interval})').format(path=self._path, interval=self._interval)
+file_spec = FileSpecBehaviour
+
+
+class CacheSpecBehaviour(ReloadingBehaviour):
+    def __init__(self, key, cache='default', interval=1.0):
+        """A Behaviour that invokes the declarative specification (see
+        uncertainty.specs.build_spec) stored as JSON in a Django cache by publish_spec, reloading it
+        when its version changes. Only the version is read on each check, the specification is read
+        when the version changes. No code is run from the cache.
+        :param key: The cache key of the specification. The version is stored in key + ':version'.
+        :param cache: The alias of the cache
+        :param interval: The amount of seconds between the checks of the version
+        """
+        super().__init__(interval)
+        self._key = key
+        self._cache = cache
+
+    def _get_cache(self):
+        from django.core.cache import caches
+
+        return caches[self._cache]
+
+    def _get_version(self):
+        return self._get_cache().get(self._key + ':version')
+
+    def _load(self):
+        return build_spec(json.loads(self._get_cache().get(self._key)))
+
+    def __str__(self):
+        return ('CacheSpecBehaviour('
+                'key={key}, '
+                'cache={cache}, '
+                'interval={interval})').format(key=self._key, cache=self._cache,
+                                               interval=self._interval)
+cache_spec = CacheSpecBehaviour
+
+
+def publish_spec(spec, key, cache='default'):
+    """Stores a declarative specification in a Django cache for CacheSpecBehaviour and increments
+    its version, so the workers reload it.
+    :param spec: The declarative specification (see uncertainty.specs.build_spec), or its JSON text
+    :param key: The cache key of the specification
+    :param cache: The alias of the cache
+    :return: The new version
+    :raises ImproperlyConfigured: If the specification is not valid
+    """
+    from django.core.cache import caches
+
+    if isinstance(spec, str):
+        spec = json.loads(spec)
+    build_spec(spec)  # fails early on invalid specifications
+    cache_ = caches[cache]
+    cache_.set(key, json.dumps(spec), None)
+    cache_.add(key + ':version', 0, None)
+    return cache_.incr(key + ':version')
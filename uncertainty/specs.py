@@ -0,0 +1,200 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11, TOML specifications are not supported
+    tomllib = None
+
+from . import behaviours, conditions, distributions
+
+# Bump when the way specifications are built changes, so cached artifacts are discarded
+_CACHE_FORMAT = 1
+
+_BEHAVIOURS = ('default', 'html', 'ok', 'bad_request', 'forbidden', 'not_allowed', 'server_error',
+               'not_found', 'status', 'json', 'delay', 'delay_request', 'rate_limit', 'budget',
+               'random_choice', 'round_robin_choice', 'conditional', 'cond', 'multi_conditional',
+               'multi_cond', 'case', 'slowdown', 'throttle', 'rechunk', 'random_stop')
+_CONDITIONS = ('is_method', 'is_get', 'is_delete', 'is_post', 'is_put', 'has_parameter',
+               'has_param', 'has_query_parameter', 'has_query_param', 'has_body_parameter',
+               'has_body_param', 'path_matches', 'path_is', 'is_authenticated', 'user_is',
+               'header_is', 'header_matches', 'has_cookie', 'meta_is')
+_DISTRIBUTIONS = ('exponential', 'lognormal', 'pareto', 'uniform', 'jitter', 'capped',
+                  'empirical', 'per_path')
+
+
+def _registry():
+    registry = {}
+    for module, names in ((behaviours, _BEHAVIOURS), (conditions, _CONDITIONS),
+                          (distributions, _DISTRIBUTIONS)):
+        for name in names:
+            registry[name] = getattr(module, name)
+    return registry
+
+
+def _and(predicates):
+    result = predicates[0]
+    for predicate in predicates[1:]:
+        result = conditions.AndPredicate(result, predicate)
+    return result
+
+
+def _or(predicates):
+    result = predicates[0]
+    for predicate in predicates[1:]:
+        result = conditions.OrPredicate(result, predicate)
+    return result
+
+
+def _not(predicate):
+    return conditions.NotPredicate(predicate)
+
+
+_REGISTRY = dict(_registry(), **{'and': _and, 'or': _or, 'not': _not})
+
+
+def build_spec(data):
+    """Builds a specification from its declarative form, made of dictionaries, lists and scalars
+    (as loaded from JSON or TOML). Each behaviour, condition or distribution is a dictionary whose
+    "type" is the name of the function or class that builds it (e.g. "cond", "is_get" or
+    "exponential"), and whose other keys are the keyword arguments. Positional arguments can be
+    given as a list in "args". Conditions are combined with the "and" and "or" types (taking a list
+    of "predicates") and "not" (taking a "predicate"). For instance:
+
+    {"type": "cond",
+     "predicate": {"type": "and", "predicates": [{"type": "is_post"},
+                                                 {"type": "path_matches", "regexp": "^/api/"}]},
+     "behaviour": {"type": "random_choice", "behaviours": [[{"type": "server_error"}, 0.3]]}}
+
+    The whole specification is validated before anything is built.
+    :param data: The declarative specification
+    :return: The specification
+    :raises ImproperlyConfigured: If the specification is not valid
+    """
+    _validate(data, 'spec')
+    return _build(data, 'spec')
+
+
+def _validate(value, path):
+    if isinstance(value, list):
+        for index, item in enumerate(value):
+            _validate(item, '{path}[{index}]'.format(path=path, index=index))
+        return
+
+    if not isinstance(value, dict):
+        return
+
+    if 'type' not in value:
+        for key, item in value.items():
+            _validate(item, '{path}.{key}'.format(path=path, key=key))
+        return
+
+    factory = _REGISTRY.get(value['type'])
+    if factory is None:
+        raise ImproperlyConfigured('{path}: unknown type {type!r}'.format(
+            path=path, type=value['type']))
+
+    args = value.get('args', [])
+    kwargs = {key: item for key, item in value.items() if key not in ('type', 'args')}
+    if not isinstance(args, list):
+        raise ImproperlyConfigured('{path}.args: must be a list'.format(path=path))
+
+    if isinstance(factory, conditions.Predicate):  # predicate instances like is_get
+        if args or kwargs:
+            raise ImproperlyConfigured('{path}: {type} takes no arguments'.format(
+                path=path, type=value['type']))
+    else:
+        try:
+            inspect.signature(factory).bind(*args, **kwargs)
+        except TypeError as e:
+            raise ImproperlyConfigured('{path}: {error}'.format(path=path, error=e))
+
+    if value['type'] in ('and', 'or') and not (kwargs['predicates'] if 'predicates' in kwargs
+                                               else args[0]):
+        raise ImproperlyConfigured('{path}: {type} needs at least one predicate'.format(
+            path=path, type=value['type']))
+
+    _validate(args, '{path}.args'.format(path=path))
+    for key, item in kwargs.items():
+        _validate(item, '{path}.{key}'.format(path=path, key=key))
+
+
+def _build(value, path):
+    if isinstance(value, list):
+        return [_build(item, '{path}[{index}]'.format(path=path, index=index))
+                for index, item in enumerate(value)]
+
+    if not isinstance(value, dict):
+        return value
+
+    if 'type' not in value:
+        return {key: _build(item, '{path}.{key}'.format(path=path, key=key))
+                for key, item in value.items()}
+
+    factory = _REGISTRY[value['type']]
+    if isinstance(factory, conditions.Predicate):
+        return factory
+
+    args = _build(value.get('args', []), '{path}.args'.format(path=path))
+    kwargs = {key: _build(item, '{path}.{key}'.format(path=path, key=key))
+              for key, item in value.items() if key not in ('type', 'args')}
+    try:
+        return factory(*args, **kwargs)
+    except (TypeError, ValueError) as e:  # arguments of the wrong type
+        raise ImproperlyConfigured('{path}: {error}'.format(path=path, error=e))
+
+
+def _parse(content, path):
+    if path.endswith('.toml'):
+        if tomllib is None:
+            raise ImproperlyConfigured('TOML specifications need Python 3.11 or later')
+        return tomllib.loads(content.decode('utf-8'))
+
+    return json.loads(content.decode('utf-8'))
+
+
+def load_spec_file(path, cache_dir=None):
+    """Loads a declarative specification (see build_spec) from a JSON or TOML (if the name ends in
+    .toml) file. If cache_dir is given (or the DJANGO_UNCERTAINTY_SPEC_CACHE_DIR setting is set),
+    the built specification is pickled into it, keyed by the hash of the content of the file, so
+    the next time the same content is loaded (e.g. by the next worker) it's unpickled, without
+    parsing and validating it again. The nodes are pickled as their constructor calls (see
+    uncertainty.nodes.Node), so they're still built when they're unpickled.
+    The cache directory should only be writable by the user running the site, as the pickles are
+    trusted when loaded.
+    :param path: The path of the file
+    :param cache_dir: The directory of the cached specifications (optional)
+    :return: The specification
+    :raises ImproperlyConfigured: If the specification is not valid
+    """
+    with open(path, 'rb') as spec_file:
+        content = spec_file.read()
+
+    if cache_dir is None:
+        cache_dir = getattr(settings, 'DJANGO_UNCERTAINTY_SPEC_CACHE_DIR', None)
+    if cache_dir is None:
+        return build_spec(_parse(content, path))
+
+    digest = hashlib.sha256(content)
+    digest.update('{format}:{suffix}'.format(format=_CACHE_FORMAT,
+                                             suffix=os.path.splitext(path)[1]).encode())
+    cache_path = os.path.join(cache_dir, digest.hexdigest() + '.pickle')
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            return pickle.load(cache_file)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        pass  # not cached yet, or cached by an incompatible version
+
+    spec = build_spec(_parse(content, path))
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as cache_file:
+        pickle.dump(spec, cache_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_file.name, cache_path)  # other workers never see a partial file
+    return spec
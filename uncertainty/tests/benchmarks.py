@@ -0,0 +1,270 @@
+"""Benchmarks of the overhead introduced by UncertaintyMiddleware on the request path.
+
+Each benchmark drives the middleware with RequestFactory requests through a representative
+specification, and reports the nanoseconds and the peak of memory allocated (as traced by
+tracemalloc) per request. The memory taken by the nodes of common specifications is measured as
+well, in bytes per node. Run it with
+
+    python -m uncertainty.tests.benchmarks --output results.json
+
+and compare against a previous run with
+
+    python -m uncertainty.tests.benchmarks --compare results.json
+
+which exits with an error if any benchmark got slower (or any node bigger) than the given
+threshold.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tracemalloc
+from time import perf_counter_ns
+
+import django
+
+
+def _specs():
+    """Returns the benchmarked specifications as (name, spec, path, streaming) tuples. A spec of
+    None benchmarks the Django stack without the middleware."""
+    from uncertainty.behaviours import (case, cond, default, ok, random_choice, rechunk,
+                                        server_error, slowdown, throttle)
+    from uncertainty.conditions import is_post, path_matches
+
+    cond_chain = default()
+    for i in range(20):
+        cond_chain = cond(path_matches('^/cond/{i}/'.format(i=i)), server_error(), cond_chain)
+
+    return [
+        ('no_spec', None, '/', False),
+        ('default', default(), '/', False),
+        ('cond_chain_20', cond_chain, '/', False),
+        ('case_100_paths', case([(path_matches('^/branch/{i}/'.format(i=i)), ok())
+                                 for i in range(100)]), '/branch/99/', False),
+        ('case_100_mixed', case([(path_matches('^/branch/{i}/'.format(i=i)) & is_post, ok())
+                                 for i in range(100)]), '/branch/99/', False),
+        ('random_choice_50', random_choice([(ok(), 0.01) for _ in range(50)]), '/', False),
+        ('slowdown_stream', slowdown(0), '/', True),
+        ('throttle_stream', throttle(10 ** 12), '/', True),
+        ('rechunk_stream', rechunk(1460), '/', True),
+    ]
+
+
+def _nodes():
+    """Returns the specifications whose memory is measured as (name, factory, nodes) tuples, where
+    nodes is the amount of nodes that factory builds."""
+    from uncertainty.behaviours import cond, delay, ok, server_error
+    from uncertainty.conditions import is_method, is_post
+
+    return [
+        ('delay_server_error', lambda: delay(server_error(), 2), 2),
+        ('is_method', lambda: is_method('POST'), 1),
+        ('cond_ok', lambda: cond(is_post, ok()), 2),
+    ]
+
+
+def _get_response_function(streaming):
+    from django.http import HttpResponse, StreamingHttpResponse
+
+    if streaming:
+        chunks = [b'x' * 1024] * 16
+        return lambda request: StreamingHttpResponse(chunks)
+
+    response = HttpResponse(b'x' * 1024)
+    return lambda request: response
+
+
+def _make_handler(spec, streaming):
+    """Returns a function that handles a request the way the Django stack would with the
+    middleware installed, consuming the content of streaming responses."""
+    from django.core.signals import setting_changed
+    from django.test.utils import override_settings
+    from uncertainty.middleware import UncertaintyMiddleware
+
+    get_response = _get_response_function(streaming)
+    if spec is None:
+        handler = get_response
+    else:
+        with override_settings(DJANGO_UNCERTAINTY=spec):
+            middleware = UncertaintyMiddleware(get_response)
+            # keeps the spec when the setting is restored
+            setting_changed.disconnect(middleware._setting_changed)
+        handler = middleware
+
+    if not streaming:
+        return handler
+
+    def handle_streaming(request):
+        response = handler(request)
+        for _ in response:
+            pass
+        return response
+
+    return handle_streaming
+
+
+def run_benchmark(spec, path, streaming, iterations):
+    """Runs a benchmark.
+    :param spec: The specification of the middleware, or None to benchmark without it
+    :param path: The path of the requests
+    :param streaming: Whether the view returns a streaming response or not
+    :param iterations: The amount of requests
+    :return: A dictionary with the nanoseconds and the peak of allocated bytes per request
+    """
+    from django.test import RequestFactory
+
+    handler = _make_handler(spec, streaming)
+    requests = [RequestFactory().get(path) for _ in range(iterations)]
+
+    for request in requests[:max(1, iterations // 10)]:  # warm up lazy initialization and caches
+        handler(request)
+
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = perf_counter_ns()
+        for request in requests:
+            handler(request)
+        elapsed = perf_counter_ns() - start
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    samples = min(iterations, 100)
+    peak_bytes = 0
+    tracemalloc.start()
+    try:
+        for request in requests[:samples]:
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            handler(request)
+            peak_bytes += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+
+    return {'iterations': iterations,
+            'ns_per_request': elapsed / iterations,
+            'peak_bytes_per_request': peak_bytes / samples}
+
+
+def measure_nodes(factory, nodes, count):
+    """Measures the memory taken by the nodes of a specification.
+    :param factory: The function that builds the specification
+    :param nodes: The amount of nodes of the specification (the shared ones aren't counted)
+    :param count: The amount of specifications to build
+    :return: A dictionary with the bytes allocated per node
+    """
+    built = [None] * count
+    gc.collect()
+    tracemalloc.start()
+    try:
+        current, _ = tracemalloc.get_traced_memory()
+        for i in range(count):
+            built[i] = factory()
+        allocated = tracemalloc.get_traced_memory()[0] - current
+    finally:
+        tracemalloc.stop()
+
+    return {'count': count, 'bytes_per_node': allocated / (count * nodes)}
+
+
+def measure_all_nodes(count=10000, names=None):
+    """Measures the memory taken by the nodes of the specifications of _nodes.
+    :param count: The amount of specifications to build of each kind
+    :param names: The names of the specifications to measure (all of them if not given)
+    :return: A dictionary with the result of measure_nodes of each specification by name
+    """
+    return {name: measure_nodes(factory, nodes, count)
+            for name, factory, nodes in _nodes() if names is None or name in names}
+
+
+def run_benchmarks(iterations=10000, names=None):
+    """Runs the benchmarks.
+    :param iterations: The amount of requests of each benchmark
+    :param names: The names of the benchmarks to run (all of them if not given)
+    :return: A dictionary with the results of each benchmark by name
+    """
+    return {name: run_benchmark(spec, path, streaming, iterations)
+            for name, spec, path, streaming in _specs() if names is None or name in names}
+
+
+def compare(results, baseline, threshold):
+    """Compares the results with a baseline.
+    :param results: The results of run_benchmarks
+    :param baseline: The results of a previous run
+    :param threshold: The maximum allowed slowdown, as a fraction of the baseline
+    :return: A list with the names of the benchmarks that regressed
+    """
+    return [name for name, result in results.items()
+            if name in baseline and result['ns_per_request'] >
+            baseline[name]['ns_per_request'] * (1 + threshold)]
+
+
+def compare_nodes(results, baseline, threshold):
+    """Compares the memory taken by nodes with a baseline.
+    :param results: The results of measure_all_nodes
+    :param baseline: The results of a previous run
+    :param threshold: The maximum allowed growth, as a fraction of the baseline
+    :return: A list with the names of the specifications whose nodes got bigger
+    """
+    return [name for name, result in results.items()
+            if name in baseline and result['bytes_per_node'] >
+            baseline[name]['bytes_per_node'] * (1 + threshold)]
+
+
+def _setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'uncertainty.tests.settings')
+    django.setup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the overhead of UncertaintyMiddleware')
+    parser.add_argument('names', nargs='*', help='The benchmarks to run (all of them by default)')
+    parser.add_argument('--iterations', type=int, default=10000,
+                        help='The amount of requests of each benchmark')
+    parser.add_argument('--output', help='A file to save the results to, as JSON')
+    parser.add_argument('--compare', help='A file with the results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='The slowdown (as a fraction) that counts as a regression')
+    args = parser.parse_args(argv)
+
+    _setup_django()
+    results = run_benchmarks(args.iterations, args.names or None)
+    nodes = measure_all_nodes(names=args.names or None)
+
+    for name, result in results.items():
+        print('{name:<20} {ns:>12.0f} ns/request {bytes:>10.0f} bytes/request'.format(
+            name=name, ns=result['ns_per_request'], bytes=result['peak_bytes_per_request']))
+    for name, result in nodes.items():
+        print('{name:<20} {bytes:>12.0f} bytes/node'.format(name=name,
+                                                            bytes=result['bytes_per_node']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'python': platform.python_version(),
+                       'django': django.get_version(),
+                       'results': results,
+                       'nodes': nodes}, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline['results'], args.threshold)
+        for name in regressions:
+            print('{name} regressed: {ns:.0f} ns/request, was {baseline:.0f} ns/request'.format(
+                name=name, ns=results[name]['ns_per_request'],
+                baseline=baseline['results'][name]['ns_per_request']), file=sys.stderr)
+        node_regressions = compare_nodes(nodes, baseline.get('nodes', {}), args.threshold)
+        for name in node_regressions:
+            print('{name} regressed: {bytes:.0f} bytes/node, was {baseline:.0f} bytes/node'.format(
+                name=name, bytes=nodes[name]['bytes_per_node'],
+                baseline=baseline['nodes'][name]['bytes_per_node']), file=sys.stderr)
+        return 1 if regressions or node_regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
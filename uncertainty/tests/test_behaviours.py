@@ -1,11 +1,31 @@
-from django.test import TestCase
-from unittest.mock import MagicMock, patch
+import json as json_module
+import os
+import tempfile
+
+from django.core.signals import request_finished
+from django.http import HttpResponse, HttpResponseServerError, StreamingHttpResponse
+from django.test import RequestFactory, TestCase
+from unittest.mock import AsyncMock, MagicMock, patch
 
 from uncertainty.behaviours import (Behaviour, default, HttpResponseBehaviour, html, ok,
                                     bad_request, forbidden, not_allowed, server_error, not_found,
                                     status, json, DelayResponseBehaviour, delay,
-                                    DelayRequestBehaviour, delay_request, RandomChoiceBehaviour,
-                                    cond, case, StreamBehaviour, slowdown, random_stop)
+                                    DelayRequestBehaviour, delay_request, rate_limit, budget,
+                                    RandomChoiceBehaviour, random_choice,
+                                    RoundRobinChoiceBehaviour, round_robin_choice, cond, case,
+                                    StreamBehaviour, slowdown, random_stop, throttle,
+                                    rechunk, to_streaming_response)
+from uncertainty.conditions import is_get, path_matches
+from uncertainty.distributions import per_path, uniform
+
+
+async def aiterate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def acollect(streaming_content):
+    return [chunk async for chunk in streaming_content]
 
 
 class BehaviourTests(TestCase):
@@ -25,6 +45,68 @@ class BehaviourTests(TestCase):
                          self.behaviour(self.get_response_mock, self.request_mock))
 
 
+class ImmutabilityTests(TestCase):
+    def test_behaviours_have_no_instance_dictionary(self):
+        """Tests that the behaviours declare __slots__ instead of having an instance dictionary"""
+        for behaviour in (default(), server_error(), delay(default(), 1),
+                          random_choice([(server_error(), 0.5)]), cond(is_get, server_error()),
+                          case([(is_get, server_error())]), slowdown(1), throttle(1024)):
+            self.assertFalse(hasattr(behaviour, '__dict__'), behaviour)
+
+    def test_attributes_can_not_be_changed(self):
+        """Tests that the attributes of a behaviour can't be changed after construction"""
+        behaviour = delay(default(), 1)
+        with self.assertRaises(AttributeError):
+            behaviour._seconds = 2
+        with self.assertRaises(AttributeError):
+            del behaviour._behaviour
+        with self.assertRaises(AttributeError):
+            behaviour.other = 1
+        self.assertEqual(1, behaviour._seconds)
+
+    def test_subclasses_without_slots_keep_instance_dictionary(self):
+        """Tests that custom behaviours that don't declare __slots__ can set their own attributes"""
+        class CustomBehaviour(Behaviour):
+            def __init__(self, value):
+                self.value = value
+
+        behaviour = CustomBehaviour(1)
+        behaviour.value = 2
+        self.assertEqual(2, behaviour.value)
+        with self.assertRaises(AttributeError):
+            behaviour._init_args = None
+
+
+class BehaviourAsyncTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = AsyncMock()
+        self.request_mock = MagicMock()
+
+    async def test_acall_awaits_get_response(self):
+        """Tests that awaiting acall awaits get_response"""
+        await Behaviour().acall(self.get_response_mock, self.request_mock)
+        self.get_response_mock.assert_awaited_once_with(self.request_mock)
+
+    async def test_acall_returns_get_response_result(self):
+        """Tests that acall returns the result of awaiting get_response"""
+        self.assertEqual(self.get_response_mock.return_value,
+                         await Behaviour().acall(self.get_response_mock, self.request_mock))
+
+    async def test_acall_runs_overridden_call(self):
+        """Tests that acall runs __call__ with a synchronous get_response when a subclass only
+        overrides __call__"""
+        class HeaderBehaviour(Behaviour):
+            def __call__(self, get_response, request):
+                response = get_response(request)
+                response['X-Header'] = 'value'
+                return response
+
+        self.get_response_mock.return_value = HttpResponse()
+        response = await HeaderBehaviour().acall(self.get_response_mock, self.request_mock)
+        self.get_response_mock.assert_awaited_once_with(self.request_mock)
+        self.assertEqual('value', response['X-Header'])
+
+
 class DefaultTests(TestCase):
     def test_default_is_behaviour_base(self):
         """Test that default is the Behaviour base class"""
@@ -51,6 +133,54 @@ class HttpResponseBehaviourTests(TestCase):
         self.assertEqual(self.response_class_mock.return_value,
                          self.behaviour(self.get_response_mock, self.request_mock))
 
+    async def test_acall_returns_response_class_constructor_result(self):
+        """Tests that acall returns the result of calling the response class constructor"""
+        self.assertEqual(self.response_class_mock.return_value,
+                         await self.behaviour.acall(self.get_response_mock, self.request_mock))
+
+
+class HttpResponseBehaviourStaticTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_mock = MagicMock()
+
+    def test_json_data_serialized_once(self):
+        """Tests that a static json behaviour serializes the data only once"""
+        with patch('django.http.response.json.dumps', wraps=json_module.dumps) as dumps_mock:
+            behaviour = json({'foo': 1}, static=True)
+            responses = [behaviour(self.get_response_mock, self.request_mock) for _ in range(3)]
+        self.assertEqual(1, dumps_mock.call_count)
+        for response in responses:
+            self.assertEqual(b'{"foo": 1}', response.content)
+            self.assertEqual('application/json', response['Content-Type'])
+
+    def test_returns_new_response_with_same_content(self):
+        """Tests that a static behaviour returns a different response object each time, sharing
+        the rendered content"""
+        behaviour = server_error(b'BOOM', static=True, headers={'X-Fault': 'yes'})
+        response_0 = behaviour(self.get_response_mock, self.request_mock)
+        response_1 = behaviour(self.get_response_mock, self.request_mock)
+        self.assertIsNot(response_0, response_1)
+        self.assertIs(response_0.content, response_1.content)
+        for response in (response_0, response_1):
+            self.assertIsInstance(response, HttpResponseServerError)
+            self.assertEqual(500, response.status_code)
+            self.assertEqual('yes', response['X-Fault'])
+
+    def test_responses_are_independent(self):
+        """Tests that modifying a response returned by a static behaviour doesn't affect the
+        next ones"""
+        behaviour = status(503, b'Unavailable', static=True)
+        response = behaviour(self.get_response_mock, self.request_mock)
+        response['X-Fault'] = 'yes'
+        response.set_cookie('foo', 'bar')
+        response.write(b'!')
+        response = behaviour(self.get_response_mock, self.request_mock)
+        self.assertNotIn('X-Fault', response)
+        self.assertEqual(0, len(response.cookies))
+        self.assertEqual(b'Unavailable', response.content)
+        self.assertEqual(503, response.status_code)
+
 
 class HttpResponseBehaviourTestsBase(TestCase):
     def setUp(self):
@@ -234,7 +364,7 @@ class DelayResponseBehaviourTests(TestCase):
     def setUp(self):
         sleep_patcher = patch('uncertainty.behaviours.sleep')
         self.sleep_mock = sleep_patcher.start()
-        self.addCleanup(self.sleep_mock.stop)
+        self.addCleanup(sleep_patcher.stop)
         self.get_response_mock = MagicMock()
         self.request_mock = MagicMock()
         self.some_behaviour = MagicMock()
@@ -263,11 +393,37 @@ class DelayResponseBehaviourTests(TestCase):
         self.assertEqual(delay, DelayResponseBehaviour)
 
 
+class DelayResponseBehaviourAsyncTests(TestCase):
+    def setUp(self):
+        sleep_patcher = patch('uncertainty.behaviours.sleep')
+        self.sleep_mock = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+        async_sleep_patcher = patch('uncertainty.behaviours.async_sleep', new_callable=AsyncMock)
+        self.async_sleep_mock = async_sleep_patcher.start()
+        self.addCleanup(async_sleep_patcher.stop)
+        self.get_response_mock = AsyncMock()
+        self.request_mock = MagicMock()
+        self.some_seconds = MagicMock()
+        self.delay_response_behaviour = DelayResponseBehaviour(default(), self.some_seconds)
+
+    async def test_returns_result_of_encapsulated_behaviour(self):
+        """Tests that acall returns the result of awaiting the encapsulated behaviour"""
+        self.assertEqual(self.get_response_mock.return_value,
+                         await self.delay_response_behaviour.acall(self.get_response_mock,
+                                                                   self.request_mock))
+
+    async def test_awaits_async_sleep(self):
+        """Tests that acall awaits asyncio.sleep instead of calling time.sleep"""
+        await self.delay_response_behaviour.acall(self.get_response_mock, self.request_mock)
+        self.async_sleep_mock.assert_awaited_once_with(self.some_seconds)
+        self.sleep_mock.assert_not_called()
+
+
 class DelayRequestBehaviourTests(TestCase):
     def setUp(self):
         sleep_patcher = patch('uncertainty.behaviours.sleep')
         self.sleep_mock = sleep_patcher.start()
-        self.addCleanup(self.sleep_mock.stop)
+        self.addCleanup(sleep_patcher.stop)
         self.get_response_mock = MagicMock()
         self.request_mock = MagicMock()
         self.some_behaviour = MagicMock()
@@ -297,6 +453,32 @@ class DelayRequestBehaviourTests(TestCase):
         self.assertEqual(delay_request, DelayRequestBehaviour)
 
 
+class DelayRequestBehaviourAsyncTests(TestCase):
+    def setUp(self):
+        sleep_patcher = patch('uncertainty.behaviours.sleep')
+        self.sleep_mock = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+        async_sleep_patcher = patch('uncertainty.behaviours.async_sleep', new_callable=AsyncMock)
+        self.async_sleep_mock = async_sleep_patcher.start()
+        self.addCleanup(async_sleep_patcher.stop)
+        self.get_response_mock = AsyncMock()
+        self.request_mock = MagicMock()
+        self.some_seconds = MagicMock()
+        self.delay_request_behaviour = DelayRequestBehaviour(default(), self.some_seconds)
+
+    async def test_returns_result_of_encapsulated_behaviour(self):
+        """Tests that acall returns the result of awaiting the encapsulated behaviour"""
+        self.assertEqual(self.get_response_mock.return_value,
+                         await self.delay_request_behaviour.acall(self.get_response_mock,
+                                                                  self.request_mock))
+
+    async def test_awaits_async_sleep(self):
+        """Tests that acall awaits asyncio.sleep instead of calling time.sleep"""
+        await self.delay_request_behaviour.acall(self.get_response_mock, self.request_mock)
+        self.async_sleep_mock.assert_awaited_once_with(self.some_seconds)
+        self.sleep_mock.assert_not_called()
+
+
 class RandomChoiceBehaviourInitTests(TestCase):
     def setUp(self):
         self.behaviour_0 = MagicMock()
@@ -334,14 +516,203 @@ class RandomChoiceBehaviourInitTests(TestCase):
         self.assertTupleEqual((self.behaviour_2, 0.6), random_choice._behaviours[2])
 
 
+class RateLimitBehaviourTests(TestCase):
+    def setUp(self):
+        self.now = 0
+        monotonic_patcher = patch('uncertainty.behaviours.monotonic', new=lambda: self.now)
+        monotonic_patcher.start()
+        self.addCleanup(monotonic_patcher.stop)
+        self.get_response_mock = MagicMock()
+        self.behaviour_mock = MagicMock()
+        self.request_factory = RequestFactory()
+
+    def test_invokes_behaviour_within_limit(self):
+        """Tests that rate_limit invokes the encapsulated behaviour for requests within the limit"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 2)
+        request = self.request_factory.get('/')
+        for _ in range(2):
+            self.assertEqual(self.behaviour_mock.return_value,
+                             rate_limit_(self.get_response_mock, request))
+        self.assertEqual(2, self.behaviour_mock.call_count)
+
+    def test_returns_429_with_retry_after_over_limit(self):
+        """Tests that rate_limit returns a 429 response with Retry-After once the limit is
+        exceeded"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 1, per=10)
+        request = self.request_factory.get('/')
+        rate_limit_(self.get_response_mock, request)
+        self.now = 2.5
+        response = rate_limit_(self.get_response_mock, request)
+        self.assertEqual(429, response.status_code)
+        self.assertEqual('8', response['Retry-After'])
+        self.behaviour_mock.assert_called_once_with(self.get_response_mock, request)
+
+    def test_allows_requests_again_after_retry_after(self):
+        """Tests that requests are allowed again once the interval has passed"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 1, per=10)
+        request = self.request_factory.get('/')
+        rate_limit_(self.get_response_mock, request)
+        self.now = 10
+        self.assertEqual(self.behaviour_mock.return_value,
+                         rate_limit_(self.get_response_mock, request))
+
+    def test_rejected_requests_dont_consume_the_limit(self):
+        """Tests that rejected requests don't delay the moment the key is allowed again"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 1, per=10)
+        request = self.request_factory.get('/')
+        rate_limit_(self.get_response_mock, request)
+        for _ in range(5):
+            rate_limit_(self.get_response_mock, request)
+        self.now = 10
+        self.assertEqual(self.behaviour_mock.return_value,
+                         rate_limit_(self.get_response_mock, request))
+
+    def test_counts_keys_separately(self):
+        """Tests that each IP address has its own limit"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 1)
+        rate_limit_(self.get_response_mock, self.request_factory.get('/', REMOTE_ADDR='10.0.0.1'))
+        response = rate_limit_(self.get_response_mock,
+                               self.request_factory.get('/', REMOTE_ADDR='10.0.0.2'))
+        self.assertEqual(self.behaviour_mock.return_value, response)
+
+    def test_counts_by_header(self):
+        """Tests that the requests can be counted by the value of a header"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 1, key='X-Api-Key')
+        rate_limit_(self.get_response_mock, self.request_factory.get('/', HTTP_X_API_KEY='a'))
+        self.assertEqual(429, rate_limit_(self.get_response_mock,
+                                          self.request_factory.get('/', HTTP_X_API_KEY='a'))
+                         .status_code)
+        self.assertEqual(self.behaviour_mock.return_value,
+                         rate_limit_(self.get_response_mock,
+                                     self.request_factory.get('/', HTTP_X_API_KEY='b')))
+
+    def test_counts_by_content_type(self):
+        """Tests that the requests can be counted by the Content-Type header, which Django keeps
+        without the HTTP_ prefix"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 1, key='Content-Type')
+        rate_limit_(self.get_response_mock, self.request_factory.post('/', content_type='a/b'))
+        self.assertEqual(429, rate_limit_(self.get_response_mock,
+                                          self.request_factory.post('/', content_type='a/b'))
+                         .status_code)
+        self.assertEqual(self.behaviour_mock.return_value,
+                         rate_limit_(self.get_response_mock,
+                                     self.request_factory.post('/', content_type='a/c')))
+
+    def test_counts_by_user(self):
+        """Tests that authenticated requests are counted by user"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 1, key='user')
+        request_0 = self.request_factory.get('/', REMOTE_ADDR='10.0.0.1')
+        request_0.user = MagicMock(is_authenticated=True, pk=1)
+        request_1 = self.request_factory.get('/', REMOTE_ADDR='10.0.0.2')
+        request_1.user = MagicMock(is_authenticated=True, pk=1)
+        rate_limit_(self.get_response_mock, request_0)
+        self.assertEqual(429, rate_limit_(self.get_response_mock, request_1).status_code)
+
+    def test_burst(self):
+        """Tests that burst requests are allowed at once"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 1, burst=3)
+        request = self.request_factory.get('/')
+        responses = [rate_limit_(self.get_response_mock, request) for _ in range(4)]
+        self.assertEqual([self.behaviour_mock.return_value] * 3, responses[:3])
+        self.assertEqual(429, responses[3].status_code)
+
+    def test_rates_below_one_allow_one_request(self):
+        """Tests that rates below one request per period allow a request by default"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 0.5)
+        request = self.request_factory.get('/')
+        self.assertEqual(self.behaviour_mock.return_value,
+                         rate_limit_(self.get_response_mock, request))
+        self.assertEqual(429, rate_limit_(self.get_response_mock, request).status_code)
+
+    def test_raises_value_error_if_burst_is_below_one(self):
+        """Tests that a burst that doesn't allow any request raises ValueError"""
+        self.assertRaises(ValueError, rate_limit, self.behaviour_mock, 1, burst=0.5)
+
+    def test_forgets_least_recently_used_keys(self):
+        """Tests that only max_keys keys are tracked, dropping the least recently used one"""
+        rate_limit_ = rate_limit(self.behaviour_mock, 1, max_keys=2)
+        for address in ('10.0.0.1', '10.0.0.2', '10.0.0.1', '10.0.0.3'):
+            rate_limit_(self.get_response_mock, self.request_factory.get('/', REMOTE_ADDR=address))
+        self.assertEqual(['10.0.0.1', '10.0.0.3'], list(rate_limit_._arrival_times))
+
+    async def test_awaits_behaviour_within_limit(self):
+        """Tests that rate_limit awaits the encapsulated behaviour in the asynchronous path"""
+        behaviour_mock = AsyncMock(spec=Behaviour)
+        rate_limit_ = rate_limit(behaviour_mock, 1)
+        request = self.request_factory.get('/')
+        self.assertEqual(behaviour_mock.acall.return_value,
+                         await rate_limit_.acall(self.get_response_mock, request))
+        self.assertEqual(429, (await rate_limit_.acall(self.get_response_mock, request))
+                         .status_code)
+        behaviour_mock.acall.assert_awaited_once_with(self.get_response_mock, request)
+
+
+class BudgetBehaviourTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'budget')
+        self.get_response_mock = MagicMock()
+        self.request_mock = MagicMock()
+        self.behaviour_mock = MagicMock()
+        self.fallback_mock = MagicMock()
+
+    def test_invokes_behaviour_while_budget_is_left(self):
+        """Tests that budget invokes the encapsulated behaviour amount times and then the
+        fallback"""
+        budget_ = budget(self.behaviour_mock, 2, 'test', fallback=self.fallback_mock,
+                         path=self.path)
+        responses = [budget_(self.get_response_mock, self.request_mock) for _ in range(3)]
+        self.assertEqual([self.behaviour_mock.return_value] * 2 + [self.fallback_mock.return_value],
+                         responses)
+
+    def test_falls_back_to_default(self):
+        """Tests that budget calls get_response once the budget is spent if there's no fallback"""
+        budget_ = budget(self.behaviour_mock, 0, 'test', path=self.path)
+        self.assertEqual(self.get_response_mock.return_value,
+                         budget_(self.get_response_mock, self.request_mock))
+        self.behaviour_mock.assert_not_called()
+
+    def test_budgets_of_the_same_name_are_shared(self):
+        """Tests that budgets backed by the same counter share the amount"""
+        budget_0 = budget(self.behaviour_mock, 1, 'test', fallback=self.fallback_mock,
+                          path=self.path)
+        budget_1 = budget(self.behaviour_mock, 1, 'test', fallback=self.fallback_mock,
+                          path=self.path)
+        budget_0(self.get_response_mock, self.request_mock)
+        self.assertEqual(self.fallback_mock.return_value,
+                         budget_1(self.get_response_mock, self.request_mock))
+
+    @patch('uncertainty.counters.time')
+    def test_budget_is_renewed_every_period(self, time_mock):
+        """Tests that the budget is renewed every per seconds"""
+        time_mock.return_value = 60
+        budget_ = budget(self.behaviour_mock, 1, 'test', per=60, fallback=self.fallback_mock,
+                         path=self.path)
+        budget_(self.get_response_mock, self.request_mock)
+        time_mock.return_value = 120
+        self.assertEqual(self.behaviour_mock.return_value,
+                         budget_(self.get_response_mock, self.request_mock))
+
+    async def test_awaits_behaviour_while_budget_is_left(self):
+        """Tests that budget awaits the encapsulated behaviour in the asynchronous path"""
+        behaviour_mock = AsyncMock(spec=Behaviour)
+        budget_ = budget(behaviour_mock, 1, 'test', path=self.path)
+        get_response_mock = AsyncMock()
+        self.assertEqual(behaviour_mock.acall.return_value,
+                         await budget_.acall(get_response_mock, self.request_mock))
+        self.assertEqual(get_response_mock.return_value,
+                         await budget_.acall(get_response_mock, self.request_mock))
+
+
 class RandomChoiceBehaviourTests(TestCase):
     def setUp(self):
         random_patcher = patch('uncertainty.behaviours.random')
         self.random_mock = random_patcher.start()
-        self.addCleanup(self.random_mock.stop)
+        self.addCleanup(random_patcher.stop)
         default_patcher = patch('uncertainty.behaviours._default')
         self.default_mock = default_patcher.start()
-        self.addCleanup(self.default_mock.stop)
+        self.addCleanup(default_patcher.stop)
 
         self.get_response_mock = MagicMock()
         self.request_mock = MagicMock()
@@ -404,12 +775,72 @@ class RandomChoiceBehaviourTests(TestCase):
         self.random_choice(self.get_response_mock, self.request_mock)
         self.default_mock.assert_called_once_with(self.get_response_mock, self.request_mock)
 
+    def test_chooses_same_behaviour_as_linear_scan(self):
+        """Tests that the chosen behaviour is the first one whose cumulative proportion is greater
+        than the random number for many behaviours"""
+        behaviours = [(MagicMock(), 0.015) for _ in range(50)]
+        behaviours[10] = (behaviours[10][0], 0)
+        random_choice = RandomChoiceBehaviour(behaviours)
+        for i in range(1000):
+            x = i / 1000
+            expected = next((b for b, f_x in random_choice._behaviours if x < f_x),
+                            self.default_mock)
+            self.random_mock.return_value = x
+            self.assertIs(expected, random_choice._choose(self.request_mock))
+
+    async def test_acall_awaits_chosen_behaviour(self):
+        """Tests that acall awaits the randomly chosen behaviour"""
+        self.random_mock.return_value = 0.45
+        behaviour = AsyncMock(spec=Behaviour)
+        random_choice = RandomChoiceBehaviour(((self.behaviour_0, 0.2), (behaviour, 0.3)))
+        response = await random_choice.acall(self.get_response_mock, self.request_mock)
+        behaviour.acall.assert_awaited_once_with(self.get_response_mock, self.request_mock)
+        self.assertEqual(behaviour.acall.return_value, response)
+
+
+class RoundRobinChoiceBehaviourTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_mock = MagicMock()
+        self.behaviour_0 = MagicMock()
+        self.behaviour_1 = MagicMock()
+
+    def test_proportions_are_exact_over_every_window(self):
+        """Tests that every window of requests gets each behaviour in its proportion"""
+        round_robin = RoundRobinChoiceBehaviour(((self.behaviour_0, 0.05),
+                                                 (self.behaviour_1, 0.29)), window=100)
+        chosen = [round_robin._choose(self.request_mock) for _ in range(300)]
+        for start in range(0, 300, 100):
+            window = chosen[start:start + 100]
+            self.assertEqual(5, window.count(self.behaviour_0))
+            self.assertEqual(29, window.count(self.behaviour_1))
+            self.assertEqual(66, len([b for b in window
+                                      if b is not self.behaviour_0 and b is not self.behaviour_1]))
+
+    def test_behaviours_are_interleaved(self):
+        """Tests that the behaviours are spread evenly over the window"""
+        round_robin = RoundRobinChoiceBehaviour(((self.behaviour_0, 0.5), self.behaviour_1),
+                                                window=10)
+        chosen = [round_robin._choose(self.request_mock) for _ in range(10)]
+        self.assertEqual([self.behaviour_0, self.behaviour_1] * 5, chosen)
+
+    def test_invokes_scheduled_behaviour(self):
+        """Tests that invoking the behaviour invokes the scheduled behaviour"""
+        round_robin = RoundRobinChoiceBehaviour(((self.behaviour_0, 1),), window=10)
+        self.assertEqual(self.behaviour_0.return_value,
+                         round_robin(self.get_response_mock, self.request_mock))
+        self.behaviour_0.assert_called_once_with(self.get_response_mock, self.request_mock)
+
+    def test_round_robin_choice_is_round_robin_choice_behaviour(self):
+        """Tests that round_robin_choice is an alias for RoundRobinChoiceBehaviour"""
+        self.assertEqual(round_robin_choice, RoundRobinChoiceBehaviour)
+
 
 class ConditionalBehaviourTests(TestCase):
     def setUp(self):
         default_patcher = patch('uncertainty.behaviours._default')
         self.default_mock = default_patcher.start()
-        self.addCleanup(self.default_mock.stop)
+        self.addCleanup(default_patcher.stop)
 
         self.get_response_mock = MagicMock()
         self.request_mock = MagicMock()
@@ -468,12 +899,33 @@ class ConditionalBehaviourTests(TestCase):
         response = cond_(self.get_response_mock, self.request_mock)
         self.assertEqual(self.default_mock.return_value, response)
 
+    async def test_acall_awaits_behaviour_predicate_true(self):
+        """Tests that if the predicate is True, acall awaits behaviour"""
+        self.predicate.return_value = True
+        behaviour = AsyncMock(spec=Behaviour)
+        alternative_behaviour = AsyncMock(spec=Behaviour)
+        cond_ = cond(self.predicate, behaviour, alternative_behaviour)
+        await cond_.acall(self.get_response_mock, self.request_mock)
+        behaviour.acall.assert_awaited_once_with(self.get_response_mock, self.request_mock)
+        alternative_behaviour.acall.assert_not_awaited()
+
+    async def test_acall_awaits_alternative_behaviour_predicate_false(self):
+        """Tests that if the predicate is False, acall awaits alternative_behaviour"""
+        self.predicate.return_value = False
+        behaviour = AsyncMock(spec=Behaviour)
+        alternative_behaviour = AsyncMock(spec=Behaviour)
+        cond_ = cond(self.predicate, behaviour, alternative_behaviour)
+        await cond_.acall(self.get_response_mock, self.request_mock)
+        alternative_behaviour.acall.assert_awaited_once_with(self.get_response_mock,
+                                                             self.request_mock)
+        behaviour.acall.assert_not_awaited()
+
 
 class MultiConditionalBehaviourTests(TestCase):
     def setUp(self):
         default_patcher = patch('uncertainty.behaviours._default')
         self.default_mock = default_patcher.start()
-        self.addCleanup(self.default_mock.stop)
+        self.addCleanup(default_patcher.stop)
 
         self.get_response_mock = MagicMock()
         self.request_mock = MagicMock()
@@ -599,7 +1051,334 @@ class MultiConditionalBehaviourTests(TestCase):
         response = case_(self.get_response_mock, self.request_mock)
         self.assertEqual(self.default_mock.return_value, response)
 
+    async def test_acall_awaits_behaviour_1_predicate_1_true(self):
+        """Tests that if the predicate_0 is False, and predicate_1 is True, acall awaits
+        behaviour_1"""
+        self.predicate_0.return_value = False
+        self.predicate_1.return_value = True
+        behaviour_0 = AsyncMock(spec=Behaviour)
+        behaviour_1 = AsyncMock(spec=Behaviour)
+        case_ = case([(self.predicate_0, behaviour_0), (self.predicate_1, behaviour_1)])
+        await case_.acall(self.get_response_mock, self.request_mock)
+        behaviour_1.acall.assert_awaited_once_with(self.get_response_mock, self.request_mock)
+        behaviour_0.acall.assert_not_awaited()
+
+
+class MultiConditionalBehaviourPathDispatchTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_mock = MagicMock()
+        self.request_mock.method = 'GET'
+        self.behaviours = [MagicMock() for _ in range(5)]
+        self.default_behaviour = MagicMock()
+        self.case = case([(path_matches('^/a'), self.behaviours[0]),
+                          (path_matches('^/b'), self.behaviours[1]),
+                          (is_get, self.behaviours[2]),
+                          (path_matches('^/c'), self.behaviours[3]),
+                          (path_matches('^/(d)'), self.behaviours[4])],
+                         default_behaviour=self.default_behaviour)
+
+    def assertInvoked(self, path, behaviour):
+        self.request_mock.path = path
+        self.case(self.get_response_mock, self.request_mock)
+        behaviour.assert_called_once_with(self.get_response_mock, self.request_mock)
+        behaviour.reset_mock()
+
+    def test_consecutive_path_predicates_are_merged(self):
+        """Tests that consecutive path_matches predicates are merged into a single test"""
+        self.assertEqual(4, len(self.case._tests_behaviours))
+
+    def test_first_match_semantics_are_kept(self):
+        """Tests that the behaviour of the first matching predicate is invoked"""
+        self.assertInvoked('/a', self.behaviours[0])
+        self.assertInvoked('/b', self.behaviours[1])
+        self.assertInvoked('/c', self.behaviours[2])
+        self.request_mock.method = 'POST'
+        self.assertInvoked('/c', self.behaviours[3])
+        self.assertInvoked('/d', self.behaviours[4])
+        self.assertInvoked('/e', self.default_behaviour)
+
+    def test_inline_global_flags_arent_merged(self):
+        """Tests that path_matches predicates with inline global flags that don't change the flags
+        (like (?u)) can still be used"""
+        behaviours = [MagicMock(), MagicMock()]
+        self.case = case([(path_matches('^/a'), behaviours[0]),
+                          (path_matches('(?u)^/b'), behaviours[1])], self.default_behaviour)
+        self.assertInvoked('/a', behaviours[0])
+        self.assertInvoked('/b', behaviours[1])
+        self.assertInvoked('/c', self.default_behaviour)
+
+
+class StreamBehaviourTests(TestCase):
+    def setUp(self):
+        self.request_mock = MagicMock()
+        self.stream_behaviour = StreamBehaviour()
+
+    def test_streaming_content_is_preserved(self):
+        """Tests that StreamBehaviour yields every chunk of a streaming response"""
+        response = self.stream_behaviour(
+            lambda request: StreamingHttpResponse([b'a', b'b', b'c']), self.request_mock)
+        self.assertEqual([b'a', b'b', b'c'], list(response.streaming_content))
+
+    def test_non_streaming_response_is_returned_untouched(self):
+        """Tests that StreamBehaviour returns non streaming responses untouched"""
+        some_response = HttpResponse(b'abc')
+        self.assertIs(some_response,
+                      self.stream_behaviour(lambda request: some_response, self.request_mock))
+
+    def test_subclasses_that_dont_call_init_dont_force_streaming(self):
+        """Tests that subclasses whose __init__ doesn't call StreamBehaviour.__init__ still work,
+        leaving non streaming responses alone"""
+        class UpperStreamBehaviour(StreamBehaviour):
+            def __init__(self, suffix):
+                self.suffix = suffix
+
+            def wrap_streaming_content(self, streaming_content):
+                for chunk in streaming_content:
+                    yield chunk.upper()
+                yield self.suffix
+
+        stream_behaviour = UpperStreamBehaviour(b'!')
+        some_response = HttpResponse(b'abc')
+        self.assertIs(some_response,
+                      stream_behaviour(lambda request: some_response, self.request_mock))
+        response = stream_behaviour(lambda request: StreamingHttpResponse([b'a', b'b']),
+                                    self.request_mock)
+        self.assertEqual([b'A', b'B', b'!'], list(response.streaming_content))
+
+    async def test_async_streaming_content_is_preserved(self):
+        """Tests that StreamBehaviour yields every chunk of an asynchronous streaming response"""
+        get_response_mock = AsyncMock(
+            return_value=StreamingHttpResponse(aiterate([b'a', b'b', b'c'])))
+        response = await self.stream_behaviour.acall(get_response_mock, self.request_mock)
+        self.assertTrue(response.is_async)
+        self.assertEqual([b'a', b'b', b'c'], await acollect(response.streaming_content))
+
+
+class ForceStreamingTests(TestCase):
+    def setUp(self):
+        self.request_mock = MagicMock()
+        self.response = HttpResponse(b'0123456789', status=201, content_type='text/plain')
+        self.response.set_cookie('some', 'cookie')
+
+    def test_streams_non_streaming_response(self):
+        """Tests that StreamBehaviour streams non streaming responses if force_streaming is True"""
+        class SmallChunksStreamBehaviour(StreamBehaviour):
+            streaming_chunk_size = 4
+
+        stream_behaviour = SmallChunksStreamBehaviour(force_streaming=True)
+        response = stream_behaviour(lambda request: self.response, self.request_mock)
+        self.assertTrue(response.streaming)
+        self.assertEqual([b'0123', b'4567', b'89'], list(response.streaming_content))
+
+    def test_keeps_status_headers_and_cookies(self):
+        """Tests that the streaming response keeps the status, headers and cookies"""
+        response = to_streaming_response(self.response, 4)
+        self.assertEqual(201, response.status_code)
+        self.assertEqual('text/plain', response['Content-Type'])
+        self.assertEqual('cookie', response.cookies['some'].value)
+
+    def test_doesnt_copy_content(self):
+        """Tests that the chunks are memoryview slices of the content"""
+        content = self.response.content
+        chunks = list(to_streaming_response(self.response, 4)._iterator)
+        self.assertEqual(3, len(chunks))
+        self.assertTrue(all(chunk.obj is content for chunk in chunks))
+
+    def test_closes_resources_and_finishes_request_once(self):
+        """Tests that closing the streaming response closes the resources of the original one and
+        sends request_finished only once"""
+        closer_mock = MagicMock()
+        self.response._resource_closers.append(closer_mock)
+        receiver_mock = MagicMock()
+        request_finished.connect(receiver_mock)
+        self.addCleanup(request_finished.disconnect, receiver_mock)
+        response = slowdown(0, force_streaming=True)(lambda request: self.response,
+                                                     self.request_mock)
+        list(response.streaming_content)
+        response.close()
+        closer_mock.assert_called_once_with()
+        self.assertEqual(1, receiver_mock.call_count)
+
+    def test_stream_behaviours_apply_to_non_streaming_responses(self):
+        """Tests that the stream behaviours act on non streaming responses if force_streaming is
+        True"""
+        response = rechunk(3, force_streaming=True)(lambda request: self.response,
+                                                    self.request_mock)
+        self.assertEqual([b'012', b'345', b'678', b'9'], list(response.streaming_content))
+
+    async def test_streams_non_streaming_response_asynchronously(self):
+        """Tests that non streaming responses get asynchronous streaming content in the
+        asynchronous path"""
+        get_response_mock = AsyncMock(return_value=self.response)
+        response = await rechunk(4, force_streaming=True).acall(get_response_mock,
+                                                                self.request_mock)
+        self.assertTrue(response.is_async)
+        self.assertEqual([b'0123', b'4567', b'89'], await acollect(response.streaming_content))
+
+
+class SlowdownStreamBehaviourTests(TestCase):
+    def setUp(self):
+        sleep_patcher = patch('uncertainty.behaviours.sleep')
+        self.sleep_mock = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+        async_sleep_patcher = patch('uncertainty.behaviours.async_sleep', new_callable=AsyncMock)
+        self.async_sleep_mock = async_sleep_patcher.start()
+        self.addCleanup(async_sleep_patcher.stop)
+        self.request_mock = MagicMock()
+        self.some_seconds = MagicMock()
+        self.slowdown = slowdown(self.some_seconds)
+
+    def test_sleeps_before_each_chunk(self):
+        """Tests that slowdown calls sleep once per chunk"""
+        response = self.slowdown(lambda request: StreamingHttpResponse([b'a', b'b']),
+                                 self.request_mock)
+        self.assertEqual([b'a', b'b'], list(response.streaming_content))
+        self.assertEqual(2, self.sleep_mock.call_count)
+        self.sleep_mock.assert_called_with(self.some_seconds)
+
+    async def test_awaits_async_sleep_before_each_chunk(self):
+        """Tests that slowdown awaits asyncio.sleep once per chunk of an asynchronous stream"""
+        get_response_mock = AsyncMock(return_value=StreamingHttpResponse(aiterate([b'a', b'b'])))
+        response = await self.slowdown.acall(get_response_mock, self.request_mock)
+        self.assertEqual([b'a', b'b'], await acollect(response.streaming_content))
+        self.assertEqual(2, self.async_sleep_mock.await_count)
+        self.sleep_mock.assert_not_called()
+
+    def test_samples_distributions_for_the_request(self):
+        """Tests that distributions that depend on the request (like per_path) sample the delay
+        for the request of the response"""
+        distribution = per_path([('^/slow/', uniform(2, 2))])
+        response = slowdown(distribution)(lambda request: StreamingHttpResponse([b'a']),
+                                          RequestFactory().get('/slow/'))
+        list(response.streaming_content)
+        self.sleep_mock.assert_called_once_with(2)
+
+    async def test_samples_distributions_for_the_request_asynchronously(self):
+        """Tests that the asynchronous stream samples the distribution for the request"""
+        distribution = per_path([('^/slow/', uniform(2, 2))])
+        get_response_mock = AsyncMock(return_value=StreamingHttpResponse(aiterate([b'a'])))
+        response = await slowdown(distribution).acall(get_response_mock,
+                                                      RequestFactory().get('/fast/'))
+        await acollect(response.streaming_content)
+        self.async_sleep_mock.assert_awaited_once_with(0)
+
+
+class ThrottleStreamBehaviourTests(TestCase):
+    def setUp(self):
+        self.now = 0
+        monotonic_patcher = patch('uncertainty.behaviours.monotonic', new=lambda: self.now)
+        monotonic_patcher.start()
+        self.addCleanup(monotonic_patcher.stop)
+        sleep_patcher = patch('uncertainty.behaviours.sleep', side_effect=self.advance)
+        self.sleep_mock = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+        async_sleep_patcher = patch('uncertainty.behaviours.async_sleep', new_callable=AsyncMock,
+                                    side_effect=self.advance)
+        self.async_sleep_mock = async_sleep_patcher.start()
+        self.addCleanup(async_sleep_patcher.stop)
+        self.request_mock = MagicMock()
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def test_holds_bandwidth(self):
+        """Tests that the stream takes as long as the bandwidth requires"""
+        throttle_ = throttle(1000, burst=100)
+        response = throttle_(lambda request: StreamingHttpResponse([b'x' * 100] * 11),
+                             self.request_mock)
+        self.assertEqual([b'x' * 100] * 11, list(response.streaming_content))
+        self.assertAlmostEqual(1, self.now)
+
+    def test_small_chunks_batch_sleeps(self):
+        """Tests that the debt of small chunks is accumulated until it's worth sleeping"""
+        throttle_ = throttle(1000, burst=0, min_sleep=0.1)
+        response = throttle_(lambda request: StreamingHttpResponse([b'x'] * 1000),
+                             self.request_mock)
+        self.assertEqual(1000, len(list(response.streaming_content)))
+        self.assertEqual(10, self.sleep_mock.call_count)
+        self.assertAlmostEqual(1, self.now)
+
+    def test_burst_is_sent_right_away(self):
+        """Tests that chunks within the burst are not held"""
+        throttle_ = throttle(1000, burst=1000)
+        response = throttle_(lambda request: StreamingHttpResponse([b'x' * 100] * 10),
+                             self.request_mock)
+        list(response.streaming_content)
+        self.sleep_mock.assert_not_called()
+
+    async def test_holds_bandwidth_without_blocking(self):
+        """Tests that the asynchronous stream takes as long as the bandwidth requires"""
+        throttle_ = throttle(1000, burst=100)
+        get_response_mock = AsyncMock(
+            return_value=StreamingHttpResponse(aiterate([b'x' * 100] * 11)))
+        response = await throttle_.acall(get_response_mock, self.request_mock)
+        self.assertEqual([b'x' * 100] * 11, await acollect(response.streaming_content))
+        self.assertAlmostEqual(1, self.now)
+        self.sleep_mock.assert_not_called()
+
+
+class RechunkStreamBehaviourTests(TestCase):
+    def setUp(self):
+        self.request_mock = MagicMock()
 
-# TODO Add StreamBehaviour tests
-# TODO Add SlowdownStreamBehaviour tests
-# TODO Add RandomStopStreamBehaviour tests
+    def test_splits_large_chunks(self):
+        """Tests that chunks larger than chunk_size are split"""
+        rechunk_ = rechunk(4)
+        response = rechunk_(lambda request: StreamingHttpResponse([b'0123456789']),
+                            self.request_mock)
+        self.assertEqual([b'0123', b'4567', b'89'], list(response.streaming_content))
+
+    def test_splits_without_copying(self):
+        """Tests that the chunks are split into memoryview slices of the original chunk"""
+        chunk = b'0123456789'
+        segments = list(rechunk(4).wrap_streaming_content([chunk]))
+        self.assertTrue(all(isinstance(segment, memoryview) for segment in segments[:2]))
+        self.assertTrue(all(segment.obj is chunk for segment in segments[:2]))
+
+    def test_coalesces_small_chunks(self):
+        """Tests that chunks smaller than chunk_size are joined"""
+        rechunk_ = rechunk(4)
+        response = rechunk_(lambda request: StreamingHttpResponse([b'01', b'2', b'345', b'6']),
+                            self.request_mock)
+        self.assertEqual([b'0123', b'456'], list(response.streaming_content))
+
+    def test_doesnt_coalesce_if_disabled(self):
+        """Tests that chunks smaller than chunk_size are left alone if coalesce is False"""
+        rechunk_ = rechunk(4, coalesce=False)
+        response = rechunk_(lambda request: StreamingHttpResponse([b'01', b'23456']),
+                            self.request_mock)
+        self.assertEqual([b'01', b'2345', b'6'], list(response.streaming_content))
+
+    async def test_rechunks_async_streaming_content(self):
+        """Tests that asynchronous streaming content is re-segmented"""
+        get_response_mock = AsyncMock(
+            return_value=StreamingHttpResponse(aiterate([b'01', b'23456789'])))
+        response = await rechunk(4).acall(get_response_mock, self.request_mock)
+        self.assertEqual([b'0123', b'4567', b'89'], await acollect(response.streaming_content))
+
+
+class RandomStopStreamBehaviourTests(TestCase):
+    def setUp(self):
+        random_patcher = patch('uncertainty.behaviours.random')
+        self.random_mock = random_patcher.start()
+        self.addCleanup(random_patcher.stop)
+        self.request_mock = MagicMock()
+        self.random_stop = random_stop(0.5)
+
+    def test_stops_stream(self):
+        """Tests that random_stop stops the stream when the random number is below the
+        probability"""
+        self.random_mock.side_effect = [0.9, 0.1]
+        response = self.random_stop(lambda request: StreamingHttpResponse([b'a', b'b', b'c']),
+                                    self.request_mock)
+        self.assertEqual([b'a'], list(response.streaming_content))
+
+    async def test_stops_async_stream(self):
+        """Tests that random_stop stops an asynchronous stream when the random number is below
+        the probability"""
+        self.random_mock.side_effect = [0.9, 0.1]
+        get_response_mock = AsyncMock(
+            return_value=StreamingHttpResponse(aiterate([b'a', b'b', b'c'])))
+        response = await self.random_stop.acall(get_response_mock, self.request_mock)
+        self.assertEqual([b'a'], await acollect(response.streaming_content))
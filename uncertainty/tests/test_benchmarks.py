@@ -0,0 +1,37 @@
+from django.test import TestCase
+
+from uncertainty.tests.benchmarks import compare, compare_nodes, measure_all_nodes, run_benchmarks
+
+
+class BenchmarksTests(TestCase):
+    def test_runs_benchmarks(self):
+        """Tests that every benchmark reports the time and allocations per request"""
+        results = run_benchmarks(iterations=10)
+        self.assertIn('case_100_paths', results)
+        for result in results.values():
+            self.assertEqual(10, result['iterations'])
+            self.assertGreater(result['ns_per_request'], 0)
+            self.assertGreaterEqual(result['peak_bytes_per_request'], 0)
+
+    def test_compare_reports_regressions(self):
+        """Tests that compare returns the benchmarks that got slower than the threshold"""
+        baseline = {'a': {'ns_per_request': 100}, 'b': {'ns_per_request': 100}}
+        results = {'a': {'ns_per_request': 119}, 'b': {'ns_per_request': 121},
+                   'c': {'ns_per_request': 1000}}
+        self.assertEqual(['b'], compare(results, baseline, 0.2))
+
+    def test_measures_nodes(self):
+        """Tests that the memory taken by the nodes stays small (within what a slotted object with
+        its own attributes takes)"""
+        results = measure_all_nodes(count=1000)
+        self.assertIn('delay_server_error', results)
+        for result in results.values():
+            self.assertGreater(result['bytes_per_node'], 0)
+            self.assertLess(result['bytes_per_node'], 128)
+
+    def test_compare_nodes_reports_regressions(self):
+        """Tests that compare_nodes returns the nodes that got bigger than the threshold"""
+        baseline = {'a': {'bytes_per_node': 100}, 'b': {'bytes_per_node': 100}}
+        results = {'a': {'bytes_per_node': 119}, 'b': {'bytes_per_node': 121},
+                   'c': {'bytes_per_node': 1000}}
+        self.assertEqual(['b'], compare_nodes(results, baseline, 0.2))
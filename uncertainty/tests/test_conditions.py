@@ -1,9 +1,15 @@
-from django.test import TestCase
-from unittest.mock import MagicMock, patch
+from itertools import product
+
+from django.test import RequestFactory, TestCase
+from unittest.mock import MagicMock, PropertyMock, patch
 
 from uncertainty.conditions import (Predicate, NotPredicate, OrPredicate, AndPredicate,
                                     IsMethodPredicate, is_get, is_delete, is_post, is_put,
-                                    has_parameter, is_authenticated, user_is, path_matches)
+                                    has_parameter, is_authenticated, user_is, path_matches,
+                                    compile_predicate, compile_path_dispatch,
+                                    is_path_dispatchable, has_query_parameter, has_body_parameter,
+                                    constant_value, header_is, header_matches, has_cookie,
+                                    meta_is, is_synchronous)
 
 
 class PredicateTests(TestCase):
@@ -51,6 +57,24 @@ class PredicateTests(TestCase):
             self.assertEqual(and_predicate_mock.return_value, self.predicate & self.other_predicate)
 
 
+class PredicateImmutabilityTests(TestCase):
+    def test_predicates_have_no_instance_dictionary(self):
+        """Tests that the predicates declare __slots__ instead of having an instance dictionary"""
+        for predicate in (is_get, is_post | is_put, -is_get, is_get & path_matches('^/'),
+                          has_parameter('a'), has_query_parameter('a'), has_body_parameter('a'),
+                          is_authenticated(), user_is('a')):
+            self.assertFalse(hasattr(predicate, '__dict__'), predicate)
+
+    def test_attributes_can_not_be_changed(self):
+        """Tests that the attributes of a predicate can't be changed after construction"""
+        predicate = is_post | is_put
+        with self.assertRaises(AttributeError):
+            predicate._left = is_get
+        with self.assertRaises(AttributeError):
+            del predicate._right
+        self.assertIs(is_post, predicate._left)
+
+
 class NotPredicateTests(TestCase):
     def setUp(self):
         self.some_predicate = MagicMock()
@@ -288,6 +312,82 @@ class HasRequestParameterPredicateTests(TestCase):
         self.assertFalse(self.has_parameter(self.get_response_mock, self.request_mock))
 
 
+class HasQueryParameterPredicateTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_factory = RequestFactory()
+        self.has_query_parameter = has_query_parameter('some name')
+
+    def test_returns_true_if_query_string_has_parameter(self):
+        """Tests that has_query_parameter returns True if the query string has the parameter"""
+        for query_string in ('some+name=1', 'a=1&some%20name=', 'a&some+name', 'some+name'):
+            request = self.request_factory.get('/', QUERY_STRING=query_string)
+            self.assertTrue(self.has_query_parameter(self.get_response_mock, request),
+                            query_string)
+
+    def test_returns_false_if_query_string_hasnt_parameter(self):
+        """Tests that has_query_parameter returns False if the query string doesn't have the
+        parameter"""
+        for query_string in ('', 'a=some+name', 'some+names=1', 'a=1&b=2'):
+            request = self.request_factory.get('/', QUERY_STRING=query_string)
+            self.assertFalse(self.has_query_parameter(self.get_response_mock, request),
+                             query_string)
+
+    def test_doesnt_build_query_dict(self):
+        """Tests that has_query_parameter doesn't access request.GET"""
+        request = self.request_factory.get('/', QUERY_STRING='some+name=1')
+        self.assertTrue(self.has_query_parameter(self.get_response_mock, request))
+        self.assertNotIn('GET', request.__dict__)
+
+
+class HasBodyParameterPredicateTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_factory = RequestFactory()
+        self.has_body_parameter = has_body_parameter('name', max_size=100)
+
+    def test_returns_true_if_form_body_has_parameter(self):
+        """Tests that has_body_parameter returns True if the form body has the parameter"""
+        request = self.request_factory.post('/', 'a=1&name=2',
+                                            content_type='application/x-www-form-urlencoded')
+        self.assertTrue(self.has_body_parameter(self.get_response_mock, request))
+
+    def test_returns_false_if_form_body_hasnt_parameter(self):
+        """Tests that has_body_parameter returns False if the form body doesn't have the
+        parameter"""
+        request = self.request_factory.post('/', 'a=name',
+                                            content_type='application/x-www-form-urlencoded')
+        self.assertFalse(self.has_body_parameter(self.get_response_mock, request))
+
+    def test_keeps_body_for_the_view(self):
+        """Tests that the view can still read the body and the POST parameters"""
+        request = self.request_factory.post('/', 'name=2',
+                                            content_type='application/x-www-form-urlencoded')
+        self.has_body_parameter(self.get_response_mock, request)
+        self.assertEqual('2', request.POST['name'])
+
+    def test_doesnt_read_large_bodies(self):
+        """Tests that has_body_parameter doesn't read bodies larger than max_size"""
+        request = self.request_factory.post('/', 'name=' + 'x' * 100,
+                                            content_type='application/x-www-form-urlencoded')
+        self.assertFalse(self.has_body_parameter(self.get_response_mock, request))
+        self.assertFalse(hasattr(request, '_body'))
+
+    def test_doesnt_read_multipart_bodies(self):
+        """Tests that has_body_parameter never reads multipart bodies"""
+        request = self.request_factory.post('/', {'name': 'x'})
+        self.assertFalse(self.has_body_parameter(self.get_response_mock, request))
+        self.assertFalse(hasattr(request, '_body'))
+
+    def test_doesnt_read_bodies_without_content_length(self):
+        """Tests that has_body_parameter doesn't read bodies of unknown size"""
+        request = self.request_factory.post('/', 'name=2',
+                                            content_type='application/x-www-form-urlencoded')
+        del request.META['CONTENT_LENGTH']
+        self.assertFalse(self.has_body_parameter(self.get_response_mock, request))
+        self.assertFalse(hasattr(request, '_body'))
+
+
 class PathMatchesRegexpPredicateTests(TestCase):
     def setUp(self):
         self.get_response_mock = MagicMock()
@@ -345,3 +445,296 @@ class IsUserPredicateTests(TestCase):
         self.assertFalse(self.user_is(self.get_response_mock, self.request_mock))
         request_mock = MagicMock(spec=[])
         self.assertFalse(self.user_is(self.get_response_mock, request_mock))
+
+
+class MetaIsPredicateTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_factory = RequestFactory()
+
+    def test_returns_true_if_meta_has_value(self):
+        """Tests that meta_is returns True if the key of request.META has the value"""
+        request = self.request_factory.get('/', REMOTE_ADDR='10.0.0.1')
+        self.assertTrue(meta_is('REMOTE_ADDR', '10.0.0.1')(self.get_response_mock, request))
+
+    def test_returns_false_if_meta_has_other_value(self):
+        """Tests that meta_is returns False if the key has another value or it's missing"""
+        request = self.request_factory.get('/', REMOTE_ADDR='10.0.0.2')
+        self.assertFalse(meta_is('REMOTE_ADDR', '10.0.0.1')(self.get_response_mock, request))
+        self.assertFalse(meta_is('MISSING', '10.0.0.1')(self.get_response_mock, request))
+
+
+class HeaderIsPredicateTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_factory = RequestFactory()
+
+    def test_returns_true_if_header_has_value(self):
+        """Tests that header_is returns True if the header has the value"""
+        request = self.request_factory.get('/', HTTP_X_CLIENT_VERSION='1.2')
+        self.assertTrue(header_is('X-Client-Version', '1.2')(self.get_response_mock, request))
+        self.assertTrue(header_is('x-client-version', '1.2')(self.get_response_mock, request))
+
+    def test_returns_false_if_header_has_other_value(self):
+        """Tests that header_is returns False if the header has another value or it's missing"""
+        request = self.request_factory.get('/', HTTP_X_CLIENT_VERSION='1.3')
+        self.assertFalse(header_is('X-Client-Version', '1.2')(self.get_response_mock, request))
+        self.assertFalse(header_is('X-Other', '1.3')(self.get_response_mock, request))
+
+    def test_reads_content_type_from_meta(self):
+        """Tests that Content-Type and Content-Length are read from their META keys"""
+        request = self.request_factory.post('/', 'a=1', content_type='text/plain')
+        self.assertTrue(header_is('Content-Type', 'text/plain')(self.get_response_mock, request))
+        self.assertTrue(header_is('Content-Length', '3')(self.get_response_mock, request))
+
+    def test_doesnt_build_headers(self):
+        """Tests that header_is reads request.META instead of request.headers"""
+        request = self.request_factory.get('/', HTTP_X_CLIENT_VERSION='1.2')
+        header_is('X-Client-Version', '1.2')(self.get_response_mock, request)
+        self.assertNotIn('headers', request.__dict__)
+
+
+class HeaderMatchesPredicateTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_factory = RequestFactory()
+        self.header_matches = header_matches('User-Agent', r'MyApp/1\.')
+
+    def test_returns_true_if_header_matches(self):
+        """Tests that header_matches returns True if the value of the header matches the regexp"""
+        request = self.request_factory.get('/', HTTP_USER_AGENT='MyApp/1.4 (Android)')
+        self.assertTrue(self.header_matches(self.get_response_mock, request))
+
+    def test_returns_false_if_header_doesnt_match(self):
+        """Tests that header_matches returns False if the header doesn't match or it's missing"""
+        request = self.request_factory.get('/', HTTP_USER_AGENT='MyApp/2.0')
+        self.assertFalse(self.header_matches(self.get_response_mock, request))
+        self.assertFalse(self.header_matches(self.get_response_mock, self.request_factory.get('/')))
+
+
+class HasCookiePredicateTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_factory = RequestFactory()
+        self.request_factory.cookies['variant'] = 'b'
+
+    def test_returns_true_if_request_has_cookie(self):
+        """Tests that has_cookie returns True if the request has the cookie"""
+        request = self.request_factory.get('/')
+        self.assertTrue(has_cookie('variant')(self.get_response_mock, request))
+        self.assertTrue(has_cookie('variant', 'b')(self.get_response_mock, request))
+
+    def test_returns_false_if_request_doesnt_have_cookie(self):
+        """Tests that has_cookie returns False if the cookie is missing or has another value"""
+        request = self.request_factory.get('/')
+        self.assertFalse(has_cookie('other')(self.get_response_mock, request))
+        self.assertFalse(has_cookie('variant', 'a')(self.get_response_mock, request))
+
+
+class CompilePredicateTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_mock = MagicMock()
+        self.predicates = [MagicMock() for _ in range(4)]
+
+    def test_returns_non_predicates_unchanged(self):
+        """Tests that compile_predicate returns objects that aren't predicates unchanged"""
+        self.assertIs(self.predicates[0], compile_predicate(self.predicates[0]))
+
+    def test_removes_double_negation(self):
+        """Tests that compiling a double negation returns the negated predicate"""
+        self.assertIs(self.predicates[0],
+                      compile_predicate(NotPredicate(NotPredicate(self.predicates[0]))))
+
+    def test_matches_predicate_tree(self):
+        """Tests that the compiled predicate returns the same values as the predicate tree"""
+        p0, p1, p2, p3 = self.predicates
+        predicate = OrPredicate(AndPredicate(p0, NotPredicate(p1)),
+                                NotPredicate(OrPredicate(p2, AndPredicate(p3, p0))))
+        compiled = compile_predicate(predicate)
+        for values in product((True, False), repeat=4):
+            for some_predicate, value in zip(self.predicates, values):
+                some_predicate.return_value = value
+            self.assertEqual(bool(predicate(self.get_response_mock, self.request_mock)),
+                             bool(compiled(self.get_response_mock, self.request_mock)))
+
+    def test_short_circuits_disjunction(self):
+        """Tests that the compiled disjunction stops evaluating at the first True predicate"""
+        p0, p1, p2, _ = self.predicates
+        p0.return_value = False
+        p1.return_value = True
+        compiled = compile_predicate(OrPredicate(OrPredicate(p0, p1), p2))
+        self.assertTrue(compiled(self.get_response_mock, self.request_mock))
+        p0.assert_called_once_with(self.get_response_mock, self.request_mock)
+        p2.assert_not_called()
+
+    def test_short_circuits_conjunction(self):
+        """Tests that the compiled conjunction stops evaluating at the first False predicate"""
+        p0, p1, p2, _ = self.predicates
+        p0.return_value = True
+        p1.return_value = False
+        compiled = compile_predicate(AndPredicate(p0, AndPredicate(p1, p2)))
+        self.assertFalse(compiled(self.get_response_mock, self.request_mock))
+        p2.assert_not_called()
+
+    def test_folds_constant_predicate(self):
+        """Tests that the base Predicate is folded as a constant True"""
+        compiled = compile_predicate(OrPredicate(self.predicates[0], Predicate()))
+        self.assertTrue(compiled(self.get_response_mock, self.request_mock))
+        self.predicates[0].assert_not_called()
+        compiled = compile_predicate(NotPredicate(Predicate()))
+        self.assertFalse(compiled(self.get_response_mock, self.request_mock))
+
+    def test_compiles_long_chains(self):
+        """Tests that chains with many terms are compiled without exhausting the stack"""
+        predicates = [IsMethodPredicate(str(i)) for i in range(2000)]
+        predicate = predicates[0]
+        for other_predicate in predicates[1:]:
+            predicate = predicate | other_predicate
+        compiled = compile_predicate(predicate)
+        self.request_mock.method = '1999'
+        self.assertTrue(compiled(self.get_response_mock, self.request_mock))
+        self.request_mock.method = 'GET'
+        self.assertFalse(compiled(self.get_response_mock, self.request_mock))
+
+    def test_compiles_deeply_nested_predicates(self):
+        """Tests that deeply nested alternating predicates are still evaluated correctly"""
+        predicate = IsMethodPredicate('GET')
+        for i in range(300):
+            if i % 2:
+                predicate = predicate | IsMethodPredicate(str(i))
+            else:
+                predicate = predicate & Predicate() & -IsMethodPredicate(str(i))
+        compiled = compile_predicate(predicate)
+        for method in ('GET', '299', 'POST'):
+            self.request_mock.method = method
+            self.assertEqual(bool(predicate(self.get_response_mock, self.request_mock)),
+                             bool(compiled(self.get_response_mock, self.request_mock)))
+
+
+class ConstantValueTests(TestCase):
+    def test_returns_value_of_constant_predicates(self):
+        """Tests that constant_value returns the value of predicates that don't use the request"""
+        self.assertIs(True, constant_value(Predicate()))
+        self.assertIs(False, constant_value(-Predicate()))
+        self.assertIs(True, constant_value(Predicate() | is_get))
+        self.assertIs(False, constant_value(-Predicate() & is_get))
+
+    def test_returns_none_for_predicates_of_the_request(self):
+        """Tests that constant_value returns None for predicates that depend on the request"""
+        self.assertIsNone(constant_value(is_get))
+        self.assertIsNone(constant_value(Predicate() & is_get))
+        self.assertIsNone(constant_value(MagicMock()))
+
+
+class IsSynchronousTests(TestCase):
+    def test_predicates_of_the_user_are_synchronous(self):
+        """Tests that is_synchronous is True if any part of the predicate uses the user"""
+        self.assertTrue(is_synchronous(is_authenticated()))
+        self.assertTrue(is_synchronous(is_post & -user_is('username')))
+        self.assertTrue(is_synchronous(is_get | (is_post & is_authenticated())))
+
+    def test_predicates_of_the_request_are_not_synchronous(self):
+        """Tests that is_synchronous is False for predicates that only read the request"""
+        self.assertFalse(is_synchronous(is_get))
+        self.assertFalse(is_synchronous(-is_post | (path_matches('^/') & header_is('A', 'b'))))
+
+    def test_other_callables_are_synchronous(self):
+        """Tests that is_synchronous is True for callables that aren't predicates"""
+        self.assertTrue(is_synchronous(MagicMock()))
+        self.assertTrue(is_synchronous(is_get & MagicMock()))
+
+
+class CountingPredicate(Predicate):
+    pure = True
+
+    def __init__(self, name):
+        self._name = name
+        self.calls = 0
+
+    def __call__(self, get_response, request):
+        self.calls += 1
+        return True
+
+
+class PredicateMemoizationTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_mock = MagicMock()
+
+    def test_pure_predicate_is_evaluated_once_per_request(self):
+        """Tests that a pure predicate shared by several compiled predicates is only evaluated once
+        per request"""
+        predicate = CountingPredicate('a')
+        tests = [compile_predicate(predicate), compile_predicate(predicate & is_get),
+                 compile_predicate(-predicate | is_post)]
+        for test in tests:
+            test(self.get_response_mock, self.request_mock)
+        self.assertEqual(1, predicate.calls)
+
+    def test_pure_predicate_is_evaluated_for_each_request(self):
+        """Tests that the results of pure predicates are not shared amongst requests"""
+        predicate = CountingPredicate('a')
+        test = compile_predicate(predicate)
+        test(self.get_response_mock, MagicMock())
+        test(self.get_response_mock, MagicMock())
+        self.assertEqual(2, predicate.calls)
+
+    def test_equal_pure_predicates_share_results(self):
+        """Tests that pure predicates of the same type and arguments share the result"""
+        predicate_0 = CountingPredicate('a')
+        predicate_1 = CountingPredicate('a')
+        compile_predicate(predicate_0)(self.get_response_mock, self.request_mock)
+        compile_predicate(predicate_1)(self.get_response_mock, self.request_mock)
+        self.assertEqual(1, predicate_0.calls + predicate_1.calls)
+
+    def test_impure_predicate_is_evaluated_every_time(self):
+        """Tests that predicates that aren't pure are not memoized"""
+        predicate = MagicMock(spec=Predicate, return_value=True)
+        test = compile_predicate(AndPredicate(predicate, is_get))
+        request_mock = MagicMock(method='GET')
+        test(self.get_response_mock, request_mock)
+        test(self.get_response_mock, request_mock)
+        self.assertEqual(2, predicate.call_count)
+
+    def test_is_authenticated_is_evaluated_once_per_request(self):
+        """Tests that is_authenticated instances of several branches resolve request.user once"""
+        user_property = PropertyMock(return_value=MagicMock(is_authenticated=True))
+        request_mock = MagicMock()
+        type(request_mock).user = user_property
+        tests = [compile_predicate(is_authenticated()) for _ in range(3)]
+        self.assertTrue(all(test(self.get_response_mock, request_mock) for test in tests))
+        self.assertEqual(2, user_property.call_count)  # hasattr and access of one evaluation
+
+
+class PathDispatchTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_mock = MagicMock()
+        self.values = [MagicMock() for _ in range(3)]
+        self.dispatch = compile_path_dispatch([(path_matches('^/api/users'), self.values[0]),
+                                               (path_matches('^/api'), self.values[1]),
+                                               (path_matches('.*/health$'), self.values[2])])
+
+    def test_returns_value_of_first_matching_predicate(self):
+        """Tests that the value associated with the first matching regexp is returned"""
+        self.request_mock.path = '/api/users/1'
+        self.assertIs(self.values[0], self.dispatch(self.get_response_mock, self.request_mock))
+        self.request_mock.path = '/api/groups/1'
+        self.assertIs(self.values[1], self.dispatch(self.get_response_mock, self.request_mock))
+        self.request_mock.path = '/status/health'
+        self.assertIs(self.values[2], self.dispatch(self.get_response_mock, self.request_mock))
+
+    def test_returns_none_if_no_predicate_matches(self):
+        """Tests that None is returned if no regexp matches the request path"""
+        self.request_mock.path = '/admin'
+        self.assertIsNone(self.dispatch(self.get_response_mock, self.request_mock))
+
+    def test_regexps_with_groups_or_flags_arent_dispatchable(self):
+        """Tests that regexps with groups or global flags can't be merged"""
+        self.assertTrue(is_path_dispatchable(path_matches('^/api/(?:users|groups)')))
+        self.assertFalse(is_path_dispatchable(path_matches('^/api/(users|groups)')))
+        self.assertFalse(is_path_dispatchable(path_matches('(?i)^/api')))
+        self.assertFalse(is_path_dispatchable(path_matches('(?u)^/api')))
+        self.assertTrue(is_path_dispatchable(path_matches('^/(?i:api)')))
+        self.assertFalse(is_path_dispatchable(is_get))
@@ -0,0 +1,159 @@
+import gc
+import multiprocessing
+import os
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from unittest import skipIf
+from unittest.mock import patch
+
+from uncertainty.counters import SharedCounter, _files, fcntl
+
+
+def _add_in_child_process(path, amount, results):
+    counter = SharedCounter('test', path=path)
+    counter.add(amount)
+    results.put(counter._offset)
+
+
+def _add_in_child_process_or_fail(path, results):
+    counter = SharedCounter('test', slots=1, path=path)
+    try:
+        counter.add()
+    except ImproperlyConfigured:
+        results.put('ImproperlyConfigured')
+    else:
+        results.put(counter._offset)
+
+
+class SharedCounterTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'counter')
+
+    def test_starts_at_zero(self):
+        """Tests that a new counter has a value of 0"""
+        self.assertEqual(0, SharedCounter('test', path=self.path).value())
+
+    def test_add(self):
+        """Tests that add increments the value of the counter"""
+        counter = SharedCounter('test', path=self.path)
+        counter.add()
+        counter.add(2)
+        self.assertEqual(3, counter.value())
+
+    def test_counters_of_the_same_file_share_value(self):
+        """Tests that counters backed by the same file share the value"""
+        counter_0 = SharedCounter('test', path=self.path)
+        counter_1 = SharedCounter('test', path=self.path)
+        counter_0.add()
+        counter_1.add(2)
+        self.assertEqual(3, counter_0.value())
+        self.assertEqual(3, counter_1.value())
+
+    def test_counters_of_the_same_file_share_slot(self):
+        """Tests that the counters of the same file in a process share the map and the slot"""
+        counter_0 = SharedCounter('test', slots=1, path=self.path)
+        counter_1 = SharedCounter('test', slots=1, path=self.path)
+        counter_0.add()
+        counter_1.add()
+        self.assertIs(counter_0._file, counter_1._file)
+        self.assertEqual(2, counter_0.value())
+
+    def test_rebuilt_counters_dont_take_new_slots(self):
+        """Tests that counters built again (e.g. by rebuilding a budget) reuse the slot"""
+        for _ in range(3):
+            SharedCounter('test', slots=1, path=self.path).add()
+        self.assertEqual(3, SharedCounter('test', slots=1, path=self.path).value())
+
+    def test_closes_file_when_unused(self):
+        """Tests that the file is unmapped when no counter uses it anymore"""
+        counter = SharedCounter('test', path=self.path)
+        counter.add()
+        mapping = counter._mmap
+        del counter
+        gc.collect()
+        self.assertTrue(mapping.closed)
+        path = os.path.realpath(self.path)
+        self.assertEqual([], [key for key in _files.keys() if key[1] == path])
+
+    def test_raises_improperly_configured_for_different_slots(self):
+        """Tests that the counters of the same file must have the same amount of slots"""
+        counter = SharedCounter('test', slots=2, path=self.path)
+        counter.add()
+        self.assertRaises(ImproperlyConfigured, SharedCounter('test', slots=1, path=self.path).add)
+
+    @skipIf(fcntl is None or 'fork' not in multiprocessing.get_all_start_methods(),
+            'slots are only locked if fcntl is available')
+    def test_raises_improperly_configured_without_free_slots(self):
+        """Tests that a counter raises ImproperlyConfigured if all the slots are taken"""
+        counter = SharedCounter('test', slots=1, path=self.path)
+        counter.add()
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        process = context.Process(target=_add_in_child_process_or_fail,
+                                  args=(self.path, results))
+        process.start()
+        process.join()
+        self.assertEqual('ImproperlyConfigured', results.get(timeout=5))
+
+    @skipIf(fcntl is None or 'fork' not in multiprocessing.get_all_start_methods(),
+            'slots are only locked if fcntl is available')
+    def test_releases_slot_when_unused(self):
+        """Tests that the slot is released when no counter of the process uses it anymore"""
+        SharedCounter('test', slots=1, path=self.path).add()
+        gc.collect()
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        process = context.Process(target=_add_in_child_process_or_fail,
+                                  args=(self.path, results))
+        process.start()
+        process.join()
+        self.assertEqual(0, results.get(timeout=5))
+
+    @skipIf('fork' not in multiprocessing.get_all_start_methods(), 'fork is not available')
+    def test_sums_slots_of_all_processes(self):
+        """Tests that the value of the counter is the sum of the counts of all the processes"""
+        counter = SharedCounter('test', path=self.path)
+        counter.add()
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        process = context.Process(target=_add_in_child_process, args=(self.path, 5, results))
+        process.start()
+        process.join()
+        self.assertNotEqual(counter._offset, results.get(timeout=5))
+        self.assertEqual(6, counter.value())
+
+    @skipIf('fork' not in multiprocessing.get_all_start_methods(), 'fork is not available')
+    def test_claims_new_slot_after_fork(self):
+        """Tests that a counter used before forking claims a new slot in the child process"""
+        counter = SharedCounter('test', path=self.path)
+        counter.add()
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        process = context.Process(target=lambda: (counter.add(5), results.put(counter._offset)))
+        process.start()
+        process.join()
+        self.assertNotEqual(counter._offset, results.get(timeout=5))
+        self.assertEqual(6, counter.value())
+
+    def test_add_if_below(self):
+        """Tests that add_if_below only adds while the value is below the limit"""
+        counter = SharedCounter('test', path=self.path)
+        self.assertEqual([True, True, False], [counter.add_if_below(2) for _ in range(3)])
+        self.assertEqual(2, counter.value())
+
+    @patch('uncertainty.counters.time')
+    def test_window_starts_from_zero(self, time_mock):
+        """Tests that a windowed counter only counts the current window"""
+        counter = SharedCounter('test', window=60, path=self.path)
+        time_mock.return_value = 120
+        counter.add(3)
+        time_mock.return_value = 179
+        self.assertEqual(3, counter.value())
+        time_mock.return_value = 180
+        self.assertEqual(0, counter.value())
+        counter.add()
+        self.assertEqual(1, counter.value())
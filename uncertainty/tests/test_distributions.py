@@ -0,0 +1,238 @@
+import json
+import mmap
+import os
+import tempfile
+from statistics import mean, median
+
+from django.test import TestCase
+from unittest.mock import MagicMock, patch
+
+from uncertainty.behaviours import delay, delay_request
+from uncertainty.distributions import (Distribution, capped, empirical, exponential, jitter,
+                                       lognormal, pareto, per_path, uniform, _inverse_cdf_table)
+
+
+class DistributionTests(TestCase):
+    def setUp(self):
+        self.distribution = uniform(0, 1, batch_size=10, seed=1)
+
+    def test_first_sample_fills_buffer(self):
+        """Tests that taking the first sample generates a whole batch"""
+        with patch.object(self.distribution, '_generate',
+                          wraps=self.distribution._generate) as generate_mock:
+            self.distribution.sample()
+            generate_mock.assert_called_once_with(10)
+        self.assertEqual(9, len(self.distribution._buffer))
+
+    def test_buffer_refilled_in_background(self):
+        """Tests that a background thread refills the buffer when it runs low"""
+        with patch('uncertainty.distributions.threading.Thread') as thread_mock:
+            for _ in range(6):
+                self.distribution.sample()
+            thread_mock.assert_called_once_with(target=self.distribution._refill, daemon=True)
+            thread_mock.return_value.start.assert_called_once_with()
+            self.distribution._refill()
+        self.assertEqual(14, len(self.distribution._buffer))
+
+    def test_same_seed_same_samples(self):
+        """Tests that distributions with the same seed generate the same samples"""
+        other_distribution = uniform(0, 1, batch_size=10, seed=1)
+        self.assertEqual([self.distribution.sample() for _ in range(30)],
+                         [other_distribution.sample() for _ in range(30)])
+
+    def test_generate_not_implemented(self):
+        """Tests that the base distribution doesn't implement the generation of samples"""
+        self.assertRaises(NotImplementedError, Distribution().sample)
+
+
+class DistributionsTests(TestCase):
+    def assertSamples(self, distribution, low, high, expected_mean=None):
+        samples = [distribution.sample() for _ in range(5000)]
+        self.assertGreaterEqual(min(samples), low)
+        self.assertLessEqual(max(samples), high)
+        if expected_mean is not None:
+            self.assertAlmostEqual(expected_mean, mean(samples), delta=expected_mean * 0.1)
+
+    def test_exponential(self):
+        """Tests the samples of the exponential distribution"""
+        self.assertSamples(exponential(0.2, seed=1), 0, float('inf'), 0.2)
+
+    def test_lognormal(self):
+        """Tests the samples of the log-normal distribution"""
+        self.assertSamples(lognormal(-2, 0.5, seed=1), 0, float('inf'), 0.153)
+
+    def test_pareto(self):
+        """Tests the samples of the Pareto distribution"""
+        self.assertSamples(pareto(3, 0.1, seed=1), 0.1, float('inf'), 0.15)
+
+    def test_uniform(self):
+        """Tests the samples of the uniform distribution"""
+        self.assertSamples(uniform(0.1, 0.3, seed=1), 0.1, 0.3, 0.2)
+
+    def test_jitter(self):
+        """Tests the samples of the jitter distribution"""
+        self.assertSamples(jitter(0.5, 0.1, seed=1), 0.4, 0.6, 0.5)
+        self.assertSamples(jitter(0.05, 0.1, seed=1), 0, 0.15)
+
+    def test_capped(self):
+        """Tests the samples of the capped distribution"""
+        self.assertSamples(capped(pareto(1, 0.1), 0.5, seed=1), 0.1, 0.5)
+
+    def test_without_numpy(self):
+        """Tests the samples of the distributions when NumPy is not installed"""
+        with patch('uncertainty.distributions.numpy', new=None):
+            self.assertSamples(exponential(0.2, seed=1), 0, float('inf'), 0.2)
+            self.assertSamples(lognormal(-2, 0.5, seed=1), 0, float('inf'), 0.153)
+            self.assertSamples(pareto(3, 0.1, seed=1), 0.1, float('inf'), 0.15)
+            self.assertSamples(uniform(0.1, 0.3, seed=1), 0.1, 0.3, 0.2)
+            self.assertSamples(capped(pareto(1, 0.1), 0.5, seed=1), 0.1, 0.5)
+
+
+class EmpiricalDistributionTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def assertProfile(self, distribution):
+        samples = sorted(distribution.sample() for _ in range(10000))
+        self.assertGreaterEqual(samples[0], 0.01)
+        self.assertLessEqual(samples[-1], 2)
+        self.assertAlmostEqual(0.1, median(samples), delta=0.01)
+        self.assertAlmostEqual(1, samples[9900], delta=0.1)
+
+    def test_percentiles(self):
+        """Tests that the samples follow the given percentile table"""
+        self.assertProfile(empirical(percentiles=[(0, 0.01), (50, 0.1), (99, 1), (100, 2)],
+                                     seed=1))
+
+    def test_buckets(self):
+        """Tests that the samples follow the given histogram buckets"""
+        distribution = empirical(buckets=[(0.1, 50), (1, 99), (2, 100), (float('inf'), 100)],
+                                 seed=1)
+        samples = sorted(distribution.sample() for _ in range(10000))
+        self.assertLessEqual(samples[-1], 2)
+        self.assertAlmostEqual(0.1, median(samples), delta=0.01)
+        self.assertAlmostEqual(1, samples[9900], delta=0.1)
+
+    def test_buckets_must_be_cumulative(self):
+        """Tests that buckets whose counts decrease (per bucket counts) are rejected"""
+        self.assertRaises(ValueError, empirical, buckets=[(0.1, 50), (1, 49), (2, 1)])
+
+    def test_empty_profiles(self):
+        """Tests that profiles without any request are rejected"""
+        with self.assertRaisesRegex(ValueError, 'empty'):
+            empirical(buckets=[(0.1, 0), (0.2, 0)])
+        with self.assertRaisesRegex(ValueError, 'empty'):
+            empirical(buckets=[])
+        with self.assertRaisesRegex(ValueError, 'empty'):
+            empirical(percentiles=[])
+
+    def test_inline_profiles_validated_when_built(self):
+        """Tests that percentiles and buckets are checked by the constructor, not the first
+        sample"""
+        self.assertRaises(ValueError, empirical, percentiles=[(50, 'slow')])
+        with patch('uncertainty.distributions._inverse_cdf_table',
+                   wraps=_inverse_cdf_table) as table_mock:
+            distribution = empirical(percentiles=[(50, 0.1)])
+            table_mock.assert_called_once()
+            distribution.sample()
+            table_mock.assert_called_once()
+
+    def test_csv_file(self):
+        """Tests that percentile tables are loaded from CSV files"""
+        path = self.write('profile.csv', 'percentile,seconds\n0,0.01\n50,0.1\n99,1\n100,2\n')
+        self.assertProfile(empirical(path=path, seed=1))
+
+    def test_memory_mapped_csv_file(self):
+        """Tests that large CSV files are memory-mapped"""
+        path = self.write('profile.csv', 'le,count\n0.01,0\n0.1,50\n1,99\n2,100\n')
+        with patch('uncertainty.distributions.mmap.mmap', wraps=mmap.mmap) as mmap_mock:
+            self.assertProfile(empirical(path=path, mmap_threshold=0, seed=1))
+            self.assertTrue(mmap_mock.called)
+
+    def test_json_file(self):
+        """Tests that percentile tables are loaded from JSON files"""
+        path = self.write('profile.json', json.dumps(
+            {'percentiles': [[0, 0.01], [50, 0.1], [99, 1], [100, 2]]}))
+        self.assertProfile(empirical(path=path, seed=1))
+
+    def test_file_loaded_lazily(self):
+        """Tests that the file is not loaded until a sample is taken"""
+        distribution = empirical(path=os.path.join(self.directory.name, 'missing.csv'))
+        self.assertRaises(FileNotFoundError, distribution.sample)
+
+    def test_invalid_csv_header(self):
+        """Tests that CSV files with an unknown header are rejected"""
+        path = self.write('profile.csv', 'p,s\n0,0.01\n')
+        self.assertRaises(ValueError, empirical(path=path).sample)
+
+    def test_exactly_one_profile(self):
+        """Tests that exactly one of percentiles, buckets or path must be given"""
+        self.assertRaises(ValueError, empirical)
+        self.assertRaises(ValueError, empirical, percentiles=[(50, 1)], buckets=[(1, 1)])
+
+
+class PathDistributionTests(TestCase):
+    def setUp(self):
+        self.request_mock = MagicMock()
+        self.distribution_0 = MagicMock(spec=Distribution)
+        self.distribution_1 = MagicMock(spec=Distribution)
+        self.per_path = per_path([('^/api/users', self.distribution_0),
+                                  ('^/api', self.distribution_1)])
+
+    def test_samples_first_matching_route(self):
+        """Tests that the distribution of the first matching route is sampled"""
+        self.request_mock.path = '/api/users/1'
+        self.assertEqual(self.distribution_0.sample.return_value,
+                         self.per_path.sample(self.request_mock))
+        self.request_mock.path = '/api/groups/1'
+        self.assertEqual(self.distribution_1.sample.return_value,
+                         self.per_path.sample(self.request_mock))
+
+    def test_no_delay_if_no_route_matches(self):
+        """Tests that the delay is 0 if no route matches and there's no default"""
+        self.request_mock.path = '/admin'
+        self.assertEqual(0, self.per_path.sample(self.request_mock))
+
+    def test_capped(self):
+        """Tests that capped samples the distribution of the route of the request"""
+        self.request_mock.path = '/api/users/1'
+        self.distribution_0.sample.return_value = 10
+        distribution = capped(self.per_path, 1)
+        self.assertEqual(1, distribution.sample(self.request_mock))
+        self.distribution_0.sample.assert_called_once_with(self.request_mock)
+        self.request_mock.path = '/admin'
+        self.assertEqual(0, distribution.sample(self.request_mock))
+
+    def test_file_routes_are_empirical(self):
+        """Tests that routes pointing to files get an EmpiricalDistribution"""
+        distribution = per_path([('^/', 'profile.csv')])._routes[0][1]
+        self.assertEqual('profile.csv', distribution._path)
+
+
+class DelayDistributionTests(TestCase):
+    def setUp(self):
+        sleep_patcher = patch('uncertainty.behaviours.sleep')
+        self.sleep_mock = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+        self.get_response_mock = MagicMock()
+        self.request_mock = MagicMock()
+        self.distribution = MagicMock(spec=Distribution)
+
+    def test_delay_sleeps_sample(self):
+        """Tests that delay sleeps a sample of the distribution"""
+        delay(MagicMock(), self.distribution)(self.get_response_mock, self.request_mock)
+        self.distribution.sample.assert_called_once_with(self.request_mock)
+        self.sleep_mock.assert_called_once_with(self.distribution.sample.return_value)
+
+    def test_delay_request_sleeps_sample(self):
+        """Tests that delay_request sleeps a sample of the distribution"""
+        delay_request(MagicMock(), self.distribution)(self.get_response_mock, self.request_mock)
+        self.distribution.sample.assert_called_once_with(self.request_mock)
+        self.sleep_mock.assert_called_once_with(self.distribution.sample.return_value)
@@ -0,0 +1,173 @@
+import threading
+
+from django.test import RequestFactory, TestCase, override_settings
+from unittest.mock import MagicMock, patch
+
+from uncertainty import metrics
+from uncertainty.behaviours import (case, cond, delay, not_found, random_choice, server_error,
+                                    status)
+from uncertainty.conditions import is_get, path_matches
+from uncertainty.distributions import exponential
+from uncertainty.views import metrics_view
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_render_counters(self):
+        """Tests that counters are rendered in the Prometheus text format"""
+        metrics.inc('uncertainty_invocations_total', (('node', 'some "node"'),), 2)
+        self.assertIn('# TYPE uncertainty_invocations_total counter\n'
+                      'uncertainty_invocations_total{node="some \\"node\\""} 2\n',
+                      metrics.render())
+
+    def test_render_histograms(self):
+        """Tests that histograms are rendered with cumulative buckets, sum and count"""
+        metrics.observe('uncertainty_delay_seconds', (('node', 'n'),), 0.3)
+        metrics.observe('uncertainty_delay_seconds', (('node', 'n'),), 20)
+        rendered = metrics.render()
+        self.assertIn('uncertainty_delay_seconds_bucket{node="n",le="0.25"} 0\n', rendered)
+        self.assertIn('uncertainty_delay_seconds_bucket{node="n",le="0.5"} 1\n', rendered)
+        self.assertIn('uncertainty_delay_seconds_bucket{node="n",le="10.0"} 1\n', rendered)
+        self.assertIn('uncertainty_delay_seconds_bucket{node="n",le="+Inf"} 2\n', rendered)
+        self.assertIn('uncertainty_delay_seconds_sum{node="n"} 20.3\n', rendered)
+        self.assertIn('uncertainty_delay_seconds_count{node="n"} 2\n', rendered)
+
+    def test_sums_metrics_of_all_threads(self):
+        """Tests that the metrics recorded by each thread are added up"""
+        thread = threading.Thread(
+            target=metrics.inc, args=('uncertainty_invocations_total', (('node', 'n'),)))
+        thread.start()
+        thread.join()
+        metrics.inc('uncertainty_invocations_total', (('node', 'n'),))
+        counters, _ = metrics.collect()
+        self.assertEqual(2, counters[('uncertainty_invocations_total', (('node', 'n'),))])
+
+    @override_settings(DJANGO_UNCERTAINTY_METRICS=True)
+    def test_enabled_by_setting(self):
+        """Tests that the DJANGO_UNCERTAINTY_METRICS setting enables the metrics"""
+        self.assertTrue(metrics.enabled)
+
+    def test_disabled_by_default(self):
+        """Tests that the metrics are disabled if DJANGO_UNCERTAINTY_METRICS is not set"""
+        self.assertFalse(metrics.enabled)
+
+
+class LabelTests(TestCase):
+    def setUp(self):
+        metrics.reset_labels()
+        self.addCleanup(metrics.reset_labels)
+
+    def test_labels_are_short(self):
+        """Tests that labels are the class name and a digest, however big the subtree is"""
+        spec = case([(path_matches('^/{i}/'.format(i=i)), server_error()) for i in range(2000)])
+        self.assertRegex(metrics.label(spec), r'^MultiConditionalBehaviour:[0-9a-f]{12}$')
+
+    def test_equal_nodes_have_the_same_label(self):
+        """Tests that labels only depend on the class and arguments of the nodes"""
+        self.assertEqual(metrics.label(delay(server_error(), 2)),
+                         metrics.label(delay(server_error(), 2)))
+        self.assertEqual(metrics.label(delay(server_error(), exponential(1))),
+                         metrics.label(delay(server_error(), exponential(1))))
+        self.assertNotEqual(metrics.label(delay(server_error(), 2)),
+                            metrics.label(delay(server_error(), 3)))
+        self.assertNotEqual(metrics.label(delay(server_error(), 2)),
+                            metrics.label(delay(not_found(), 2)))
+
+    @override_settings(DJANGO_UNCERTAINTY_METRICS=True)
+    def test_reset_labels_labels_the_spec(self):
+        """Tests that reset_labels discards the labels and labels the nodes of the spec"""
+        metrics.label(server_error())
+        error = server_error()
+        spec = cond(is_get, error)
+        metrics.reset_labels(spec)
+        self.assertEqual({id(spec), id(is_get), id(error), id(spec._alternative_behaviour)},
+                         set(metrics._labels))
+
+    def test_reset_labels_doesnt_label_if_disabled(self):
+        """Tests that reset_labels only discards the labels if metrics are disabled"""
+        metrics.reset_labels(server_error())
+        self.assertEqual({}, metrics._labels)
+
+    @patch('uncertainty.metrics._MAX_LABELS', 2)
+    def test_labels_are_bounded(self):
+        """Tests that the labels are discarded when there are too many of them"""
+        for i in range(3):
+            metrics.label(status(200 + i))
+        self.assertEqual(1, len(metrics._labels))
+
+
+@override_settings(DJANGO_UNCERTAINTY_METRICS=True)
+class BehaviourMetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.get_response_mock = MagicMock()
+        self.request = RequestFactory().get('/')
+
+    def test_records_branches_and_predicate_results(self):
+        """Tests that conditional behaviours record the result of the predicate and the branch"""
+        error = server_error()
+        behaviour = cond(is_get, error)
+        behaviour(self.get_response_mock, self.request)
+        counters, _ = metrics.collect()
+        self.assertEqual(1, counters[('uncertainty_predicate_results_total',
+                                      (('predicate', metrics.label(is_get)), ('result', 'true')))])
+        self.assertEqual(1, counters[('uncertainty_branches_total',
+                                      (('node', metrics.label(behaviour)),
+                                       ('branch', metrics.label(error))))])
+        self.assertEqual(1, counters[('uncertainty_invocations_total',
+                                      (('node', metrics.label(error)),))])
+
+    def test_case_records_predicate_results(self):
+        """Tests that case records the result of every predicate it evaluates, including the ones
+        of merged path_matches predicates"""
+        first, second, third = path_matches('^/a/'), path_matches('^/b/'), is_get
+        behaviour = case([(first, server_error()), (second, not_found()), (third, status(418))])
+        response = behaviour(self.get_response_mock, self.request)
+        self.assertEqual(418, response.status_code)
+        counters, _ = metrics.collect()
+        for predicate, result in ((first, 'false'), (second, 'false'), (third, 'true')):
+            self.assertEqual(1, counters[('uncertainty_predicate_results_total',
+                                          (('predicate', metrics.label(predicate)),
+                                           ('result', result)))])
+
+    def test_records_injected_status_codes(self):
+        """Tests that response behaviours record the status code of the injected responses"""
+        error = server_error()
+        random_choice([(error, 1)])(self.get_response_mock, self.request)
+        counters, _ = metrics.collect()
+        self.assertEqual(1, counters[('uncertainty_responses_total',
+                                      (('node', metrics.label(error)), ('status', '500')))])
+
+    @patch('uncertainty.behaviours.sleep')
+    def test_records_injected_delays(self, sleep_mock):
+        """Tests that delay behaviours record the injected delays"""
+        behaviour = delay(MagicMock(), 0.3)
+        behaviour(self.get_response_mock, self.request)
+        _, histograms = metrics.collect()
+        buckets, total = histograms[('uncertainty_delay_seconds',
+                                     (('node', metrics.label(behaviour)),))]
+        self.assertEqual(1, sum(buckets))
+        self.assertEqual(0.3, total)
+
+    def test_records_nothing_if_disabled(self):
+        """Tests that the behaviours don't record metrics if they're disabled"""
+        with self.settings(DJANGO_UNCERTAINTY_METRICS=False):
+            cond(is_get, server_error())(self.get_response_mock, self.request)
+        self.assertEqual(({}, {}), metrics.collect())
+
+
+class MetricsViewTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_returns_metrics_in_prometheus_format(self):
+        """Tests that the view returns the rendered metrics as text"""
+        metrics.inc('uncertainty_invocations_total', (('node', 'n'),))
+        response = metrics_view(RequestFactory().get('/metrics'))
+        self.assertEqual('text/plain; version=0.0.4; charset=utf-8', response['Content-Type'])
+        self.assertEqual(metrics.render(), response.content.decode())
@@ -1,29 +1,150 @@
+import gc
+import os
+import tempfile
+import weakref
+
+from asgiref.sync import iscoroutinefunction
 from django.conf import settings
-from django.test import TestCase, override_settings
-from unittest.mock import MagicMock
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.signals import setting_changed
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils.functional import SimpleLazyObject
+from unittest.mock import AsyncMock, MagicMock, patch
 
+from uncertainty import metrics
+from uncertainty.behaviours import (Behaviour, MultiConditionalBehaviour, case, cond, default,
+                                    delay, random_choice, rate_limit, server_error)
+from uncertainty.conditions import is_authenticated, is_post, is_put, path_matches, user_is
 from uncertainty.middleware import UncertaintyMiddleware
+from uncertainty.sources import file_spec
+
+
+class UncertaintyMiddlewareInitTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+
+    @override_settings()
+    def test_raises_middleware_not_used_if_setting_is_missing(self):
+        """Tests that the middleware raises MiddlewareNotUsed if the DJANGO_UNCERTAINTY has not been
+        set"""
+        del settings.DJANGO_UNCERTAINTY
+        self.assertRaises(MiddlewareNotUsed, UncertaintyMiddleware, self.get_response_mock)
+
+    @override_settings(DJANGO_UNCERTAINTY=None)
+    def test_raises_middleware_not_used_if_setting_is_none(self):
+        """Tests that the middleware raises MiddlewareNotUsed if the DJANGO_UNCERTAINTY setting is
+        None"""
+        self.assertRaises(MiddlewareNotUsed, UncertaintyMiddleware, self.get_response_mock)
+
+    @override_settings(DJANGO_UNCERTAINTY='server_error')
+    def test_raises_improperly_configured_if_setting_is_not_callable(self):
+        """Tests that the middleware raises ImproperlyConfigured if the DJANGO_UNCERTAINTY setting
+        is not a Behaviour"""
+        self.assertRaises(ImproperlyConfigured, UncertaintyMiddleware, self.get_response_mock)
+
+    def test_interns_spec(self):
+        """Tests that the middleware shares the identical subtrees of the specification"""
+        spec = random_choice([(delay(server_error(), 1), 0.3),
+                              (cond(is_put, delay(server_error(), 1)), 0.3)])
+        with self.settings(DJANGO_UNCERTAINTY=spec):
+            uncertainty_middleware = UncertaintyMiddleware(self.get_response_mock)
+            setting_changed.disconnect(uncertainty_middleware._setting_changed)
+        interned = uncertainty_middleware._spec
+        self.assertEqual(spec, interned)
+        self.assertIs(interned._choices[0], interned._choices[1]._behaviour)
+
+    def test_optimizes_spec(self):
+        """Tests that the middleware optimizes the specification"""
+        spec = cond(is_post, server_error(), cond(is_put, server_error()))
+        with self.settings(DJANGO_UNCERTAINTY=spec):
+            uncertainty_middleware = UncertaintyMiddleware(self.get_response_mock)
+            setting_changed.disconnect(uncertainty_middleware._setting_changed)
+        self.assertIsInstance(uncertainty_middleware._spec, MultiConditionalBehaviour)
+
+    @override_settings(DJANGO_UNCERTAINTY_METRICS=True)
+    def test_labels_spec_for_metrics(self):
+        """Tests that the middleware labels the specification for the metrics, and discards the
+        labels of the previous one when the specification changes"""
+        spec = delay(server_error(), 1)
+        with self.settings(DJANGO_UNCERTAINTY=spec):
+            uncertainty_middleware = UncertaintyMiddleware(self.get_response_mock)
+            self.assertIn(id(uncertainty_middleware._spec), metrics._labels)
+            with self.settings(DJANGO_UNCERTAINTY=server_error()):
+                self.assertNotIn(id(spec), metrics._labels)
+            setting_changed.disconnect(uncertainty_middleware._setting_changed)
+
+    def test_releases_replaced_sources(self):
+        """Tests that the background thread of a replaced file_spec doesn't keep it alive"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'spec.json')
+        with open(path, 'w') as spec_file:
+            spec_file.write('{"type": "server_error"}')
+
+        spec = file_spec(path, interval=60)
+        reference = weakref.ref(spec)
+        with self.settings(DJANGO_UNCERTAINTY=spec):
+            uncertainty_middleware = UncertaintyMiddleware(self.get_response_mock)
+            self.addCleanup(setting_changed.disconnect, uncertainty_middleware._setting_changed)
+            spec._current()
+            spec._loaded.wait(5)
+            self.assertEqual(500, uncertainty_middleware(MagicMock()).status_code)
+        del spec
+        gc.collect()
+        self.assertIsNone(reference())
+
+    @override_settings(DJANGO_UNCERTAINTY_METRICS=True)
+    def test_records_predicate_results_of_optimized_specs(self):
+        """Tests that the predicates of cond chains (merged into a case by the optimizer) record
+        their results, also when their paths are dispatched with a single regexp"""
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        predicates = [is_post, path_matches('^/a/'), path_matches('^/b/'), path_matches('^/c/')]
+        spec = cond(predicates[0], server_error(),
+                    cond(predicates[1], server_error(),
+                         cond(predicates[2], delay(server_error(), 1),
+                              cond(predicates[3], server_error()))))
+        with self.settings(DJANGO_UNCERTAINTY=spec):
+            uncertainty_middleware = UncertaintyMiddleware(self.get_response_mock)
+            setting_changed.disconnect(uncertainty_middleware._setting_changed)
+            with patch('uncertainty.behaviours.sleep'):
+                response = uncertainty_middleware(RequestFactory().get('/b/'))
+        self.assertEqual(500, response.status_code)
+        counters, _ = metrics.collect()
+        results = {labels[0][1]: labels[1][1] for (name, labels) in counters
+                   if name == 'uncertainty_predicate_results_total'}
+        self.assertEqual({metrics.label(predicates[0]): 'false',
+                          metrics.label(predicates[1]): 'false',
+                          metrics.label(predicates[2]): 'true'}, results)
 
 
 class UncertaintyMiddlewareTests(TestCase):
     def setUp(self):
         self.get_response_mock = MagicMock()
         self.request_mock = MagicMock()
+        self.django_uncertainty = MagicMock()
+        settings_override = self.settings(DJANGO_UNCERTAINTY=self.django_uncertainty)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
         self.uncertainty_middleware = UncertaintyMiddleware(self.get_response_mock)
+        self.addCleanup(setting_changed.disconnect, self.uncertainty_middleware._setting_changed)
 
     @override_settings()
     def test_calls_get_response_if_setting_is_missing(self):
-        """Tests that the middleware calls the given get_response if the DJANGO_UNCERTAINTY has not
-        been set"""
+        """Tests that the middleware calls the given get_response if the DJANGO_UNCERTAINTY has
+        been removed"""
         del settings.DJANGO_UNCERTAINTY
+        setting_changed.send(sender=None, setting='DJANGO_UNCERTAINTY', value=None, enter=True)
         self.uncertainty_middleware(self.request_mock)
         self.get_response_mock.assert_called_once_with(self.request_mock)
 
     @override_settings()
     def test_returns_get_response_result_if_setting_is_missing(self):
         """Tests that the middleware returns the result of calling get_response if the
-        DJANGO_UNCERTAINTY has not been set"""
+        DJANGO_UNCERTAINTY has been removed"""
         del settings.DJANGO_UNCERTAINTY
+        setting_changed.send(sender=None, setting='DJANGO_UNCERTAINTY', value=None, enter=True)
         self.assertEqual(self.get_response_mock.return_value,
                          self.uncertainty_middleware(self.request_mock))
 
@@ -43,14 +164,101 @@ class UncertaintyMiddlewareTests(TestCase):
 
     def test_calls_django_uncertainty_setting(self):
         """Test that the middleware calls the DJANGO_UNCERTAINTY setting"""
-        django_uncertainty = MagicMock()
-        with self.settings(DJANGO_UNCERTAINTY=django_uncertainty):
-            self.uncertainty_middleware(self.request_mock)
-            django_uncertainty.assert_called_once_with(self.get_response_mock, self.request_mock)
+        self.uncertainty_middleware(self.request_mock)
+        self.django_uncertainty.assert_called_once_with(self.get_response_mock, self.request_mock)
 
     def test_returns_django_uncertainty_setting_result(self):
         """Test that the middleware returns the result of calling the DJANGO_UNCERTAINTY setting"""
+        self.assertEqual(self.django_uncertainty.return_value,
+                         self.uncertainty_middleware(self.request_mock))
+
+    def test_calls_changed_django_uncertainty_setting(self):
+        """Test that the middleware calls the new DJANGO_UNCERTAINTY setting after it changes"""
         django_uncertainty = MagicMock()
         with self.settings(DJANGO_UNCERTAINTY=django_uncertainty):
-            self.assertEqual(django_uncertainty.return_value,
-                             self.uncertainty_middleware(self.request_mock))
+            self.uncertainty_middleware(self.request_mock)
+            django_uncertainty.assert_called_once_with(self.get_response_mock, self.request_mock)
+            self.django_uncertainty.assert_not_called()
+
+    def test_doesnt_read_setting_on_each_request(self):
+        """Test that the middleware doesn't access the settings while processing requests"""
+        with patch('uncertainty.middleware.settings', new=object()):
+            self.uncertainty_middleware(self.request_mock)
+        self.django_uncertainty.assert_called_once_with(self.get_response_mock, self.request_mock)
+
+
+class UncertaintyMiddlewareAsyncTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = AsyncMock()
+        self.request_mock = MagicMock()
+        self.django_uncertainty = AsyncMock(spec=Behaviour)
+        settings_override = self.settings(DJANGO_UNCERTAINTY=self.django_uncertainty)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.uncertainty_middleware = UncertaintyMiddleware(self.get_response_mock)
+        self.addCleanup(setting_changed.disconnect, self.uncertainty_middleware._setting_changed)
+
+    def test_is_coroutine_function_if_get_response_is_async(self):
+        """Tests that the middleware is marked as a coroutine function if get_response is one"""
+        self.assertTrue(iscoroutinefunction(self.uncertainty_middleware))
+
+    def test_is_not_coroutine_function_if_get_response_is_sync(self):
+        """Tests that the middleware is not marked as a coroutine function if get_response is
+        synchronous"""
+        uncertainty_middleware = UncertaintyMiddleware(MagicMock())
+        self.addCleanup(setting_changed.disconnect, uncertainty_middleware._setting_changed)
+        self.assertFalse(iscoroutinefunction(uncertainty_middleware))
+
+    @override_settings(DJANGO_UNCERTAINTY=None)
+    async def test_awaits_get_response_if_setting_is_none(self):
+        """Tests that the middleware awaits get_response if the DJANGO_UNCERTAINTY setting is
+        None"""
+        response = await self.uncertainty_middleware(self.request_mock)
+        self.get_response_mock.assert_awaited_once_with(self.request_mock)
+        self.assertEqual(self.get_response_mock.return_value, response)
+
+    async def test_awaits_django_uncertainty_setting(self):
+        """Test that the middleware awaits the acall method of the DJANGO_UNCERTAINTY setting"""
+        response = await self.uncertainty_middleware(self.request_mock)
+        self.django_uncertainty.acall.assert_awaited_once_with(self.get_response_mock,
+                                                               self.request_mock)
+        self.assertEqual(self.django_uncertainty.acall.return_value, response)
+
+
+class UncertaintyMiddlewareAsyncUserTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = AsyncMock()
+        self.request_factory = RequestFactory()
+        self.user = User.objects.create_user('alice')
+
+    def get_request(self):
+        """Returns a request whose user is loaded from the database when it's first used, like the
+        one set by AuthenticationMiddleware."""
+        request = self.request_factory.get('/')
+        request.user = SimpleLazyObject(lambda: User.objects.get(pk=self.user.pk))
+        return request
+
+    async def get_response(self, spec):
+        with self.settings(DJANGO_UNCERTAINTY=spec):
+            uncertainty_middleware = UncertaintyMiddleware(self.get_response_mock)
+            self.addCleanup(setting_changed.disconnect, uncertainty_middleware._setting_changed)
+            return await uncertainty_middleware(self.get_request())
+
+    async def test_evaluates_is_authenticated_in_a_thread(self):
+        """Tests that is_authenticated doesn't load the lazy user on the event loop"""
+        response = await self.get_response(cond(is_authenticated(), server_error()))
+        self.assertEqual(500, response.status_code)
+
+    async def test_evaluates_user_is_in_a_thread(self):
+        """Tests that user_is doesn't load the lazy user on the event loop, also in case"""
+        response = await self.get_response(cond(-is_post & user_is('alice'), server_error()))
+        self.assertEqual(500, response.status_code)
+        response = await self.get_response(case([(is_post, default()),
+                                                 (user_is('alice'), server_error())]))
+        self.assertEqual(500, response.status_code)
+
+    async def test_evaluates_rate_limit_user_key_in_a_thread(self):
+        """Tests that rate_limit with the user key doesn't load the lazy user on the event loop"""
+        spec = rate_limit(default(), 1, per=60, key='user')
+        self.assertEqual(self.get_response_mock.return_value, await self.get_response(spec))
+        self.assertEqual(429, (await self.get_response(spec)).status_code)
@@ -0,0 +1,131 @@
+import pickle
+
+from django.test import RequestFactory, TestCase
+from unittest.mock import MagicMock
+
+from uncertainty.behaviours import (Behaviour, DelayResponseBehaviour, case, cond, default,
+                                    delay, json, rate_limit, random_choice, round_robin_choice,
+                                    server_error, status)
+from uncertainty.conditions import is_post, is_put, path_matches, user_is
+from uncertainty.nodes import intern_spec, map_children
+
+
+class NodeEqualityTests(TestCase):
+    def test_nodes_with_equal_arguments_are_equal(self):
+        """Tests that nodes of the same type and constructor arguments are equal"""
+        self.assertEqual(delay(server_error(), 2), delay(server_error(), 2))
+        self.assertEqual(hash(delay(server_error(), 2)), hash(delay(server_error(), 2)))
+        self.assertEqual(is_post | is_put, is_post | is_put)
+        self.assertEqual(user_is('a'), user_is('a'))
+
+    def test_nodes_with_different_arguments_are_not_equal(self):
+        """Tests that nodes with different types or constructor arguments are not equal"""
+        self.assertNotEqual(delay(server_error(), 2), delay(server_error(), 3))
+        self.assertNotEqual(is_post | is_put, is_put | is_post)
+        self.assertNotEqual(status(200), json(200))
+        self.assertNotEqual(json([1, 2]), json((1, 2)))
+        self.assertNotEqual(json(1), json(True))
+
+    def test_arguments_in_containers_are_compared(self):
+        """Tests that nodes in lists and dictionaries of arguments are compared structurally"""
+        self.assertEqual(random_choice([(server_error(), 0.5)]),
+                         random_choice([(server_error(), 0.5)]))
+        self.assertEqual(json({'a': [1]}), json({'a': [1]}))
+
+    def test_stateful_nodes_are_only_equal_to_themselves(self):
+        """Tests that stateful nodes (like rate_limit) are not equal to other nodes"""
+        behaviour = rate_limit(default(), 10)
+        self.assertEqual(behaviour, behaviour)
+        self.assertNotEqual(behaviour, rate_limit(default(), 10))
+
+    def test_nodes_with_unhashable_arguments_are_only_equal_to_themselves(self):
+        """Tests that nodes whose arguments can't be hashed are compared by identity"""
+        behaviour = json({1, 2})
+        self.assertEqual(behaviour, behaviour)
+        self.assertNotEqual(behaviour, json({1, 2}))
+        self.assertIsInstance(hash(behaviour), int)
+
+
+class NodeArgumentsTests(TestCase):
+    def test_argument_slots_are_not_kept_twice(self):
+        """Tests that nodes with _argument_slots rebuild their arguments from their slots"""
+        behaviour = delay(server_error(), 2)
+        self.assertIsNone(behaviour._init_args)
+        self.assertEqual(((server_error(), 2), {}), behaviour._arguments())
+
+    def test_empty_named_arguments_are_not_kept(self):
+        """Tests that nodes without named arguments don't keep an empty dictionary"""
+        self.assertIsNone(random_choice([(server_error(), 0.5)])._init_kwargs)
+        self.assertEqual({'window': 10},
+                         round_robin_choice([(server_error(), 0.5)], window=10)._init_kwargs)
+
+    def test_subclasses_of_argument_slots_classes_keep_arguments(self):
+        """Tests that subclasses (which may take other arguments) keep their own arguments"""
+        class CustomDelayBehaviour(DelayResponseBehaviour):
+            __slots__ = ()
+
+            def __init__(self, seconds):
+                super().__init__(server_error(), seconds)
+
+        behaviour = CustomDelayBehaviour(2)
+        self.assertEqual(((2,), {}), behaviour._arguments())
+        constructor, args = behaviour.__reduce__()
+        self.assertEqual(behaviour, constructor(*args))
+        self.assertIs(behaviour, map_children(behaviour, lambda child: child))
+
+    def test_default_behaviour_is_pickled_by_name(self):
+        """Tests that the shared default behaviour is still shared after unpickling"""
+        spec = pickle.loads(pickle.dumps(cond(is_post, server_error())))
+        self.assertIs(cond(is_post, server_error())._alternative_behaviour,
+                      spec._alternative_behaviour)
+
+
+class InternSpecTests(TestCase):
+    def test_shares_identical_subtrees(self):
+        """Tests that identical subtrees are replaced by a single instance"""
+        spec = intern_spec(case([(path_matches('^/{i}/'.format(i=i)),
+                                  delay(server_error(), 2)) for i in range(10)]))
+        behaviours = [behaviour for _, behaviour in spec._predicates_behaviours]
+        self.assertTrue(all(behaviour is behaviours[0] for behaviour in behaviours))
+
+    def test_shares_identical_predicates(self):
+        """Tests that identical predicates are replaced by a single instance"""
+        spec = intern_spec(cond(is_post | is_put, server_error(),
+                                cond(is_post | is_put, default())))
+        self.assertIs(spec._predicate, spec._alternative_behaviour._predicate)
+
+    def test_keeps_unique_specs(self):
+        """Tests that specifications without repeated subtrees are returned as they are"""
+        spec = cond(is_post, server_error(), delay(default(), 1))
+        self.assertIs(spec, intern_spec(spec))
+
+    def test_interned_spec_behaves_the_same(self):
+        """Tests that the interned specification behaves as the original one"""
+        spec = intern_spec(cond(path_matches('^/a/'), server_error(),
+                                cond(path_matches('^/b/'), server_error())))
+        request_factory = RequestFactory()
+        get_response_mock = MagicMock()
+        self.assertEqual(500, spec(get_response_mock, request_factory.get('/a/')).status_code)
+        self.assertEqual(500, spec(get_response_mock, request_factory.get('/b/')).status_code)
+        self.assertEqual(get_response_mock.return_value,
+                         spec(get_response_mock, request_factory.get('/c/')))
+
+    def test_keeps_stateful_nodes_apart(self):
+        """Tests that identical stateful nodes are not merged"""
+        spec = intern_spec(random_choice([rate_limit(default(), 10), rate_limit(default(), 10)]))
+        first, second = spec._choices
+        self.assertIsNot(first, second)
+
+    def test_leaves_other_objects_alone(self):
+        """Tests that objects that aren't nodes are returned as they are"""
+        behaviour_mock = MagicMock(spec=Behaviour)
+        self.assertIs(behaviour_mock, intern_spec(behaviour_mock))
+        self.assertIsNone(intern_spec(None))
+
+    def test_interns_long_chains(self):
+        """Tests that interning doesn't hash the whole subtree of every node"""
+        spec = default()
+        for i in range(100):
+            spec = cond(path_matches('^/{i}/'.format(i=i % 10)), server_error(), spec)
+        spec = intern_spec(spec)
+        self.assertIs(spec._behaviour, spec._alternative_behaviour._behaviour)
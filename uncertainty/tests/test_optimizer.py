@@ -0,0 +1,150 @@
+from django.test import RequestFactory, TestCase
+from unittest.mock import MagicMock
+
+from uncertainty.behaviours import (Behaviour, ConditionalBehaviour, MultiConditionalBehaviour,
+                                    RandomChoiceBehaviour, case, cond, default, delay, not_found,
+                                    random_choice, round_robin_choice, server_error, status)
+from uncertainty.conditions import Predicate, is_get, is_post, path_matches
+from uncertainty.optimizer import optimize_spec
+
+
+class ConditionalFoldingTests(TestCase):
+    def test_folds_always_true_cond(self):
+        """Tests that cond with a predicate that is always True is replaced by its behaviour"""
+        behaviour = server_error()
+        self.assertIs(behaviour, optimize_spec(cond(Predicate(), behaviour, not_found())))
+        self.assertIs(behaviour, optimize_spec(cond(Predicate() | is_get, behaviour)))
+
+    def test_folds_always_false_cond(self):
+        """Tests that cond with a predicate that is always False is replaced by its alternative"""
+        alternative = not_found()
+        self.assertIs(alternative, optimize_spec(cond(-Predicate(), server_error(), alternative)))
+
+    def test_folds_nested_conds(self):
+        """Tests that constant conds are folded anywhere in the specification"""
+        behaviour = server_error()
+        spec = optimize_spec(delay(cond(Predicate(), behaviour), 1))
+        self.assertIs(behaviour, spec._behaviour)
+
+    def test_drops_always_false_case_branches(self):
+        """Tests that case branches whose predicate is always False are dropped"""
+        behaviour = server_error()
+        spec = optimize_spec(case([(-Predicate(), not_found()), (is_post, behaviour)]))
+        self.assertEqual([(is_post, behaviour)], spec._predicates_behaviours)
+
+    def test_always_true_case_branch_becomes_default(self):
+        """Tests that a case branch whose predicate is always True ends the case"""
+        behaviour = not_found()
+        spec = optimize_spec(case([(is_post, server_error()), (Predicate(), behaviour),
+                                   (is_get, status(418))], server_error()))
+        self.assertEqual([(is_post, spec._predicates_behaviours[0][1])],
+                         spec._predicates_behaviours)
+        self.assertIs(behaviour, spec._default_behaviour)
+
+    def test_keeps_non_constant_cond(self):
+        """Tests that cond with a predicate that depends on the request is kept"""
+        spec = cond(is_post, server_error())
+        self.assertIs(spec, optimize_spec(spec))
+
+
+class ConditionalMergingTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_factory = RequestFactory()
+
+    def test_merges_cond_chain_into_case(self):
+        """Tests that chained conds are merged into a single case"""
+        first, second, alternative = server_error(), not_found(), status(418)
+        spec = optimize_spec(cond(path_matches('^/a/'), first,
+                                  cond(path_matches('^/b/'), second, alternative)))
+        self.assertIsInstance(spec, MultiConditionalBehaviour)
+        self.assertEqual([first, second], [b for _, b in spec._predicates_behaviours])
+        self.assertIs(alternative, spec._default_behaviour)
+        self.assertEqual(500, spec(self.get_response_mock, self.request_factory.get('/a/'))
+                         .status_code)
+        self.assertEqual(404, spec(self.get_response_mock, self.request_factory.get('/b/'))
+                         .status_code)
+        self.assertEqual(418, spec(self.get_response_mock, self.request_factory.get('/c/'))
+                         .status_code)
+
+    def test_merges_case_defaults(self):
+        """Tests that case and cond default behaviours are merged into the case"""
+        spec = optimize_spec(case([(is_post, server_error())],
+                                  cond(is_get, not_found(), case([(path_matches('^/'),
+                                                                   status(418))]))))
+        self.assertEqual(3, len(spec._predicates_behaviours))
+        self.assertIs(type(spec._default_behaviour), Behaviour)
+
+    def test_doesnt_merge_subclasses(self):
+        """Tests that subclasses of cond are left alone"""
+        class CustomConditionalBehaviour(ConditionalBehaviour):
+            __slots__ = ()
+
+        spec = cond(is_post, server_error(), CustomConditionalBehaviour(is_get, not_found()))
+        self.assertIs(spec, optimize_spec(spec))
+
+
+class RandomChoiceOptimizationTests(TestCase):
+    def assertProportions(self, expected, spec):
+        previous = 0
+        proportions = []
+        for behaviour, f_x in spec._behaviours:
+            proportions.append((behaviour, f_x - previous))
+            previous = f_x
+        self.assertEqual(len(expected), len(proportions))
+        for (expected_behaviour, expected_proportion), (behaviour, proportion) in zip(expected,
+                                                                                      proportions):
+            self.assertIs(expected_behaviour, behaviour)
+            self.assertAlmostEqual(expected_proportion, proportion)
+
+    def test_merges_nested_random_choices(self):
+        """Tests that nested random_choice behaviours are merged multiplying the proportions"""
+        first, second, third = server_error(), not_found(), status(418)
+        spec = optimize_spec(random_choice([(random_choice([(first, 0.5), (second, 0.25)]), 0.4),
+                                            (third, 0.2)]))
+        self.assertProportions([(first, 0.2), (second, 0.1), (third, 0.2)], spec)
+
+    def test_drops_zero_proportions(self):
+        """Tests that branches with a proportion of 0 are dropped"""
+        first, second = server_error(), not_found()
+        spec = optimize_spec(random_choice([(first, 0.3), (second, 0), (status(418), 0.0)]))
+        self.assertProportions([(first, 0.3)], spec)
+
+    def test_unwraps_single_certain_branch(self):
+        """Tests that random_choice with a single branch with a proportion of 1 is unwrapped"""
+        behaviour = server_error()
+        self.assertIs(behaviour, optimize_spec(random_choice([(behaviour, 1.0)])))
+        self.assertIs(behaviour, optimize_spec(random_choice([behaviour])))
+        spec = optimize_spec(random_choice([(random_choice([(behaviour, 0.5), (not_found(), 0)]),
+                                             0.5), (random_choice([behaviour]), 0)]))
+        self.assertProportions([(behaviour, 0.25)], spec)
+
+    def test_empty_random_choice_becomes_default(self):
+        """Tests that random_choice without branches is replaced by the default behaviour"""
+        self.assertIs(type(optimize_spec(random_choice([(server_error(), 0)]))), Behaviour)
+
+    def test_keeps_optimal_random_choice(self):
+        """Tests that random_choice behaviours that can't be optimized are kept"""
+        spec = random_choice([(server_error(), 0.3), (default(), 0.2)])
+        self.assertIs(spec, optimize_spec(spec))
+
+    def test_doesnt_merge_round_robin_choices(self):
+        """Tests that round_robin_choice behaviours are not merged into random_choice"""
+        inner = round_robin_choice([(server_error(), 0.5)])
+        spec = optimize_spec(random_choice([(inner, 0.5)]))
+        self.assertIsInstance(spec, RandomChoiceBehaviour)
+        self.assertIs(inner, spec._behaviours[0][0])
+
+
+class OptimizeSpecTests(TestCase):
+    def test_leaves_other_objects_alone(self):
+        """Tests that objects that aren't nodes are returned as they are"""
+        behaviour_mock = MagicMock(spec=Behaviour)
+        self.assertIs(behaviour_mock, optimize_spec(behaviour_mock))
+        self.assertIsNone(optimize_spec(None))
+
+    def test_optimizes_shared_subtrees_once(self):
+        """Tests that a subtree used in several places is optimized into a single node"""
+        shared = cond(is_post, server_error(), cond(is_get, not_found()))
+        spec = optimize_spec(random_choice([(shared, 0.2), (delay(shared, 1), 0.2)]))
+        self.assertIs(spec._behaviours[0][0], spec._behaviours[1][0]._behaviour)
@@ -0,0 +1,88 @@
+import threading
+
+from django.test import RequestFactory, TestCase, override_settings
+from unittest.mock import MagicMock
+
+from uncertainty.behaviours import RandomChoiceBehaviour
+from uncertainty.rng import get_random, random
+
+
+@override_settings(DJANGO_UNCERTAINTY_SEED=42, DJANGO_UNCERTAINTY_SEED_HEADER='X-Uncertainty-Seed')
+class GetRandomTests(TestCase):
+    def setUp(self):
+        self.request_factory = RequestFactory()
+
+    def test_same_header_value_replays_same_numbers(self):
+        """Tests that requests with the same seed header value get the same random numbers"""
+        request_0 = self.request_factory.get('/', HTTP_X_UNCERTAINTY_SEED='request-1')
+        request_1 = self.request_factory.get('/', HTTP_X_UNCERTAINTY_SEED='request-1')
+        self.assertEqual([random(request_0) for _ in range(10)],
+                         [random(request_1) for _ in range(10)])
+
+    def test_different_header_values_get_different_numbers(self):
+        """Tests that requests with different seed header values get different random numbers"""
+        request_0 = self.request_factory.get('/', HTTP_X_UNCERTAINTY_SEED='request-1')
+        request_1 = self.request_factory.get('/', HTTP_X_UNCERTAINTY_SEED='request-2')
+        self.assertNotEqual([random(request_0) for _ in range(10)],
+                            [random(request_1) for _ in range(10)])
+
+    def test_different_seeds_get_different_numbers(self):
+        """Tests that the same header value gets different random numbers with another seed"""
+        request_0 = self.request_factory.get('/', HTTP_X_UNCERTAINTY_SEED='request-1')
+        numbers = [random(request_0) for _ in range(10)]
+        with self.settings(DJANGO_UNCERTAINTY_SEED=43):
+            request_1 = self.request_factory.get('/', HTTP_X_UNCERTAINTY_SEED='request-1')
+            self.assertNotEqual(numbers, [random(request_1) for _ in range(10)])
+
+    @override_settings(DJANGO_UNCERTAINTY_SEED_HEADER='Content-Type')
+    def test_content_type_seed_header(self):
+        """Tests that the Content-Type header, which Django keeps without the HTTP_ prefix, can be
+        the seed header"""
+        request_0 = self.request_factory.post('/', content_type='a/b')
+        request_1 = self.request_factory.post('/', content_type='a/b')
+        self.assertIsNot(get_random(request_0), get_random())
+        self.assertEqual([random(request_0) for _ in range(10)],
+                         [random(request_1) for _ in range(10)])
+
+    def test_random_is_cached_on_the_request(self):
+        """Tests that the same random.Random instance is used for the lifetime of a request"""
+        request = self.request_factory.get('/', HTTP_X_UNCERTAINTY_SEED='request-1')
+        self.assertIs(get_random(request), get_random(request))
+
+    def test_requests_without_header_use_thread_random(self):
+        """Tests that requests without the seed header use the random.Random of the thread"""
+        request_0 = self.request_factory.get('/')
+        request_1 = self.request_factory.get('/')
+        self.assertIs(get_random(request_0), get_random(request_1))
+        self.assertIs(get_random(request_0), get_random())
+
+    def test_threads_use_different_randoms(self):
+        """Tests that each thread has its own random.Random instance"""
+        randoms = []
+        thread = threading.Thread(target=lambda: randoms.append(get_random()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(get_random(), randoms[0])
+
+    def test_seeded_thread_random_is_reproducible(self):
+        """Tests that the thread random.Random instances are seeded from the seed setting"""
+        with self.settings(DJANGO_UNCERTAINTY_SEED=7):
+            numbers = [random() for _ in range(10)]
+        with self.settings(DJANGO_UNCERTAINTY_SEED=7):
+            self.assertEqual(numbers, [random() for _ in range(10)])
+
+
+@override_settings(DJANGO_UNCERTAINTY_SEED=42, DJANGO_UNCERTAINTY_SEED_HEADER='X-Uncertainty-Seed')
+class RandomChoiceReplayTests(TestCase):
+    def test_random_choice_decisions_are_replayed(self):
+        """Tests that random_choice takes the same decisions for requests with the same seed
+        header value"""
+        request_factory = RequestFactory()
+        behaviours = [MagicMock() for _ in range(10)]
+        random_choice = RandomChoiceBehaviour(behaviours)
+        choices = []
+        for _ in range(2):
+            request = request_factory.get('/', HTTP_X_UNCERTAINTY_SEED='replay')
+            choices.append([random_choice._choose(request) for _ in range(20)])
+        self.assertEqual(choices[0], choices[1])
+        self.assertGreater(len(set(choices[0])), 1)
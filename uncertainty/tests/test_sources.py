@@ -0,0 +1,174 @@
+import gc
+import os
+import tempfile
+import weakref
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from unittest.mock import AsyncMock, MagicMock
+
+from uncertainty.behaviours import Behaviour
+from uncertainty.sources import cache_spec, file_spec, load_spec, publish_spec
+
+SPEC = """
+import uncertainty as u
+DJANGO_UNCERTAINTY = u.status({status})
+"""
+
+
+def load(behaviour):
+    """Starts the background thread of a ReloadingBehaviour and waits for the first load."""
+    behaviour._current()
+    behaviour._loaded.wait(5)
+
+
+class LoadSpecTests(TestCase):
+    def test_returns_django_uncertainty(self):
+        """Tests that load_spec returns the DJANGO_UNCERTAINTY variable of the source"""
+        spec = load_spec(SPEC.format(status=418))
+        self.assertEqual(418, spec(MagicMock(), MagicMock()).status_code)
+
+    def test_raises_key_error_without_django_uncertainty(self):
+        """Tests that load_spec raises KeyError if the source doesn't assign DJANGO_UNCERTAINTY"""
+        self.assertRaises(KeyError, load_spec, 'x = 1')
+
+
+class FileSpecBehaviourTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'spec.py')
+        self.write(418)
+        self.file_spec = file_spec(self.path, interval=60)
+        self.addCleanup(self.file_spec.stop)
+        self.get_response_mock = MagicMock()
+        self.request_mock = MagicMock()
+
+    def write(self, status, mtime=None):
+        with open(self.path, 'w') as spec_file:
+            spec_file.write(SPEC.format(status=status))
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_loads_spec_on_first_call(self):
+        """Tests that the specification of the file is loaded in the background and invoked"""
+        self.assertEqual(self.get_response_mock.return_value,
+                         self.file_spec(self.get_response_mock, self.request_mock))
+        self.file_spec._loaded.wait(5)
+        response = self.file_spec(self.get_response_mock, self.request_mock)
+        self.assertEqual(418, response.status_code)
+
+    def test_doesnt_load_on_request_path(self):
+        """Tests that the first invocation doesn't wait for the specification to load"""
+        stopped = self.file_spec._stopped
+        self.file_spec._load = MagicMock(side_effect=lambda: stopped.wait(5) and None)
+        self.assertEqual(self.get_response_mock.return_value,
+                         self.file_spec(self.get_response_mock, self.request_mock))
+        self.file_spec.stop()
+
+    def test_poller_doesnt_keep_behaviour_alive(self):
+        """Tests that the background thread stops when the behaviour isn't used anymore"""
+        file_spec_ = file_spec(self.path, interval=60)
+        load(file_spec_)
+        reference = weakref.ref(file_spec_)
+        del file_spec_
+        gc.collect()
+        self.assertIsNone(reference())
+
+    def test_reloads_spec_when_file_changes(self):
+        """Tests that reload swaps the specification when the file changes"""
+        load(self.file_spec)
+        self.write(503, mtime=0)
+        self.assertTrue(self.file_spec.reload())
+        self.assertEqual(503, self.file_spec(self.get_response_mock, self.request_mock).status_code)
+
+    def test_doesnt_reload_unchanged_file(self):
+        """Tests that reload doesn't load the file again if it hasn't changed"""
+        load(self.file_spec)
+        self.assertFalse(self.file_spec.reload())
+
+    def test_keeps_spec_if_file_is_invalid(self):
+        """Tests that the previous specification is kept if the new one can't be loaded"""
+        load(self.file_spec)
+        with open(self.path, 'w') as spec_file:
+            spec_file.write('DJANGO_UNCERTAINTY = (')
+        with self.assertLogs('uncertainty.sources'):
+            self.assertFalse(self.file_spec.reload())
+        self.assertEqual(418, self.file_spec(self.get_response_mock, self.request_mock).status_code)
+
+    def test_calls_get_response_if_file_is_missing(self):
+        """Tests that the default behaviour is used if the file can't be loaded at first"""
+        os.remove(self.path)
+        with self.assertLogs('uncertainty.sources'):
+            load(self.file_spec)
+        response = self.file_spec(self.get_response_mock, self.request_mock)
+        self.assertEqual(self.get_response_mock.return_value, response)
+
+    def test_polls_file_in_background(self):
+        """Tests that a background thread reloads the specification"""
+        file_spec_ = file_spec(self.path, interval=0.01)
+        self.addCleanup(file_spec_.stop)
+        load(file_spec_)
+        self.write(503, mtime=0)
+        for _ in range(500):
+            if file_spec_._version[0] == 0:
+                break
+            file_spec_._stopped.wait(0.01)
+        self.assertEqual(503, file_spec_(self.get_response_mock, self.request_mock).status_code)
+
+    async def test_awaits_spec(self):
+        """Tests that the asynchronous path awaits the specification"""
+        behaviour_mock = AsyncMock(spec=Behaviour)
+        self.file_spec._load = lambda: behaviour_mock
+        load(self.file_spec)
+        get_response_mock = AsyncMock()
+        response = await self.file_spec.acall(get_response_mock, self.request_mock)
+        behaviour_mock.acall.assert_awaited_once_with(get_response_mock, self.request_mock)
+        self.assertEqual(behaviour_mock.acall.return_value, response)
+
+
+class CacheSpecBehaviourTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.cache_spec = cache_spec('spec', interval=60)
+        self.addCleanup(self.cache_spec.stop)
+        self.get_response_mock = MagicMock()
+        self.request_mock = MagicMock()
+
+    def test_calls_get_response_until_spec_is_published(self):
+        """Tests that the default behaviour is used while there's no specification in the cache"""
+        self.assertEqual(self.get_response_mock.return_value,
+                         self.cache_spec(self.get_response_mock, self.request_mock))
+
+    def test_loads_published_spec(self):
+        """Tests that a published specification is loaded when its version changes"""
+        load(self.cache_spec)
+        self.assertEqual(1, publish_spec({'type': 'status', 'args': [418]}, 'spec'))
+        self.assertTrue(self.cache_spec.reload())
+        self.assertEqual(418, self.cache_spec(self.get_response_mock, self.request_mock)
+                         .status_code)
+        self.assertEqual(2, publish_spec('{"type": "status", "args": [503]}', 'spec'))
+        self.assertTrue(self.cache_spec.reload())
+        self.assertEqual(503, self.cache_spec(self.get_response_mock, self.request_mock)
+                         .status_code)
+
+    def test_stores_json(self):
+        """Tests that the specification is stored as JSON, so no code is run from the cache"""
+        publish_spec({'type': 'status', 'args': [418]}, 'spec')
+        self.assertEqual('{"type": "status", "args": [418]}', cache.get('spec'))
+
+    def test_doesnt_run_python_source(self):
+        """Tests that Python source in the cache is not run"""
+        cache.set('spec', SPEC.format(status=418))
+        cache.set('spec:version', 1)
+        with self.assertLogs('uncertainty.sources'):
+            load(self.cache_spec)
+        response = self.cache_spec(self.get_response_mock, self.request_mock)
+        self.assertEqual(self.get_response_mock.return_value, response)
+
+    def test_publish_rejects_invalid_spec(self):
+        """Tests that publish_spec doesn't store specifications that can't be built"""
+        self.assertRaises(ImproperlyConfigured, publish_spec, {'type': 'explode'}, 'spec')
+        self.assertIsNone(cache.get('spec:version'))
@@ -0,0 +1,146 @@
+import json
+import os
+import pickle
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory, TestCase
+from unittest import skipIf
+from unittest.mock import MagicMock, patch
+
+from uncertainty.behaviours import ConditionalBehaviour, cond, random_choice, server_error
+from uncertainty.conditions import AndPredicate, is_post, path_matches
+from uncertainty.specs import build_spec, load_spec_file, tomllib
+
+SPEC = {
+    'type': 'cond',
+    'predicate': {'type': 'and', 'predicates': [{'type': 'is_post'},
+                                                {'type': 'path_matches', 'regexp': '^/api/'}]},
+    'behaviour': {'type': 'status', 'args': [503]},
+}
+
+
+class BuildSpecTests(TestCase):
+    def setUp(self):
+        self.get_response_mock = MagicMock()
+        self.request_factory = RequestFactory()
+
+    def test_builds_behaviour_tree(self):
+        """Tests that build_spec builds the behaviours and conditions of the specification"""
+        spec = build_spec(SPEC)
+        self.assertIsInstance(spec, ConditionalBehaviour)
+        self.assertIsInstance(spec._predicate, AndPredicate)
+        self.assertEqual(503, spec(self.get_response_mock,
+                                   self.request_factory.post('/api/')).status_code)
+        self.assertEqual(self.get_response_mock.return_value,
+                         spec(self.get_response_mock, self.request_factory.get('/api/')))
+
+    def test_builds_nested_lists(self):
+        """Tests that lists of behaviours and proportions are built"""
+        spec = build_spec({'type': 'random_choice',
+                           'behaviours': [[{'type': 'server_error'}, 1.0]]})
+        self.assertEqual(500, spec(self.get_response_mock, self.request_factory.get('/'))
+                         .status_code)
+
+    def test_builds_not(self):
+        """Tests that the not type negates a predicate"""
+        spec = build_spec({'type': 'cond', 'predicate': {'type': 'not',
+                                                         'predicate': {'type': 'is_get'}},
+                           'behaviour': {'type': 'server_error'}})
+        self.assertEqual(500, spec(self.get_response_mock, self.request_factory.post('/'))
+                         .status_code)
+
+    def test_raises_improperly_configured_for_unknown_types(self):
+        """Tests that build_spec raises ImproperlyConfigured naming the path of unknown types"""
+        with self.assertRaisesRegex(ImproperlyConfigured, r'spec\.behaviour: unknown type'):
+            build_spec({'type': 'cond', 'predicate': {'type': 'is_get'},
+                        'behaviour': {'type': 'explode'}})
+
+    def test_raises_improperly_configured_for_wrong_arguments(self):
+        """Tests that build_spec raises ImproperlyConfigured if the arguments don't match"""
+        with self.assertRaisesRegex(ImproperlyConfigured, r'spec\.predicate'):
+            build_spec({'type': 'cond', 'predicate': {'type': 'path_matches', 'regex': '^/'},
+                        'behaviour': {'type': 'server_error'}})
+
+    def test_raises_improperly_configured_for_arguments_of_predicate_instances(self):
+        """Tests that build_spec raises ImproperlyConfigured if is_get and the like get arguments"""
+        with self.assertRaises(ImproperlyConfigured):
+            build_spec({'type': 'cond', 'predicate': {'type': 'is_get', 'args': [1]},
+                        'behaviour': {'type': 'server_error'}})
+
+    def test_validates_before_building(self):
+        """Tests that nothing is built if any part of the specification is invalid"""
+        with patch('uncertainty.specs._build') as build_mock:
+            with self.assertRaises(ImproperlyConfigured):
+                build_spec([SPEC, {'type': 'explode'}])
+        build_mock.assert_not_called()
+
+
+class PickleTests(TestCase):
+    def test_behaviour_tree_can_be_pickled(self):
+        """Tests that specifications with compiled predicates can be pickled and unpickled"""
+        spec = cond(is_post & path_matches('^/api/'),
+                    random_choice([(server_error(), 1.0)]))
+        unpickled = pickle.loads(pickle.dumps(spec))
+        request = RequestFactory().post('/api/')
+        self.assertEqual(500, unpickled(MagicMock(), request).status_code)
+        self.assertEqual(str(spec), str(unpickled))
+
+
+class LoadSpecFileTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(self.directory, 'spec.json')
+        with open(self.path, 'w') as spec_file:
+            json.dump(SPEC, spec_file)
+        self.cache_dir = os.path.join(self.directory, 'cache')
+
+    def test_loads_json(self):
+        """Tests that load_spec_file builds the specification of a JSON file"""
+        self.assertIsInstance(load_spec_file(self.path), ConditionalBehaviour)
+
+    @skipIf(tomllib is None, 'tomllib is not available')
+    def test_loads_toml(self):
+        """Tests that load_spec_file builds the specification of a TOML file"""
+        path = os.path.join(self.directory, 'spec.toml')
+        with open(path, 'w') as spec_file:
+            spec_file.write('type = "cond"\n'
+                            'predicate = {type = "is_post"}\n'
+                            'behaviour = {type = "status", args = [503]}\n')
+        spec = load_spec_file(path)
+        self.assertEqual(503, spec(MagicMock(), RequestFactory().post('/')).status_code)
+
+    def test_caches_built_spec(self):
+        """Tests that the built specification is pickled into the cache directory"""
+        load_spec_file(self.path, cache_dir=self.cache_dir)
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+        with patch('uncertainty.specs.build_spec') as build_spec_mock:
+            spec = load_spec_file(self.path, cache_dir=self.cache_dir)
+        build_spec_mock.assert_not_called()
+        self.assertIsInstance(spec, ConditionalBehaviour)
+
+    def test_changed_content_is_built_again(self):
+        """Tests that the cache is keyed by the content of the file"""
+        load_spec_file(self.path, cache_dir=self.cache_dir)
+        with open(self.path, 'w') as spec_file:
+            json.dump(dict(SPEC, behaviour={'type': 'server_error'}), spec_file)
+        spec = load_spec_file(self.path, cache_dir=self.cache_dir)
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+        self.assertEqual(500, spec(MagicMock(), RequestFactory().post('/api/')).status_code)
+
+    def test_uses_cache_dir_setting(self):
+        """Tests that the DJANGO_UNCERTAINTY_SPEC_CACHE_DIR setting sets the cache directory"""
+        with self.settings(DJANGO_UNCERTAINTY_SPEC_CACHE_DIR=self.cache_dir):
+            load_spec_file(self.path)
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+    def test_rebuilds_corrupt_cache(self):
+        """Tests that unreadable cached specifications are built again"""
+        load_spec_file(self.path, cache_dir=self.cache_dir)
+        cache_path = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        with open(cache_path, 'wb') as cache_file:
+            cache_file.write(b'garbage')
+        self.assertIsInstance(load_spec_file(self.path, cache_dir=self.cache_dir),
+                              ConditionalBehaviour)
@@ -0,0 +1,15 @@
+from django.http import HttpResponse
+
+from . import metrics
+
+
+def metrics_view(request):
+    """A view that exposes the metrics recorded by the behaviours (see uncertainty.metrics) in the
+    Prometheus text exposition format. Add it to the URLconf to let Prometheus scrape it:
+
+    path('uncertainty/metrics', uncertainty.views.metrics_view)
+
+    :param request: The request
+    :return: An HttpResponse with the metrics
+    """
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')